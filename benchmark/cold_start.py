@@ -0,0 +1,97 @@
+"""
+Measure cold start cost of the lambda handler modules.
+
+Each handler module is imported in a fresh interpreter several times. Import
+time, memory used by the import and the heavy packages loaded are reported, e.g.
+
+    python benchmark/cold_start.py --runs 20
+"""
+
+import os
+import sys
+import json
+import argparse
+import statistics
+import subprocess
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+
+# Environment used by the functions unless already set
+DEFAULT_ENV = {
+    "AWS_REGION": "us-east-1",
+    "AWS_ACCESS_KEY_ID": "benchmark",
+    "AWS_SECRET_ACCESS_KEY": "benchmark",
+    "IAM_KEY_ROTATOR_TABLE": "iam-key-rotator",
+    "MAIL_CLIENT": "ses",
+    "MAIL_FROM": "security@example.com",
+    "ENCRYPT_KEY_PAIR": "false",
+    "PREFETCH_ACCOUNT_INFO": "false",
+}
+
+# Packages which are expensive to import and are needed only by some configurations
+HEAVY_PACKAGES = ["boto3", "cryptography", "requests"]
+
+# Code run in the fresh interpreter. Memory is measured as the growth of the
+# resident set size so that the interpreter itself is not counted
+CHILD_CODE = """
+import sys, json, time, resource
+sys.path.insert(0, sys.argv[2])
+rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+started_at = time.perf_counter()
+__import__(sys.argv[1])
+import_ms = (time.perf_counter() - started_at) * 1000
+rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+print(json.dumps({
+    "import_ms": import_ms,
+    "rss_kib": rss_after - rss_before,
+    "modules": len(sys.modules),
+    "loaded": sorted(p for p in json.loads(sys.argv[3]) if p in sys.modules),
+}))
+"""
+
+
+def measure(module, src_dir, env):
+    """
+    Import module in a fresh interpreter and return the measurements
+    """
+    out = subprocess.run(
+        [sys.executable, "-c", CHILD_CODE, module, src_dir, json.dumps(HEAVY_PACKAGES)],
+        env=env,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    return json.loads(out.stdout.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument(
+        "--modules",
+        default="creator,destructor",
+        help="Comma separated handler modules to import",
+    )
+    parser.add_argument(
+        "--runs", type=int, default=10, help="No. of fresh imports per module"
+    )
+    parser.add_argument(
+        "--src", default=SRC_DIR, help="Directory holding the function modules"
+    )
+    args = parser.parse_args()
+
+    env = {**DEFAULT_ENV, **os.environ}
+    header = f"{'module':<12} {'import_ms_p50':>13} {'import_ms_max':>13} {'rss_mib':>8} {'modules':>8}  heavy packages loaded"
+    print(header)
+    print("-" * len(header))
+    for module in args.modules.split(","):
+        runs = [
+            measure(module, os.path.abspath(args.src), env) for _ in range(args.runs)
+        ]
+        import_ms = [r["import_ms"] for r in runs]
+        print(
+            f"{module:<12} {statistics.median(import_ms):>13.1f} {max(import_ms):>13.1f} {statistics.median(r['rss_kib'] for r in runs) / 1024:>8.1f} {runs[-1]['modules']:>8}  {', '.join(runs[-1]['loaded']) or '-'}"
+        )
+
+
+if __name__ == "__main__":
+    main()
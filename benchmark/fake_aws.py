@@ -0,0 +1,481 @@
+"""
+In-memory stand-in for the AWS services used by creator and destructor functions.
+Every API call is counted and can be slowed down or throttled to see how the
+functions behave against a busy account
+"""
+
+import io
+import re
+import csv
+import time
+import random
+import threading
+from datetime import datetime, timedelta, timezone
+
+from botocore.exceptions import ClientError
+
+# Error code returned by each service when a request is throttled
+THROTTLING_ERROR_CODES = {
+    "iam": "Throttling",
+    "dynamodb": "ProvisionedThroughputExceededException",
+    "ssm": "ThrottlingException",
+    "kms": "ThrottlingException",
+    "ses": "Throttling",
+    "lambda": "TooManyRequestsException",
+}
+
+# No. of items returned in a single page by paginated calls
+PAGE_SIZE = 100
+
+
+class TokenBucket:
+    """
+    Allows rate calls per second with bursts of up to rate calls
+    """
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = rate
+        self.updated_at = time.monotonic()
+
+    def take(self):
+        """
+        Consume a token. Returns False if no token is left
+        """
+        now = time.monotonic()
+        self.tokens = min(self.rate, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+
+class FakeAWS:
+    """
+    Holds state of the fake account along with call counters. latency_ms, rate_limit
+    and throttle_prob are dicts of service name to value, "*" applies to all services.
+    now is the fixed time at which keys are created and reports are generated
+    """
+
+    def __init__(
+        self, latency_ms=None, rate_limit=None, throttle_prob=None, seed=0, now=None
+    ):
+        self.now = now or datetime.now(timezone.utc)
+        self.latency_ms = latency_ms or {}
+        self.rate_limit = rate_limit or {}
+        self.throttle_prob = throttle_prob or {}
+        self.calls = {}
+        self.throttles = {}
+        self.users = {}
+        self.tables = {}
+        self.parameters = {}
+        self.invocations = []
+        self._buckets = {}
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def _setting(self, settings, service):
+        return settings.get(service, settings.get("*", 0))
+
+    def api_call(self, service, operation, throttle=True):
+        """
+        Count API call, wait for the configured latency and raise a throttling
+        error if the call is over the rate limit of the service
+        """
+        latency_ms = self._setting(self.latency_ms, service)
+        if latency_ms > 0:
+            time.sleep(latency_ms / 1000)
+
+        with self._lock:
+            key = f"{service}:{operation}"
+            self.calls[key] = self.calls.get(key, 0) + 1
+            throttled = False
+            if throttle:
+                rate = self._setting(self.rate_limit, service)
+                if rate > 0:
+                    bucket = self._buckets.setdefault(service, TokenBucket(rate))
+                    throttled = not bucket.take()
+                prob = self._setting(self.throttle_prob, service)
+                if not throttled and prob > 0:
+                    throttled = self._random.random() < prob
+            if throttled:
+                self.throttles[service] = self.throttles.get(service, 0) + 1
+
+        if throttled:
+            raise client_error(
+                THROTTLING_ERROR_CODES[service], "Rate exceeded", operation
+            )
+
+    def reset_counters(self):
+        """
+        Clear call and throttle counters, e.g. between creator and destructor runs
+        """
+        with self._lock:
+            self.calls = {}
+            self.throttles = {}
+
+    def calls_per_service(self):
+        """
+        Return total no. of API calls made to each service
+        """
+        totals = {}
+        for key, count in self.calls.items():
+            service = key.split(":")[0]
+            totals[service] = totals.get(service, 0) + count
+        return totals
+
+    def add_user(self, user_name, tags, key_ages):
+        """
+        Add user with the given tags and access keys of the given age in days
+        """
+        self.users[user_name] = {
+            "tags": tags,
+            "keys": [
+                {
+                    "AccessKeyId": f"AKIA{user_name.upper()}{i}",
+                    "CreateDate": self.now - timedelta(days=age, hours=1),
+                    "Status": "Active",
+                }
+                for i, age in enumerate(key_ages)
+            ],
+        }
+
+    def clients(self):
+        """
+        Return fake client of each service
+        """
+        return {
+            "iam": FakeIAM(self),
+            "dynamodb": FakeDynamoDB(self),
+            "ssm": FakeSSM(self),
+            "kms": FakeKMS(self),
+            "ses": FakeSES(self),
+            "lambda": FakeLambda(self),
+        }
+
+
+def client_error(code, message, operation):
+    """
+    Build ClientError the same way botocore raises it
+    """
+    return ClientError({"Error": {"Code": code, "Message": message}}, operation)
+
+
+class FakePaginator:
+    """
+    Paginator which makes a counted call for every page
+    """
+
+    def __init__(self, aws, service, operation, pages):
+        self.aws = aws
+        self.service = service
+        self.operation = operation
+        self.pages = pages
+
+    def paginate(self, **kwargs):
+        for page in self.pages(**kwargs):
+            # botocore retries throttled pages on its own
+            self.aws.api_call(self.service, self.operation, throttle=False)
+            yield page
+
+
+class FakeIAM:
+    def __init__(self, aws):
+        self.aws = aws
+
+    def _user(self, user_name, operation):
+        user = self.aws.users.get(user_name)
+        if user is None:
+            raise client_error(
+                "NoSuchEntity",
+                f"The user with name {user_name} cannot be found.",
+                operation,
+            )
+        return user
+
+    def get_paginator(self, operation):
+        if operation != "get_account_authorization_details":
+            raise NotImplementedError(operation)
+        return FakePaginator(
+            self.aws, "iam", "GetAccountAuthorizationDetails", self._details_pages
+        )
+
+    def _details_pages(self, **kwargs):
+        names = sorted(self.aws.users)
+        for i in range(0, len(names), PAGE_SIZE):
+            yield {
+                "UserDetailList": [
+                    {"UserName": name, "Tags": self.aws.users[name]["tags"]}
+                    for name in names[i : i + PAGE_SIZE]
+                ],
+                "IsTruncated": i + PAGE_SIZE < len(names),
+            }
+
+    def list_users(self, Marker=None):
+        self.aws.api_call("iam", "ListUsers")
+        names = sorted(self.aws.users)
+        start = int(Marker or 0)
+        resp = {
+            "Users": [{"UserName": name} for name in names[start : start + PAGE_SIZE]],
+            "IsTruncated": start + PAGE_SIZE < len(names),
+        }
+        if resp["IsTruncated"]:
+            resp["Marker"] = str(start + PAGE_SIZE)
+        return resp
+
+    def list_user_tags(self, UserName):
+        self.aws.api_call("iam", "ListUserTags")
+        return {"Tags": self._user(UserName, "ListUserTags")["tags"]}
+
+    def list_access_keys(self, UserName):
+        self.aws.api_call("iam", "ListAccessKeys")
+        user = self._user(UserName, "ListAccessKeys")
+        return {"AccessKeyMetadata": [dict(k) for k in user["keys"]]}
+
+    def create_access_key(self, UserName):
+        self.aws.api_call("iam", "CreateAccessKey")
+        with self.aws._lock:
+            user = self._user(UserName, "CreateAccessKey")
+            if len(user["keys"]) >= 2:
+                raise client_error(
+                    "LimitExceeded",
+                    "Cannot exceed quota for AccessKeysPerUser: 2",
+                    "CreateAccessKey",
+                )
+            key = {
+                "AccessKeyId": f"AKIANEW{UserName.upper()}{len(user['keys'])}",
+                "CreateDate": self.aws.now,
+                "Status": "Active",
+            }
+            user["keys"].append(key)
+        return {
+            "AccessKey": {
+                "UserName": UserName,
+                "AccessKeyId": key["AccessKeyId"],
+                "SecretAccessKey": "secret/" + key["AccessKeyId"].lower(),
+            }
+        }
+
+    def delete_access_key(self, UserName, AccessKeyId):
+        self.aws.api_call("iam", "DeleteAccessKey")
+        with self.aws._lock:
+            user = self._user(UserName, "DeleteAccessKey")
+            keys = [k for k in user["keys"] if k["AccessKeyId"] != AccessKeyId]
+            if len(keys) == len(user["keys"]):
+                raise client_error(
+                    "NoSuchEntity",
+                    f"The Access Key with id {AccessKeyId} cannot be found.",
+                    "DeleteAccessKey",
+                )
+            user["keys"] = keys
+        return {}
+
+    def list_account_aliases(self):
+        self.aws.api_call("iam", "ListAccountAliases")
+        return {"AccountAliases": ["benchmark"]}
+
+    def generate_credential_report(self):
+        self.aws.api_call("iam", "GenerateCredentialReport")
+        return {"State": "COMPLETE"}
+
+    def get_credential_report(self):
+        self.aws.api_call("iam", "GetCredentialReport")
+        out = io.StringIO()
+        writer = csv.writer(out)
+        writer.writerow(
+            [
+                "user",
+                "arn",
+                "access_key_1_active",
+                "access_key_1_last_rotated",
+                "access_key_2_active",
+                "access_key_2_last_rotated",
+            ]
+        )
+        writer.writerow(["<root_account>", "", "false", "N/A", "false", "N/A"])
+        for name, user in sorted(self.aws.users.items()):
+            row = [name, f"arn:aws:iam::000000000000:user/{name}"]
+            for i in range(2):
+                if i < len(user["keys"]):
+                    created = user["keys"][i]["CreateDate"]
+                    row.extend(["true", created.isoformat().replace("+00:00", "Z")])
+                else:
+                    row.extend(["false", "N/A"])
+            writer.writerow(row)
+
+        return {
+            "Content": out.getvalue().encode("utf-8"),
+            "GeneratedTime": self.aws.now,
+        }
+
+
+class FakeDynamoDB:
+    # Key attributes of the tables used by the functions
+    KEY_SCHEMA = {"user": ("user", "ak"), "state": ("pk", "sk")}
+
+    def __init__(self, aws):
+        self.aws = aws
+
+    def _table(self, table_name):
+        return self.aws.tables.setdefault(table_name, {})
+
+    def _key(self, item):
+        attrs = self.KEY_SCHEMA["state"] if "pk" in item else self.KEY_SCHEMA["user"]
+        return tuple(item[a]["S"] for a in attrs)
+
+    def put_item(self, TableName, Item):
+        self.aws.api_call("dynamodb", "PutItem")
+        with self.aws._lock:
+            self._table(TableName)[self._key(Item)] = Item
+        return {}
+
+    def get_item(self, TableName, Key, ConsistentRead=False):
+        self.aws.api_call("dynamodb", "GetItem")
+        item = self._table(TableName).get(self._key(Key))
+        return {} if item is None else {"Item": item}
+
+    def delete_item(self, TableName, Key):
+        self.aws.api_call("dynamodb", "DeleteItem")
+        with self.aws._lock:
+            self._table(TableName).pop(self._key(Key), None)
+        return {}
+
+    def update_item(self, TableName, Key, UpdateExpression, ExpressionAttributeValues):
+        self.aws.api_call("dynamodb", "UpdateItem")
+        with self.aws._lock:
+            item = self._table(TableName).setdefault(self._key(Key), dict(Key))
+            for action, clause in re.findall(
+                r"(SET|ADD) (.*?)(?= SET | ADD |$)", UpdateExpression
+            ):
+                for part in clause.split(","):
+                    name, value = re.split(r"\s*=\s*|\s+", part.strip())
+                    value = ExpressionAttributeValues[value]
+                    if action == "ADD" and name in item:
+                        total = int(item[name]["N"]) + int(value["N"])
+                        item[name] = {"N": str(total)}
+                    else:
+                        item[name] = value
+        return {}
+
+    def batch_write_item(self, RequestItems):
+        self.aws.api_call("dynamodb", "BatchWriteItem")
+        with self.aws._lock:
+            for table_name, requests in RequestItems.items():
+                for request in requests:
+                    item = request["PutRequest"]["Item"]
+                    self._table(table_name)[self._key(item)] = item
+        return {"UnprocessedItems": {}}
+
+    def get_paginator(self, operation):
+        if operation == "query":
+            return FakePaginator(self.aws, "dynamodb", "Query", self._query_pages)
+        if operation != "scan":
+            raise NotImplementedError(operation)
+        return FakePaginator(self.aws, "dynamodb", "Scan", self._scan_pages)
+
+    def _query_pages(self, TableName, KeyConditionExpression, **kwargs):
+        # Only "hash = :value" and "hash = :value AND range <= :value" conditions are supported
+        hash_attr, hash_value, range_attr, range_value = re.match(
+            r"(\w+) = (:\w+)(?: AND (\w+) <= (:\w+))?", KeyConditionExpression
+        ).groups()
+        values = kwargs["ExpressionAttributeValues"]
+        items = [
+            i
+            for i in self._table(TableName).values()
+            if i.get(hash_attr) == values[hash_value]
+            and (
+                range_attr is None
+                or (
+                    range_attr in i
+                    and int(i[range_attr]["N"]) <= int(values[range_value]["N"])
+                )
+            )
+        ]
+
+        page_size = PAGE_SIZE * 10
+        for i in range(0, max(1, len(items)), page_size):
+            yield {"Items": items[i : i + page_size]}
+
+    def _scan_pages(self, TableName, FilterExpression=None, **kwargs):
+        items = list(self._table(TableName).values())
+        if FilterExpression is not None:
+            attr, value = re.match(
+                r"begins_with\((\w+), (:\w+)\)", FilterExpression
+            ).groups()
+            prefix = kwargs["ExpressionAttributeValues"][value]["S"]
+            items = [i for i in items if i[attr]["S"].startswith(prefix)]
+
+        page_size = PAGE_SIZE * 10
+        for i in range(0, max(1, len(items)), page_size):
+            yield {"Items": items[i : i + page_size]}
+
+
+class FakeSSM:
+    def __init__(self, aws):
+        self.aws = aws
+
+    def put_parameter(self, Name, Value, **kwargs):
+        self.aws.api_call("ssm", "PutParameter")
+        with self.aws._lock:
+            self.aws.parameters[Name] = Value
+        return {"Version": 1}
+
+    def get_parameter(self, Name, WithDecryption=False):
+        self.aws.api_call("ssm", "GetParameter")
+        return {"Parameter": {"Name": Name, "Value": self.aws.parameters.get(Name, "")}}
+
+    def delete_parameters(self, Names):
+        self.aws.api_call("ssm", "DeleteParameters")
+        with self.aws._lock:
+            deleted = [n for n in Names if self.aws.parameters.pop(n, None) is not None]
+        return {
+            "DeletedParameters": deleted,
+            "InvalidParameters": [n for n in Names if n not in deleted],
+        }
+
+
+class FakeKMS:
+    def __init__(self, aws):
+        self.aws = aws
+
+    def generate_data_key(self, KeyId, KeySpec, EncryptionContext=None):
+        self.aws.api_call("kms", "GenerateDataKey")
+        plaintext = bytes(random.getrandbits(8) for _ in range(32))
+        return {"Plaintext": plaintext, "CiphertextBlob": b"encrypted:" + plaintext}
+
+
+class FakeSES:
+    def __init__(self, aws):
+        self.aws = aws
+
+    def get_send_quota(self):
+        self.aws.api_call("ses", "GetSendQuota")
+        return {"MaxSendRate": 1000.0, "Max24HourSend": 1000000.0}
+
+    def send_email(self, **kwargs):
+        self.aws.api_call("ses", "SendEmail")
+        return {"MessageId": "benchmark"}
+
+    def create_template(self, Template):
+        self.aws.api_call("ses", "CreateTemplate")
+        return {}
+
+    def update_template(self, Template):
+        self.aws.api_call("ses", "UpdateTemplate")
+        return {}
+
+    def send_bulk_templated_email(self, Destinations, **kwargs):
+        self.aws.api_call("ses", "SendBulkTemplatedEmail")
+        return {"Status": [{"Status": "Success"} for _ in Destinations]}
+
+
+class FakeLambda:
+    def __init__(self, aws):
+        self.aws = aws
+
+    def invoke(self, FunctionName, InvocationType, Payload):
+        self.aws.api_call("lambda", "Invoke")
+        with self.aws._lock:
+            self.aws.invocations.append(Payload)
+        return {"StatusCode": 202}
@@ -0,0 +1,304 @@
+"""
+Benchmark creator and destructor functions against an in-memory AWS account.
+
+Each account size is run in a separate process so that module level state and
+memory usage of one run do not leak into the next one. Function settings are
+read from the environment the same way as in lambda, e.g.
+
+    INVENTORY_MODE=per_user FAN_OUT=true python benchmark/run.py --sizes 1000,10000
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import logging
+import argparse
+import tracemalloc
+import multiprocessing
+import concurrent.futures
+from datetime import datetime, timezone
+
+import fake_aws
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+
+# Environment used by the functions unless already set
+DEFAULT_ENV = {
+    "AWS_REGION": "us-east-1",
+    "AWS_ACCESS_KEY_ID": "benchmark",
+    "AWS_SECRET_ACCESS_KEY": "benchmark",
+    "ACCOUNT_ID": "000000000000",
+    "IAM_KEY_ROTATOR_TABLE": "iam-key-rotator",
+    "IAM_KEY_ROTATOR_STATE_TABLE": "iam-key-rotator-state",
+    "MAIL_CLIENT": "ses",
+    "MAIL_FROM": "security@example.com",
+    "ENCRYPT_KEY_PAIR": "false",
+    "SELF_INVOKE": "true",
+    "METRICS_ENABLED": "false",
+}
+
+# Time at which every run starts so that key ages and expiry times are the same in each run
+RUN_STARTED_AT = datetime(2024, 1, 15, 12, 0, tzinfo=timezone.utc)
+
+# No. of records delivered to the destructor in a single stream batch
+STREAM_BATCH_SIZE = 100
+
+# Maximum no. of invocations run for a single creator run, including self invocations and shards
+MAX_INVOCATIONS = 200
+
+
+class FakeContext:
+    """
+    Lambda context which runs out of time timeout_secs after it is created
+    """
+
+    def __init__(self, timeout_secs, request_id):
+        self.function_name = "iam-key-creator"
+        self.aws_request_id = request_id
+        self.deadline = time.monotonic() + timeout_secs
+
+    def get_remaining_time_in_millis(self):
+        return max(0, int((self.deadline - time.monotonic()) * 1000))
+
+
+def build_account(aws, size, seed):
+    """
+    Add users with a mix of tags and key ages to the fake account
+    """
+    rnd = random.Random(seed)
+    for i in range(size):
+        tags = [{"Key": "team", "Value": f"team-{i % 20}"}]
+        if rnd.random() < 0.85:
+            tags.append({"Key": "IKR:EMAIL", "Value": f"user{i}@example.com"})
+            if rnd.random() < 0.3:
+                tags.append(
+                    {"Key": "IKR:ROTATE_AFTER_DAYS", "Value": str(rnd.randint(30, 120))}
+                )
+            if rnd.random() < 0.2:
+                tags.append(
+                    {"Key": "IKR:DELETE_AFTER_DAYS", "Value": str(rnd.randint(1, 10))}
+                )
+            for n in range(rnd.choice([0, 0, 0, 1, 2])):
+                tags.append(
+                    {"Key": f"IKR:INSTRUCTION_{n}", "Value": f"Update profile {n}"}
+                )
+
+        key_count = rnd.choices([0, 1, 2], weights=[10, 75, 15])[0]
+        aws.add_user(
+            f"user-{i:06d}", tags, [rnd.randint(0, 200) for _ in range(key_count)]
+        )
+
+
+def patch_clients(clients):
+    """
+    Replace AWS clients handed out to the function modules with the fake ones
+    """
+    import shared_functions
+
+    for service, client in clients.items():
+        shared_functions.set_client(service, client)
+
+
+def measure(aws, func):
+    """
+    Run func and return its result along with the measurements of the run
+    """
+    aws.reset_counters()
+    tracemalloc.start()
+    started_at = time.perf_counter()
+    result = func()
+    wall_secs = time.perf_counter() - started_at
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return result, {
+        "wall_secs": round(wall_secs, 3),
+        "peak_mib": round(peak / (1024 * 1024), 1),
+        "calls": aws.calls_per_service(),
+        "throttles": dict(aws.throttles),
+    }
+
+
+def run_creator(aws, timeout_secs):
+    """
+    Run creator function along with all the invocations it makes for the
+    remaining users or shards. Returns time taken by each invocation
+    """
+    import creator
+
+    durations = []
+    events = [{}]
+    while len(events) > 0 and len(durations) < MAX_INVOCATIONS:
+        event = events.pop(0)
+        context = FakeContext(timeout_secs, f"run-{len(durations)}")
+        started_at = time.perf_counter()
+        creator.handler(event, context)
+        durations.append(time.perf_counter() - started_at)
+
+        events.extend(json.loads(payload) for payload in aws.invocations)
+        aws.invocations.clear()
+
+    return durations
+
+
+def run_destructor(aws, table_name):
+    """
+    Deliver all the deletion records to the destructor function in stream batches.
+    Returns no. of records and no. of batch item failures
+    """
+    import destructor
+
+    items = list(aws.tables.get(table_name, {}).values())
+    failures = 0
+    for i in range(0, len(items), STREAM_BATCH_SIZE):
+        records = [
+            {
+                "eventName": "REMOVE",
+                "dynamodb": {"SequenceNumber": str(i + n), "OldImage": item},
+            }
+            for n, item in enumerate(items[i : i + STREAM_BATCH_SIZE])
+        ]
+        resp = destructor.handler({"Records": records}, None)
+        failures += len(resp["batchItemFailures"])
+
+    return len(items), failures
+
+
+def run_size(size, options):
+    """
+    Benchmark both functions for an account of the given size
+    """
+    for name, value in DEFAULT_ENV.items():
+        os.environ.setdefault(name, value)
+    sys.path.insert(0, SRC_DIR)
+
+    handler = logging.StreamHandler()
+    handler.setLevel(options["log_level"])
+    logging.getLogger().addHandler(handler)
+
+    import shared_functions
+
+    aws = fake_aws.FakeAWS(
+        options["latency_ms"],
+        options["rate_limit"],
+        options["throttle_prob"],
+        options["seed"],
+        RUN_STARTED_AT,
+    )
+    build_account(aws, size, options["seed"])
+    patch_clients(aws.clients())
+    shared_functions.set_clock_time(RUN_STARTED_AT)
+
+    durations, creator_stats = measure(
+        aws, lambda: run_creator(aws, options["timeout_secs"])
+    )
+    creator_stats.update(
+        {
+            "invocations": len(durations),
+            "max_invocation_secs": round(max(durations), 3),
+            "client_retries": shared_functions.iam_concurrency.retries,
+        }
+    )
+
+    (records, failures), destructor_stats = measure(
+        aws, lambda: run_destructor(aws, os.environ["IAM_KEY_ROTATOR_TABLE"])
+    )
+    destructor_stats.update({"records": records, "batch_item_failures": failures})
+
+    return {"size": size, "creator": creator_stats, "destructor": destructor_stats}
+
+
+def parse_per_service(values, cast):
+    """
+    Parse SERVICE=VALUE options. A value without service name applies to all services
+    """
+    settings = {}
+    for value in values or []:
+        service, _, setting = value.rpartition("=")
+        settings[service or "*"] = cast(setting)
+    return settings
+
+
+def format_counts(counts):
+    return " ".join(f"{k}={v}" for k, v in sorted(counts.items())) or "-"
+
+
+def print_report(results):
+    header = f"{'users':>7} {'phase':<10} {'invocations':>11} {'wall_s':>8} {'max_inv_s':>9} {'peak_mib':>8}  calls / throttles"
+    print(header)
+    print("-" * len(header))
+    for result in results:
+        for phase in ["creator", "destructor"]:
+            stats = result[phase]
+            invocations = stats.get("invocations", "-")
+            max_invocation = stats.get("max_invocation_secs", "-")
+            print(
+                f"{result['size']:>7} {phase:<10} {invocations:>11} {stats['wall_secs']:>8} {max_invocation:>9} {stats['peak_mib']:>8}  {format_counts(stats['calls'])} / {format_counts(stats['throttles'])}"
+            )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument(
+        "--sizes",
+        default="100,1000,10000,50000",
+        help="Comma separated no. of users in the account",
+    )
+    parser.add_argument(
+        "--latency-ms",
+        action="append",
+        help="Latency of each API call as [SERVICE=]MS, e.g. iam=40",
+    )
+    parser.add_argument(
+        "--rate-limit",
+        action="append",
+        help="Calls per second allowed before calls are throttled as [SERVICE=]RATE, e.g. iam=20",
+    )
+    parser.add_argument(
+        "--throttle-prob",
+        action="append",
+        help="Probability of a call being throttled as [SERVICE=]PROB, e.g. ssm=0.05",
+    )
+    parser.add_argument(
+        "--timeout-secs",
+        type=float,
+        default=900,
+        help="Timeout of each function invocation",
+    )
+    parser.add_argument("--seed", type=int, default=7, help="Seed for synthetic users")
+    parser.add_argument(
+        "--log-level", default="ERROR", help="Level of function logs to print"
+    )
+    parser.add_argument(
+        "--json", action="store_true", help="Print results as JSON lines"
+    )
+    args = parser.parse_args()
+
+    options = {
+        "latency_ms": parse_per_service(args.latency_ms, float),
+        "rate_limit": parse_per_service(args.rate_limit, float),
+        "throttle_prob": parse_per_service(args.throttle_prob, float),
+        "timeout_secs": args.timeout_secs,
+        "seed": args.seed,
+        "log_level": args.log_level.upper(),
+    }
+
+    results = []
+    for size in [int(s) for s in args.sizes.split(",")]:
+        with concurrent.futures.ProcessPoolExecutor(
+            1, mp_context=multiprocessing.get_context("spawn")
+        ) as executor:
+            result = executor.submit(run_size, size, options).result()
+
+        if args.json:
+            print(json.dumps(result), flush=True)
+        results.append(result)
+
+    if not args.json:
+        print_report(results)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,12 +1,30 @@
 import os
+import base64
 
 from cryptography.fernet import Fernet
 
 ENC_KEY = os.environ.get('ENC_KEY', None)
 CIPHER_TEXT = os.environ.get('CIPHER_TEXT', None)
 
+# Encrypted data key shared in the mail when the key pair is encrypted using AWS KMS
+DATA_KEY = os.environ.get('DATA_KEY', None)
+USER_NAME = os.environ.get('USER_NAME', None)
+
+if DATA_KEY is not None:
+    import boto3
+
+    if USER_NAME is None:
+        raise KeyError('USER_NAME is required to decrypt the data key')
+
+    kms = boto3.client('kms')
+    resp = kms.decrypt(
+        CiphertextBlob=base64.b64decode(DATA_KEY),
+        EncryptionContext={'ikr:user': USER_NAME}
+    )
+    ENC_KEY = base64.urlsafe_b64encode(resp['Plaintext']).decode('utf-8')
+
 if ENC_KEY is None:
-    raise KeyError('ENC_KEY is required to decrypt the cipher text')
+    raise KeyError('ENC_KEY or DATA_KEY is required to decrypt the cipher text')
 
 if CIPHER_TEXT is None:
     raise KeyError('CIPHER_TEXT is required')
@@ -2,18 +2,28 @@
 Generates new key pair, notifies user and schedules deletion of old key pair
 """
 
+import io
 import os
+import sys
+import csv
+import time
 import logging
-import concurrent.futures
-from datetime import datetime, date
+from datetime import datetime, timezone
 
-import pytz
-import boto3
+import json
+import math
+import zlib
+import hashlib
+import threading
+import concurrent.futures
 
 from botocore.exceptions import ClientError
 
 import shared_functions
 import encryption
+import metrics
+import notification_outbox
+import user_index
 
 # Table name which holds existing access key pair details to be deleted
 IAM_KEY_ROTATOR_TABLE = os.environ.get("IAM_KEY_ROTATOR_TABLE", None)
@@ -33,134 +43,161 @@ MAIL_CLIENT = os.environ.get("MAIL_CLIENT", "ses")
 # From address to be used while sending mail
 MAIL_FROM = os.environ.get("MAIL_FROM", None)
 
-# AWS_REGION environment variable is by default available within lambda environment
-iam = boto3.client("iam", region_name=os.environ.get("AWS_REGION"))
-dynamodb = boto3.client("dynamodb", region_name=os.environ.get("AWS_REGION"))
+# Whether to send mails using SES templates and SendBulkTemplatedEmail
+SES_TEMPLATE_MODE = os.environ.get("SES_TEMPLATE_MODE", "false") == "true"
 
-logger = logging.getLogger("creator")
-logger.setLevel(logging.INFO)
+# Name of SES template used for new key pair mail
+SES_TEMPLATE_NAME = os.environ.get("SES_TEMPLATE_NAME", "ikr-new-access-key-pair")
 
+# Notification record fields which are not passed to the SES template
+NON_TEMPLATE_FIELDS = ["id", "email", "new_access_key", "encrypted"]
 
-def prepare_instruction(key_update_instructions):
-    """
-    Joins instructions in ascending order and returns a string
-    """
-    sorted_keys = sorted(key_update_instructions)
-    prepared_instruction = [key_update_instructions[k] for k in sorted_keys]
-    return " ".join(prepared_instruction)
+# How to fetch users and their tags. bulk: GetAccountAuthorizationDetails, per_user: ListUsers + ListUserTags per user
+INVENTORY_MODE = os.environ.get("INVENTORY_MODE", "bulk")
 
+# Where to read access key age from. report: IAM credential report, api: ListAccessKeys per user
+KEY_AGE_SOURCE = os.environ.get("KEY_AGE_SOURCE", "report")
 
-def fetch_users_with_email(user):
-    """
-    Checks if email is present as a tag and returns username and other tags if present
-    """
-    logger.info("Fetching tags for %s", user)
-    resp = iam.list_user_tags(UserName=user)
+# Max no. of seconds to wait for IAM to generate the credential report
+CREDENTIAL_REPORT_WAIT_SECS = int(os.environ.get("CREDENTIAL_REPORT_WAIT_SECS", 30))
 
-    user_attributes = {}
-    key_update_instructions = {}
-    for t in resp["Tags"]:
-        if t["Key"].lower().startswith("ikr:instruction_"):
-            key_update_instructions[int(t["Key"].split("_")[1])] = t["Value"]
-        elif t["Key"].lower().startswith("ikr:"):
-            user_attributes[t["Key"].split(":")[1].lower()] = t["Value"]
+# Share of the remaining run time which can be spent waiting for the credential report.
+# Rest of the time is kept for fetching keys per user and rotating them
+CREDENTIAL_REPORT_WAIT_SHARE = float(
+    os.environ.get("CREDENTIAL_REPORT_WAIT_SHARE", 0.25)
+)
 
-    if len(key_update_instructions) > 0:
-        user_attributes["instruction"] = prepare_instruction(key_update_instructions)
-    else:
-        user_attributes["instruction"] = ""
+# No. of seconds between checks of the credential report state
+CREDENTIAL_REPORT_POLL_SECS = 2
 
-    if "email" in user_attributes:
-        return True, user, user_attributes
+# Credential report older than these many hours is considered stale and is not used
+CREDENTIAL_REPORT_MAX_AGE_HOURS = int(
+    os.environ.get("CREDENTIAL_REPORT_MAX_AGE_HOURS", 4)
+)
 
-    return False, user, None
+# Table name which holds run checkpoints so that an unfinished run is resumed
+IAM_KEY_ROTATOR_STATE_TABLE = os.environ.get("IAM_KEY_ROTATOR_STATE_TABLE", None)
 
+# No new user is picked up once the remaining run time falls below these many seconds
+STOP_WHEN_REMAINING_SECS = int(os.environ.get("STOP_WHEN_REMAINING_SECS", 5))
 
-def fetch_user_keys(user):
-    """
-    Fetch existing access key and age of the key associated with an IAM user
-    """
-    logger.info("Fetching keys for %s", user)
-    resp = iam.list_access_keys(UserName=user)
+# No. of seconds between checks of the encryption and mail backlog while key creation waits for it
+DRAIN_POLL_SECS = 0.1
 
-    user_keys = []
-    for obj in resp["AccessKeyMetadata"]:
-        user_keys.append(
-            {
-                "ak": obj["AccessKeyId"],
-                "ak_age_days": (datetime.now(pytz.UTC) - obj["CreateDate"]).days,
-            }
-        )
+# No. of seconds kept for saving deletion records, unsent mails and checkpoints
+# when mails being sent hold up the end of the run
+SAVE_STATE_SECS = 1.5
 
-    return user, user_keys
+# Whether to invoke the function again asynchronously when the run is stopped early
+SELF_INVOKE = os.environ.get("SELF_INVOKE", "false") == "true"
 
+# Maximum no. of times a run re-invokes itself before leaving the rest for the next scheduled run
+MAX_SELF_INVOCATIONS = int(os.environ.get("MAX_SELF_INVOCATIONS", 20))
 
-def fetch_user_details():
-    """
-    Fetch list of users whose keys needs to be rotated periodically
-    """
-    users = {}
-    try:
-        params = {}
-        logger.info("Fetching all users")
-        while True:
-            resp = iam.list_users(**params)
+# Whether to split users into shards which are processed by parallel invocations
+FAN_OUT = os.environ.get("FAN_OUT", "false") == "true"
 
-            for u in resp["Users"]:
-                users[u["UserName"]] = {}
+# No. of users a single shard is expected to process
+USERS_PER_SHARD = int(os.environ.get("USERS_PER_SHARD", 1000))
 
-            try:
-                params["Marker"] = resp["Marker"]
-            except Exception:
-                break
+# Maximum no. of shards a run is split into
+MAX_SHARDS = int(os.environ.get("MAX_SHARDS", 16))
 
-        logging.info("User count: %s", len(users))
+# Maximum size of the user inventory passed to a shard in its invoke payload.
+# Asynchronous invoke payloads are limited to 256 KB, larger inventories are
+# stored in the state table
+SHARD_PAYLOAD_MAX_BYTES = 200_000
 
-        logger.info("Fetching tags for users individually")
-        with concurrent.futures.ThreadPoolExecutor(10) as executor:
-            results = [executor.submit(fetch_users_with_email, user) for user in users]
+# Maximum size of the compressed user inventory stored in the state table for
+# a shard. DynamoDB items are limited to 400 KB
+SHARD_ITEM_MAX_BYTES = 380_000
 
-        for f in concurrent.futures.as_completed(results):
-            has_email, user_name, user_attributes = f.result()
-            if not has_email:
-                users.pop(user_name)
-            else:
-                users[user_name]["attributes"] = user_attributes
-        logger.info("User(s) with email tag: %s", [user for user in users])
+# Minimum no. of parallel IAM calls left for each shard out of IAM_MAX_WORKERS
+MIN_IAM_WORKERS_PER_SHARD = int(os.environ.get("MIN_IAM_WORKERS_PER_SHARD", 4))
 
-        logger.info("Fetching keys for users individually")
-        with concurrent.futures.ThreadPoolExecutor(10) as executor:
-            results = [executor.submit(fetch_user_keys, user) for user in users]
+# Whether to check only the users which are new, changed or due for rotation using the user index
+INCREMENTAL = os.environ.get("INCREMENTAL", "false") == "true"
 
-        for f in concurrent.futures.as_completed(results):
-            user_name, keys = f.result()
-            users[user_name]["keys"] = keys
-    except ClientError as ce:
-        logger.error(ce)
+# IAM API calls which change tags or keys of a user and are delivered as EventBridge events
+USER_CHANGE_EVENTS = [
+    "CreateUser",
+    "DeleteUser",
+    "TagUser",
+    "UntagUser",
+    "CreateAccessKey",
+    "DeleteAccessKey",
+]
 
-    return users
+# No. of days after which run results and checkpoints are removed from the state table
+STATE_EXPIRY_DAYS = int(os.environ.get("STATE_EXPIRY_DAYS", 7))
 
+# Pending deletion records are written right away once the remaining run time falls below these many seconds
+FLUSH_WHEN_REMAINING_SECS = int(os.environ.get("FLUSH_WHEN_REMAINING_SECS", 3))
 
-def send_email(
-    email,
-    user_name,
-    access_key,
-    secret_key,
-    instruction,
-    existing_access_key,
-    existing_key_delete_age,
-):
-    """
-    Send new key pair to the user
-    """
-    try:
-        # fetch aws account info
-        account_id = shared_functions.fetch_account_info()["id"]
-        account_name = shared_functions.fetch_account_info()["name"]
+# Pending deletion records are written at least every these many seconds, even if the batch is not full
+DELETION_FLUSH_SECS = float(os.environ.get("DELETION_FLUSH_SECS", 2))
 
-        mail_subject = "New Access Key Pair"
+# Maximum no. of keys rotated by a run, the most overdue keys first. 0 rotates all the due keys
+MAX_ROTATIONS_PER_RUN = int(os.environ.get("MAX_ROTATIONS_PER_RUN", 0))
 
-        mail_body_plain = f"""Hey {user_name},\n\n
+# No. of days over which rotation of keys which become due on the same day is spread when MAX_ROTATIONS_PER_RUN
+# leaves due keys for later runs. Keys under the cap are always rotated as soon as they are due
+ROTATION_SPREAD_DAYS = int(os.environ.get("ROTATION_SPREAD_DAYS", 0))
+
+# Accounts whose keys are rotated by assuming ORGANIZATION_ROLE_NAME in each one. Comma separated account ids,
+# or "organization" for all the active accounts of the AWS organization. Empty rotates keys of the account of the function
+TARGET_ACCOUNTS = os.environ.get("TARGET_ACCOUNTS", "")
+
+# Maximum no. of target accounts processed in parallel in organization mode
+ACCOUNT_MAX_WORKERS = int(os.environ.get("ACCOUNT_MAX_WORKERS", 4))
+
+# Name of the function under which metrics are published, available within lambda environment
+FUNCTION_NAME = os.environ.get("AWS_LAMBDA_FUNCTION_NAME", "iam-key-creator")
+
+# Latency assumed by plan mode for API calls whose latency was not observed while planning
+PLAN_DEFAULT_CALL_MS = 100
+
+# Reasons for which a user with email tag is skipped
+SKIP_NO_KEY = "no_key"
+SKIP_TWO_KEYS = "two_keys"
+SKIP_NOT_DUE = "not_due"
+SKIP_NO_EMAIL = "no_email"
+SKIP_SPREAD = "spread"
+SKIP_RUN_LIMIT = "run_limit"
+
+# Name of the API call used to send a single mail by each mail client
+MAIL_API_CALLS = {
+    "ses": "ses:SendEmail",
+    "smtp": "smtp:SendMail",
+    "mailgun": "mailgun:SendMessage",
+}
+
+# Outbox used to send mails in background, created for every invocation
+outbox = None
+
+# Mails of encrypted key pairs which could not be sent, saved for the next run
+unsent_notifications = []
+unsent_notifications_lock = threading.Lock()
+
+# Batch writer for pending deletion records, created for every invocation
+deletion_writer = None
+
+# Lambda context of the current invocation
+run_context = None
+
+# Engine which encrypts new key pairs in background, created for every invocation
+encryption_engine = None
+
+# Account id and name of the users whose new key pair was deleted because it could not be encrypted
+rolled_back = set()
+rolled_back_lock = threading.Lock()
+
+logger = logging.getLogger("creator")
+logger.setLevel(logging.INFO)
+
+MAIL_SUBJECT = "New Access Key Pair"
+
+MAIL_BODY_PLAIN = """Hey {user_name},\n\n
         A new access key pair has been generated for you. Please update the same wherever necessary.\n\n
         Account: {account_id} ({account_name})\n
         Access Key: {access_key}\n
@@ -170,7 +207,7 @@ def send_email(
         Thanks,\n
         Your Security Team"""
 
-        mail_body_html = f"""
+MAIL_BODY_HTML = """
         <!DOCTYPE html>
         <html style="font-family: "Helvetica Neue", Helvetica, Arial, sans-serif;
                           box-sizing: border-box; font-size: 14px; margin: 0;">
@@ -180,13 +217,13 @@ def send_email(
                 <title>{mail_subject}</title>
 
                 <style type="text/css">
-                    body {{{{
+                    body {{
                         -webkit-font-smoothing: antialiased;
                         -webkit-text-size-adjust: none;
                         width: 100% !important;
                         height: 100%;
                         line-height: 1.6em;
-                    }}}}
+                    }}
                 </style>
             </head>
             <body>
@@ -211,177 +248,1981 @@ def send_email(
             </body>
         </html>"""
 
-        logger.info("Using %s as mail client", MAIL_CLIENT)
 
-        if MAIL_CLIENT == "smtp":
-            import smtp_mailer
+def prepare_instruction(key_update_instructions):
+    """
+    Joins instructions in ascending order and returns a string
+    """
+    sorted_keys = sorted(key_update_instructions)
+    prepared_instruction = [key_update_instructions[k] for k in sorted_keys]
+    return " ".join(prepared_instruction)
 
-            smtp_mailer.send_email(
-                email,
-                user_name,
-                mail_subject,
-                MAIL_FROM,
-                mail_body_plain,
-                mail_body_html,
-            )
-        elif MAIL_CLIENT == "ses":
-            import ses_mailer
 
-            ses_mailer.send_email(
-                email,
-                user_name,
-                mail_subject,
-                MAIL_FROM,
-                mail_body_plain,
-                mail_body_html,
-            )
-        elif MAIL_CLIENT == "mailgun":
-            import mailgun_mailer
+def parse_user_tags(tags):
+    """
+    Extracts ikr tags and returns user attributes if email tag is present
+    """
+    user_attributes = {}
+    key_update_instructions = {}
+    for t in tags:
+        if t["Key"].lower().startswith("ikr:instruction_"):
+            key_update_instructions[int(t["Key"].split("_")[1])] = t["Value"]
+        elif t["Key"].lower().startswith("ikr:"):
+            user_attributes[t["Key"].split(":")[1].lower()] = t["Value"]
 
-            mailgun_mailer.send_email(
-                email,
-                user_name,
-                mail_subject,
-                MAIL_FROM,
-                mail_body_plain,
-                mail_body_html,
-            )
-        else:
-            logger.error(
-                "%s: Invalid mail client",
-                MAIL_CLIENT,
-            )
-    except (Exception, ClientError) as ce:
-        logger.error(
-            "Failed to send mail to user %s (%s). Reason: %s", user_name, email, ce
-        )
+    if len(key_update_instructions) > 0:
+        user_attributes["instruction"] = prepare_instruction(key_update_instructions)
+    else:
+        user_attributes["instruction"] = ""
 
+    if "email" in user_attributes:
+        return user_attributes
 
-def mark_key_for_destroy(user_name, ak, existing_key_delete_age, email):
+    return None
+
+
+def fetch_users_with_email(user):
     """
-    Add key in DynamoDB to delete it after few days
+    Checks if email is present as a tag and returns username and other tags if present
     """
-    try:
-        today = date.today()
-        dynamodb.put_item(
-            TableName=IAM_KEY_ROTATOR_TABLE,
-            Item={
-                "user": {"S": user_name},
-                "ak": {"S": ak},
-                "email": {"S": email},
-                "delete_on": {
-                    "N": str(
-                        round(
-                            datetime(
-                                today.year, today.month, today.day, tzinfo=pytz.utc
-                            ).timestamp()
-                        )
-                        + (existing_key_delete_age * 24 * 60 * 60)
-                    )
-                },
-                "delete_enc_key": {"S": "Y" if ENCRYPT_KEY_PAIR else "N"},
-            },
+    logger.info("Fetching tags for %s", user)
+    resp = shared_functions.get_iam_concurrency().call(
+        shared_functions.get_client("iam").list_user_tags, UserName=user
+    )
+
+    user_attributes = parse_user_tags(resp["Tags"])
+    if user_attributes is not None:
+        return True, user, user_attributes
+
+    return False, user, None
+
+
+def fetch_user_keys(user):
+    """
+    Fetch existing access key and age of the key associated with an IAM user
+    """
+    logger.info("Fetching keys for %s", user)
+    resp = shared_functions.get_iam_concurrency().call(
+        shared_functions.get_client("iam").list_access_keys, UserName=user
+    )
+
+    clock = shared_functions.run_clock()
+    user_keys = []
+    for obj in resp["AccessKeyMetadata"]:
+        user_keys.append(
+            {"ak": obj["AccessKeyId"], "ak_age_days": clock.age_days(obj["CreateDate"])}
         )
-        logger.info("Key %s marked for deletion", ak)
-    except (Exception, ClientError) as ce:
-        logger.error("Failed to mark key %s for deletion. Reason: %s", ak, ce)
 
+    return user, user_keys
 
-def create_user_key(user_name, user):
+
+@metrics.timed("list")
+def fetch_users_bulk():
     """
-    Generate new key pair for the IAM user if required
+    Fetch all users along with their tags using GetAccountAuthorizationDetails
+    """
+    users = {}
+    logger.info("Fetching all users with tags in bulk")
+    paginator = shared_functions.get_client("iam").get_paginator(
+        "get_account_authorization_details"
+    )
+    for page in paginator.paginate(Filter=["User"]):
+        for u in page["UserDetailList"]:
+            users[u["UserName"]] = parse_user_tags(u.get("Tags", []))
+
+    logger.info("User count: %s", len(users))
+    return users
+
+
+def credential_report_wait_secs():
+    """
+    Return no. of seconds the run can wait for the credential report. Waiting is
+    limited to a share of the remaining run time so that the per user fallback
+    and the rotations still fit in the invocation
+    """
+    secs = remaining_secs()
+    if secs is None:
+        return CREDENTIAL_REPORT_WAIT_SECS
+    return min(
+        CREDENTIAL_REPORT_WAIT_SECS,
+        max(0, secs - STOP_WHEN_REMAINING_SECS) * CREDENTIAL_REPORT_WAIT_SHARE,
+    )
+
+
+def fetch_credential_report():
+    """
+    Generate IAM credential report and return its content along with generation time.
+    Returns None if the report is not available
     """
     try:
-        if len(user["keys"]) == 0:
-            logger.info(
-                "Skipping key creation for %s because no existing key found", user_name
-            )
-        elif len(user["keys"]) == 2:
-            logger.warning(
-                "Skipping key creation for %s because 2 keys already exist. Please delete anyone to create new key",
-                user_name,
-            )
-        else:
-            for k in user["keys"]:
-                key_rotation_age = (
-                    user["attributes"]["rotate_after_days"]
-                    if "rotate_after_days" in user["attributes"]
-                    else ROTATE_AFTER_DAYS
+        logger.info("Fetching credential report")
+        max_wait_secs = credential_report_wait_secs()
+        waited = 0
+        while True:
+            state = shared_functions.get_client("iam").generate_credential_report()[
+                "State"
+            ]
+            if state == "COMPLETE":
+                break
+            if waited + CREDENTIAL_REPORT_POLL_SECS > max_wait_secs:
+                logger.warning(
+                    "Credential report not ready after %s seconds. Current state: %s",
+                    waited,
+                    state,
                 )
-                if k["ak_age_days"] <= int(key_rotation_age):
-                    logger.info(
-                        "Skipping key creation for %s because existing key is only %s day(s) old and the rotation is set for %s days",
-                        user_name,
-                        k["ak_age_days"],
-                        key_rotation_age,
-                    )
-                else:
-                    logger.info("Creating new access key for %s", user_name)
-                    resp = iam.create_access_key(UserName=user_name)
-                    logger.info("New key pair generated for user %s", user_name)
-
-                    # Email keys to user
-                    existing_key_delete_age = (
-                        user["attributes"]["delete_after_days"]
-                        if "delete_after_days" in user["attributes"]
-                        else DELETE_AFTER_DAYS
-                    )
+                return None
+            time.sleep(CREDENTIAL_REPORT_POLL_SECS)
+            waited += CREDENTIAL_REPORT_POLL_SECS
 
-                    if ENCRYPT_KEY_PAIR:
-                        user_access_key, user_secret_access_key = encryption.encrypt(
-                            user_name,
-                            resp["AccessKey"]["AccessKeyId"],
-                            resp["AccessKey"]["SecretAccessKey"],
-                        )
-                        user_instruction = f'{user["attributes"]["instruction"]} (The above key pair is encrypted so you need to decrypt it using the encryption key stored in SSM parameter /ikr/secret/iam/{user_name} before using the key pair. You can use the *decryption.py* file present in the *skildops/aws-iam-key-rotator* repo)'
-                    else:
-                        user_access_key = resp["AccessKey"]["AccessKeyId"]
-                        user_secret_access_key = resp["AccessKey"]["SecretAccessKey"]
-                        user_instruction = user["attributes"]["instruction"]
-
-                    send_email(
-                        user["attributes"]["email"],
-                        user_name,
-                        user_access_key,
-                        user_secret_access_key,
-                        user_instruction,
-                        user["keys"][0]["ak"],
-                        int(existing_key_delete_age),
-                    )
+        resp = shared_functions.get_client("iam").get_credential_report()
+    except ClientError as ce:
+        logger.warning("Unable to fetch credential report. Reason: %s", ce)
+        return None
 
-                    # Mark exisiting key to destory after X days
-                    mark_key_for_destroy(
-                        user_name,
-                        user["keys"][0]["ak"],
-                        int(existing_key_delete_age),
-                        user["attributes"]["email"],
-                    )
-    except (Exception, ClientError) as ce:
-        logger.error("Failed to create new key pair. Reason: %s", ce)
+    return resp["Content"], resp["GeneratedTime"]
 
 
-def create_user_keys(users):
+def parse_credential_report(content):
     """
-    Call create_user_key in parallel using threads
+    Stream parse credential report into a compact index of user name and
+    tuple of access key age in days
     """
-    with concurrent.futures.ThreadPoolExecutor(10) as executor:
-        [executor.submit(create_user_key, user, users[user]) for user in users]
+    clock = shared_functions.run_clock()
+    rows = csv.reader(io.TextIOWrapper(io.BytesIO(content), encoding="utf-8"))
+    header = next(rows)
+    user_col = header.index("user")
+    rotated_cols = [
+        header.index("access_key_1_last_rotated"),
+        header.index("access_key_2_last_rotated"),
+    ]
 
+    key_ages = {}
+    for row in rows:
+        ages = []
+        for col in rotated_cols:
+            if row[col] != "N/A":
+                last_rotated = datetime.fromisoformat(row[col].replace("Z", "+00:00"))
+                ages.append(clock.age_days(last_rotated))
+        key_ages[row[user_col]] = tuple(ages)
 
-def handler(event, context):
+    return key_ages
+
+
+@metrics.timed("keys")
+def load_key_ages():
     """
-    Entrypoint function for lambda
+    Build user to key age index from credential report.
+    Returns None if report is missing or stale so that keys are fetched per user
     """
-    global ENCRYPT_KEY_PAIR
-    ENCRYPT_KEY_PAIR = False if ENCRYPT_KEY_PAIR == "false" else True
+    report = fetch_credential_report()
+    if report is None:
+        return None
 
-    if IAM_KEY_ROTATOR_TABLE is None:
-        logger.error(
-            "IAM_KEY_ROTATOR_TABLE is required. Current value: %s",
-            IAM_KEY_ROTATOR_TABLE,
+    content, generated_time = report
+    report_age_hours = shared_functions.run_clock().age_hours(generated_time)
+    if report_age_hours > CREDENTIAL_REPORT_MAX_AGE_HOURS:
+        logger.warning(
+            "Ignoring credential report as it is %.1f hour(s) old", report_age_hours
         )
-    elif MAIL_FROM is None:
-        logger.error("MAIL_FROM is required. Current value: %s", MAIL_FROM)
-    else:
-        users = fetch_user_details()
-        create_user_keys(users)
+        return None
+
+    key_ages = parse_credential_report(content)
+    logger.info("Credential report contains %s user(s)", len(key_ages))
+    return key_ages
+
+
+def rotate_after_days(user):
+    """
+    Return no. of days after which key of the user is rotated
+    """
+    return int(user["attributes"].get("rotate_after_days", ROTATE_AFTER_DAYS))
+
+
+def delete_after_days(user):
+    """
+    Return no. of days after rotation at which existing key of the user is deleted
+    """
+    return int(user["attributes"].get("delete_after_days", DELETE_AFTER_DAYS))
+
+
+def is_rotation_due(user, key_age_days):
+    """
+    Checks if a key of the given age needs to be rotated for the user
+    """
+    return key_age_days > rotate_after_days(user)
+
+
+def days_overdue(user):
+    """
+    Return no. of days since the only key of the user became due for rotation
+    """
+    return user["keys"][0]["ak_age_days"] - rotate_after_days(user)
+
+
+def spread_hash(user_name):
+    """
+    Return a stable hash of the user name which is independent of the shard of the user
+    """
+    return int.from_bytes(hashlib.sha1(user_name.encode("utf-8")).digest()[:4], "big")
+
+
+def rotation_delay_days(user_name):
+    """
+    Return no. of days rotation of a due key is delayed for the user when not all
+    the due keys can be rotated by a run. Users are spread evenly over
+    ROTATION_SPREAD_DAYS, so keys created on the same day are not all left for
+    the same later run
+    """
+    if ROTATION_SPREAD_DAYS <= 1:
+        return 0
+    return spread_hash(user_name) % ROTATION_SPREAD_DAYS
+
+
+def shard_of(user_name, shard_count):
+    """
+    Return the shard a user belongs to. crc32 is used so that the shard
+    stays the same across invocations
+    """
+    return zlib.crc32(user_name.encode("utf-8")) % shard_count
+
+
+def is_selected(user_name, start_from=None, shard=None):
+    """
+    Checks if user needs to be processed by this invocation.
+    Users before start_from are skipped when resuming a run and
+    only users of the given (index, count) shard are processed by a shard
+    """
+    if start_from is not None and user_name < start_from:
+        return False
+    return shard is None or shard_of(user_name, shard[1]) == shard[0]
+
+
+@metrics.timed("list")
+def list_user_names():
+    """
+    Fetch names of all the users
+    """
+    user_names = []
+    params = {}
+    logger.info("Fetching all users")
+    while True:
+        resp = shared_functions.get_iam_concurrency().call(
+            shared_functions.get_client("iam").list_users, **params
+        )
+
+        for u in resp["Users"]:
+            user_names.append(u["UserName"])
+
+        try:
+            params["Marker"] = resp["Marker"]
+        except Exception:
+            break
+
+    logger.info("User count: %s", len(user_names))
+    return user_names
+
+
+def user_call_failed(user_name, ce, action):
+    """
+    Log failure of a per user call. Returns True if the user needs to be checked
+    again by a later run, False if the user no longer exists
+    """
+    if ce.response["Error"]["Code"] == "NoSuchEntity":
+        logger.info("Skipping %s as the user no longer exists", user_name)
+        return False
+
+    logger.error("Failed to fetch %s of %s. Reason: %s", action, user_name, ce)
+    metrics.count("UsersFailed")
+    return True
+
+
+@metrics.timed("tags")
+def fetch_users_with_tags(user_names):
+    """
+    Fetch tags of the given users. Returns the users with email tag along with
+    names of the users whose tags could not be fetched, which are left for a later run
+    """
+    users = {user_name: {} for user_name in user_names}
+    failed = []
+
+    logger.info("Fetching tags for users individually")
+    results = shared_functions.get_iam_concurrency().map(fetch_users_with_email, users)
+
+    for user_name, f in zip(user_names, results):
+        try:
+            has_email, _, user_attributes = f.result()
+        except ClientError as ce:
+            users.pop(user_name)
+            if user_call_failed(user_name, ce, "tags"):
+                failed.append(user_name)
+            continue
+
+        if not has_email:
+            users.pop(user_name)
+        else:
+            users[user_name]["attributes"] = user_attributes
+
+    return users, failed
+
+
+def resolve_user_keys(users, key_ages=None):
+    """
+    Populate keys for each user using the key age source, or the given key ages
+    taken from the credential report by the coordinator of a fanned out run.
+    Per user calls are made only for the users missing from the credential report
+    or whose key needs to be rotated (credential report does not contain key id).
+    Returns names of the users whose keys could not be fetched
+    """
+    if key_ages is None and KEY_AGE_SOURCE == "report":
+        key_ages = load_key_ages()
+    if key_ages is None:
+        logger.info("Fetching keys for all users individually")
+
+    pending_users = []
+    for user_name, user in users.items():
+        ages = None if key_ages is None else key_ages.get(user_name)
+        if ages is None or (len(ages) == 1 and is_rotation_due(user, ages[0])):
+            pending_users.append(user_name)
+        else:
+            # Key id is only required when the key is rotated
+            user["keys"] = [{"ak": None, "ak_age_days": age} for age in ages]
+
+    return fetch_keys_individually(users, pending_users)
+
+
+@metrics.timed("keys")
+def fetch_keys_individually(users, user_names):
+    """
+    Populate keys of the given users using per user calls. Users whose keys
+    could not be fetched are removed and their names are returned
+    """
+    logger.info("Fetching keys for %s user(s) individually", len(user_names))
+    results = shared_functions.get_iam_concurrency().map(fetch_user_keys, user_names)
+
+    failed = []
+    for user_name, f in zip(user_names, results):
+        try:
+            users[user_name]["keys"] = f.result()[1]
+        except ClientError as ce:
+            users.pop(user_name)
+            if user_call_failed(user_name, ce, "keys"):
+                failed.append(user_name)
+
+    return failed
+
+
+def load_inventory(start_from=None, shard=None, inventory=None):
+    """
+    Fetch users with email tag along with their keys. Only users selected for
+    this invocation are returned, along with names of the selected users
+    without email tag and names of the users whose details could not be fetched.
+    A shard uses the part of the inventory passed by the coordinator, if any,
+    instead of listing all the users of the account again
+    """
+    inventory = inventory or {}
+    users = {}
+    untagged = []
+    failed = []
+    if INVENTORY_MODE == "bulk":
+        bulk_users = inventory.get("users")
+        if bulk_users is None:
+            bulk_users = fetch_users_bulk()
+        for user_name, user_attributes in bulk_users.items():
+            if not is_selected(user_name, start_from, shard):
+                continue
+            if user_attributes is None:
+                untagged.append(user_name)
+            else:
+                users[user_name] = {"attributes": user_attributes}
+    else:
+        user_names = inventory.get("user_names")
+        if user_names is None:
+            user_names = list_user_names()
+        selected = [
+            user_name
+            for user_name in user_names
+            if is_selected(user_name, start_from, shard)
+        ]
+        users, failed = fetch_users_with_tags(selected)
+        failed_set = set(failed)
+        untagged = [
+            user_name
+            for user_name in selected
+            if user_name not in users and user_name not in failed_set
+        ]
+    logger.info("User(s) with email tag: %s", [user for user in users])
+
+    failed.extend(resolve_user_keys(users, inventory.get("key_ages")))
+    if len(failed) > 0:
+        logger.warning("Details of %s user(s) could not be fetched", len(failed))
+    return users, untagged, failed
+
+
+def load_user_details(start_from=None, shard=None, inventory=None):
+    """
+    Fetch users with email tag along with their keys.
+    Only users selected for this invocation are returned
+    """
+    return load_inventory(start_from, shard, inventory)[0]
+
+
+def fetch_user_details(start_from=None, shard=None, inventory=None):
+    """
+    Fetch list of users whose keys needs to be rotated periodically.
+    Only users selected for this invocation are returned
+    """
+    users = {}
+    try:
+        users = load_user_details(start_from, shard, inventory)
+    except ClientError as ce:
+        logger.error(ce)
+
+    return users
+
+
+def fetch_changed_user_details(start_from=None, shard=None, inventory=None):
+    """
+    Fetch details of the users which need to be checked according to the user index,
+    i.e. users marked as changed and users whose key is due for rotation. New users
+    are marked as changed by their CreateUser or TagUser event. All the users are
+    fetched when a full scan is due. Returns the users along with names of all the
+    checked users, including the ones without email tag
+    """
+    if user_index.is_full_scan_due(shard_scope(shard)):
+        logger.info("Running full scan to build user index")
+        # Inventory already lists all the users, so checked users are taken from it
+        users, untagged, failed = load_inventory(start_from, shard, inventory)
+        checked = sorted([*users, *untagged])
+        if start_from is None:
+            # Entries of the users whose details could not be fetched are kept
+            listed = set(checked + failed)
+            user_index.remove(
+                [
+                    user_name
+                    for user_name in user_index.load_user_names()
+                    if is_selected(user_name, None, shard) and user_name not in listed
+                ]
+            )
+        # Full scan is complete only if all the users were checked
+        return users, checked, len(failed) == 0
+
+    checked = sorted(
+        user_name
+        for user_name in user_index.load_due(shared_functions.run_clock().epoch)
+        if is_selected(user_name, start_from, shard)
+    )
+    logger.info("%s user(s) are changed or due for rotation", len(checked))
+
+    users, failed = fetch_users_with_tags(checked)
+    failed.extend(fetch_keys_individually(users, list(users)))
+    # Index entries of the failed users are left as is, so they are checked again
+    failed = set(failed)
+    return users, [u for u in checked if u not in failed], False
+
+
+@metrics.timed("index")
+def update_user_index(users, checked, rotated, skipped):
+    """
+    Save state of the checked users in the user index
+    """
+    clock = shared_functions.run_clock()
+    rotated = set(rotated)
+    skipped = set(skipped)
+    items = []
+    for user_name in checked:
+        if user_name in skipped:
+            continue
+        user = users.get(user_name)
+        if user is None or "keys" not in user:
+            # User is checked again only when it is tagged
+            items.append(user_index.build_entry(user_name, [], None, None, clock))
+            continue
+
+        # Existing key of a rotated user is already marked for deletion
+        key_ages = (
+            [0] if user_name in rotated else [k["ak_age_days"] for k in user["keys"]]
+        )
+        items.append(
+            user_index.build_entry(
+                user_name,
+                key_ages,
+                rotate_after_days(user),
+                delete_after_days(user),
+                clock,
+            )
+        )
+
+    user_index.save(items)
+
+
+def send_email(
+    email,
+    user_name,
+    access_key,
+    secret_key,
+    instruction,
+    existing_access_key,
+    existing_key_delete_age,
+    account_info=None,
+):
+    """
+    Send new key pair to the user. Returns True if the mail was sent.
+    Info of the account of the current scope is used unless account_info is passed
+    """
+    try:
+        if account_info is None:
+            # fetch aws account info
+            account_info = shared_functions.fetch_account_info()
+        fields = {
+            "mail_subject": MAIL_SUBJECT,
+            "user_name": user_name,
+            "account_id": account_info["id"],
+            "account_name": account_info["name"],
+            "access_key": access_key,
+            "secret_key": secret_key,
+            "instruction": instruction,
+            "existing_access_key": existing_access_key,
+            "existing_key_delete_age": existing_key_delete_age,
+        }
+
+        mail_body_plain = MAIL_BODY_PLAIN.format(**fields)
+        mail_body_html = MAIL_BODY_HTML.format(**fields)
+
+        logger.info("Using %s as mail client", MAIL_CLIENT)
+
+        if MAIL_CLIENT == "smtp":
+            import smtp_mailer
+
+            return smtp_mailer.send_email(
+                email,
+                user_name,
+                MAIL_SUBJECT,
+                MAIL_FROM,
+                mail_body_plain,
+                mail_body_html,
+            )
+        elif MAIL_CLIENT == "ses":
+            import ses_mailer
+
+            return ses_mailer.send_email(
+                email,
+                user_name,
+                MAIL_SUBJECT,
+                MAIL_FROM,
+                mail_body_plain,
+                mail_body_html,
+            )
+        elif MAIL_CLIENT == "mailgun":
+            import mailgun_mailer
+
+            return mailgun_mailer.send_email(
+                email,
+                user_name,
+                MAIL_SUBJECT,
+                MAIL_FROM,
+                mail_body_plain,
+                mail_body_html,
+            )
+        else:
+            logger.error(
+                "%s: Invalid mail client",
+                MAIL_CLIENT,
+            )
+    except (Exception, ClientError) as ce:
+        logger.error(
+            "Failed to send mail to user %s (%s). Reason: %s", user_name, email, ce
+        )
+
+    return False
+
+
+def send_notification(record):
+    """
+    Send new key pair mail for a notification record
+    """
+    return send_email(
+        record["email"],
+        record["user_name"],
+        record["access_key"],
+        record["secret_key"],
+        record["instruction"],
+        record["existing_access_key"],
+        record["existing_key_delete_age"],
+        {"id": record["account_id"], "name": record["account_name"]},
+    )
+
+
+def send_bulk_notifications(records):
+    """
+    Send new key pair mail to multiple users using SES template.
+    Returns the records the mail could not be sent to
+    """
+    import ses_mailer
+
+    fields = ses_mailer.template_placeholders(
+        [
+            "user_name",
+            "account_id",
+            "account_name",
+            "access_key",
+            "secret_key",
+            "instruction",
+            "existing_access_key",
+            "existing_key_delete_age",
+        ]
+    )
+    fields["mail_subject"] = MAIL_SUBJECT
+
+    ses_mailer.ensure_template(
+        SES_TEMPLATE_NAME,
+        MAIL_SUBJECT,
+        MAIL_BODY_PLAIN.format(**fields),
+        MAIL_BODY_HTML.format(**fields),
+    )
+    # Records carry info of their own account, so a batch may span accounts
+    destinations = [
+        (r["email"], {k: v for k, v in r.items() if k not in NON_TEMPLATE_FIELDS})
+        for r in records
+    ]
+    failed = ses_mailer.send_bulk_email(
+        SES_TEMPLATE_NAME,
+        MAIL_FROM,
+        destinations,
+        {
+            "account_id": records[0]["account_id"],
+            "account_name": records[0]["account_name"],
+        },
+    )
+    return [r for r, d in zip(records, destinations) if d in failed]
+
+
+def build_outbox():
+    """
+    Create notification outbox for the configured mail client
+    """
+    callbacks = {
+        "on_sent": on_notification_sent,
+        "on_undelivered": on_notification_undelivered,
+    }
+    if MAIL_CLIENT == "ses" and SES_TEMPLATE_MODE:
+        import ses_mailer
+
+        return notification_outbox.NotificationOutbox(
+            send_notification,
+            send_many=send_bulk_notifications,
+            batch_size=ses_mailer.SES_BULK_BATCH_SIZE,
+            should_stop=is_running_out_of_time,
+            **callbacks,
+        )
+
+    if MAIL_CLIENT not in ["smtp", "ses", "mailgun"]:
+        # Mails cannot be sent without a valid mail client, so do not retry them
+        return notification_outbox.NotificationOutbox(
+            send_notification, max_attempts=1, **callbacks
+        )
+
+    return notification_outbox.NotificationOutbox(
+        send_notification, should_stop=is_running_out_of_time, **callbacks
+    )
+
+
+def on_notification_sent(record):
+    """
+    Mark existing key for deletion once the mail of a key pair which is not
+    encrypted is sent. Existing key of an encrypted key pair is marked when
+    its mail is queued
+    """
+    if not record["encrypted"]:
+        mark_key_for_destroy(
+            record["user_name"],
+            record["existing_access_key"],
+            record["existing_key_delete_age"],
+            record["email"],
+        )
+
+
+def on_notification_undelivered(record):
+    """
+    Keep mail of an encrypted key pair so that the next run sends it. A key pair
+    which is not encrypted is rolled back instead, as its mail cannot be stored
+    without the secret
+    """
+    if record["encrypted"]:
+        with unsent_notifications_lock:
+            unsent_notifications.append(record)
+        return
+
+    rollback_user_key(
+        {"user_name": record["user_name"], "access_key": record["new_access_key"]},
+        "its mail could not be sent",
+    )
+
+
+def outbox_key(notification_id):
+    """
+    Return state table key of a notification left unsent
+    """
+    return {"pk": {"S": "outbox"}, "sk": {"S": notification_id}}
+
+
+def load_unsent_notifications():
+    """
+    Fetch notifications which earlier runs could not send
+    """
+    if IAM_KEY_ROTATOR_STATE_TABLE is None:
+        return []
+
+    records = []
+    paginator = shared_functions.get_client("dynamodb").get_paginator("query")
+    for page in paginator.paginate(
+        TableName=IAM_KEY_ROTATOR_STATE_TABLE,
+        KeyConditionExpression="pk = :pk",
+        ExpressionAttributeValues={":pk": {"S": "outbox"}},
+        ConsistentRead=True,
+    ):
+        records.extend(json.loads(item["record"]["S"]) for item in page["Items"])
+
+    if len(records) > 0:
+        logger.info(
+            "Resending %s notification(s) left unsent by earlier runs", len(records)
+        )
+    return records
+
+
+def save_unsent_notifications(records, resent_ids):
+    """
+    Save mails of encrypted key pairs which could not be sent so that the next
+    run sends them, and remove the mails of earlier runs which are sent now.
+    A mail is saved with the id and user name of the new key pair and the key
+    pair in encrypted form only
+    """
+    if IAM_KEY_ROTATOR_STATE_TABLE is None:
+        if len(records) > 0:
+            logger.error(
+                "IAM_KEY_ROTATOR_STATE_TABLE is not set. %s notification(s) could not be sent",
+                len(records),
+            )
+        return
+
+    client = shared_functions.get_client("dynamodb")
+    writer = shared_functions.DynamoDBBatchWriter(client, IAM_KEY_ROTATOR_STATE_TABLE)
+    failed = []
+    for record in records:
+        if not record["encrypted"]:
+            # Never store a secret which is not encrypted
+            logger.error(
+                "Not saving notification %s of unencrypted key pair", record["id"]
+            )
+            continue
+        failed.extend(
+            writer.put(
+                {
+                    **outbox_key(record["id"]),
+                    "user_name": {"S": record["user_name"]},
+                    "access_key": {"S": record["new_access_key"]},
+                    "record": {"S": json.dumps(record)},
+                    "expires_at": expires_at(),
+                }
+            )
+        )
+    failed.extend(writer.flush())
+    for item in failed:
+        logger.error("Failed to save unsent notification %s", item["sk"]["S"])
+    if len(records) > len(failed):
+        logger.info(
+            "%s unsent notification(s) saved for the next run",
+            len(records) - len(failed),
+        )
+
+    for notification_id in resent_ids - {r["id"] for r in records}:
+        client.delete_item(
+            TableName=IAM_KEY_ROTATOR_STATE_TABLE, Key=outbox_key(notification_id)
+        )
+
+
+def resend_unsent_notifications(shard):
+    """
+    Queue notifications left unsent by earlier runs. Only the first shard resends
+    them so that shards do not send the same mail. Returns ids of the notifications
+    """
+    if shard is not None and shard[0] != 0:
+        return set()
+
+    try:
+        records = load_unsent_notifications()
+    except (Exception, ClientError) as ce:
+        logger.error("Failed to load unsent notifications. Reason: %s", ce)
+        return set()
+
+    for record in records:
+        outbox.enqueue(record)
+    return {r["id"] for r in records}
+
+
+def drain_outbox(resent_ids):
+    """
+    Wait for the queued notifications to be sent and save the ones left unsent.
+    Waiting stops in time for the run state to be saved
+    """
+    remaining = remaining_secs()
+    stats = outbox.drain(
+        None if remaining is None else max(0, remaining - SAVE_STATE_SECS)
+    )
+    try:
+        save_unsent_notifications(unsent_notifications, resent_ids)
+    except (Exception, ClientError) as ce:
+        logger.error("Failed to save unsent notifications. Reason: %s", ce)
+    return stats
+
+
+def remaining_secs():
+    """
+    Return no. of seconds left before the invocation times out, None if unknown
+    """
+    if run_context is None:
+        return None
+    return run_context.get_remaining_time_in_millis() / 1000
+
+
+def has_remaining_time(secs):
+    """
+    Checks if the invocation has at least secs seconds left before its timeout
+    """
+    remaining = remaining_secs()
+    return remaining is None or remaining >= secs
+
+
+def drain_secs(in_flight=0):
+    """
+    Estimate no. of seconds needed to encrypt and mail the key pairs created
+    so far, along with in_flight key pairs which are being created
+    """
+    secs = 0
+    if encryption_engine is not None:
+        secs += encryption_engine.backlog_secs(in_flight)
+    if outbox is not None:
+        secs += outbox.backlog_secs(in_flight)
+    return secs
+
+
+def has_time_for_rotation(in_flight):
+    """
+    Checks if one more key pair can be created, encrypted and mailed before the
+    run stops. Key pairs which are being created, encrypted or mailed take up
+    the remaining time first, so that no key pair is created only to be rolled
+    back or left without a mail
+    """
+    # Encryption stops and deletion records are flushed once FLUSH_WHEN_REMAINING_SECS are left
+    secs = FLUSH_WHEN_REMAINING_SECS + drain_secs(in_flight + 1)
+    return has_remaining_time(max(STOP_WHEN_REMAINING_SECS, secs))
+
+
+def is_running_out_of_time():
+    """
+    Checks if the invocation is close to its timeout
+    """
+    return not has_remaining_time(FLUSH_WHEN_REMAINING_SECS)
+
+
+def save_deletion_records(items):
+    """
+    Put deletion records one by one, used for records the batch write could not save
+    """
+    for item in items:
+        ak = item["ak"]["S"]
+        try:
+            shared_functions.get_client("dynamodb").put_item(
+                TableName=IAM_KEY_ROTATOR_TABLE, Item=item
+            )
+            logger.info("Key %s marked for deletion", ak)
+        except (Exception, ClientError) as ce:
+            logger.error("Failed to mark key %s for deletion. Reason: %s", ak, ce)
+
+
+@metrics.timed("mark")
+def flush_deletion_records():
+    """
+    Stop the background flush and write all the queued deletion records to DynamoDB
+    """
+    deletion_writer.stop_flushing()
+    save_deletion_records(deletion_writer.flush())
+    logger.info("%s key(s) marked for deletion", deletion_writer.written)
+
+
+@metrics.timed("mark")
+def mark_key_for_destroy(user_name, ak, existing_key_delete_age, email):
+    """
+    Queue key to be added in DynamoDB to delete it after few days. Records are
+    written in batches, every DELETION_FLUSH_SECS, or right away when the run is
+    about to time out
+    """
+    try:
+        item = {
+            "user": {"S": user_name},
+            "ak": {"S": ak},
+            "email": {"S": email},
+            "delete_on": {
+                "N": str(
+                    shared_functions.run_clock().days_from_today(
+                        existing_key_delete_age
+                    )
+                )
+            },
+            "delete_enc_key": {
+                "S": "Y"
+                if ENCRYPT_KEY_PAIR and encryption.ENCRYPTION_MODE == "ssm"
+                else "N"
+            },
+        }
+        account_id = shared_functions.current_account_id()
+        if account_id is not None:
+            # Destructor deletes the key in the same account
+            item["account_id"] = {"S": account_id}
+        failed = deletion_writer.put(item)
+        logger.info("Key %s queued for deletion", ak)
+        if is_running_out_of_time():
+            failed.extend(deletion_writer.flush())
+        save_deletion_records(failed)
+    except (Exception, ClientError) as ce:
+        logger.error("Failed to mark key %s for deletion. Reason: %s", ak, ce)
+
+
+def finish_rotation(job, access_key, secret_key, instruction):
+    """
+    Send new key pair to the user and mark existing key for deletion. The new
+    key pair is rolled back if its mail cannot be queued. Existing key of a key
+    pair which is not encrypted is marked only once the mail is sent, so that
+    the key pair can be rolled back if the mail fails. Returns True if the
+    rotation is completed
+    """
+    user_name = job["user_name"]
+    user = job["user"]
+    existing_key_delete_age = delete_after_days(user)
+    try:
+        account_info = shared_functions.fetch_account_info()
+
+        # Mail is sent in background by the outbox
+        outbox.enqueue(
+            {
+                "id": f"new-key:{user_name}:{job['access_key']}",
+                "email": user["attributes"]["email"],
+                "account_id": account_info["id"],
+                "account_name": account_info["name"],
+                "user_name": user_name,
+                "access_key": access_key,
+                "secret_key": secret_key,
+                "instruction": instruction,
+                "existing_access_key": user["keys"][0]["ak"],
+                "existing_key_delete_age": existing_key_delete_age,
+                "new_access_key": job["access_key"],
+                "encrypted": ENCRYPT_KEY_PAIR,
+            }
+        )
+    except (Exception, ClientError) as ce:
+        rollback_user_key(job, f"its mail could not be queued. Reason: {ce}")
+        return False
+
+    if not ENCRYPT_KEY_PAIR:
+        return True
+
+    # Mark exisiting key to destory after X days
+    mark_key_for_destroy(
+        user_name,
+        user["keys"][0]["ak"],
+        existing_key_delete_age,
+        user["attributes"]["email"],
+    )
+    return True
+
+
+def on_key_pair_encrypted(job, result):
+    """
+    Complete rotation once the new key pair is encrypted
+    """
+    user_name = job["user_name"]
+    user = job["user"]
+    user_access_key, user_secret_access_key, encrypted_data_key = result
+    if encrypted_data_key is None:
+        user_instruction = f'{user["attributes"]["instruction"]} (The above key pair is encrypted so you need to decrypt it using the encryption key stored in SSM parameter /ikr/secret/iam/{user_name} before using the key pair. You can use the *decryption.py* file present in the *skildops/aws-iam-key-rotator* repo)'
+    else:
+        instruction = user["attributes"]["instruction"]
+        user_instruction = f"{instruction} (The above key pair is encrypted so you need to decrypt it using the data key {encrypted_data_key}. Decrypt the data key with AWS KMS using encryption context ikr:user={user_name} before using it to decrypt the key pair. You can use the *decryption.py* file present in the *skildops/aws-iam-key-rotator* repo)"
+
+    finish_rotation(job, user_access_key, user_secret_access_key, user_instruction)
+
+
+def rollback_user_key(job, reason):
+    """
+    Delete new key pair which could not be shared with the user.
+    The existing key is kept and the user is rotated by a later run
+    """
+    user_name = job["user_name"]
+    logger.error("Rolling back new key pair of %s because %s", user_name, reason)
+    with rolled_back_lock:
+        rolled_back.add((shared_functions.current_account_id(), user_name))
+
+    try:
+        shared_functions.get_iam_concurrency().call(
+            shared_functions.get_client("iam").delete_access_key,
+            UserName=user_name,
+            AccessKeyId=job["access_key"],
+        )
+        logger.info("New key pair of %s deleted", user_name)
+    except ClientError as ce:
+        logger.error(
+            "Failed to delete new key pair %s of %s. Reason: %s",
+            job["access_key"],
+            user_name,
+            ce,
+        )
+
+
+def plan_user_rotation(user_name, user):
+    """
+    Decide whether key of a user with email tag needs to be rotated. Returns None
+    if a new key pair needs to be generated, else the reason the user is skipped.
+    Makes no API call, so the same decision is used by plan mode
+    """
+    if len(user["keys"]) == 0:
+        return SKIP_NO_KEY
+    if len(user["keys"]) == 2:
+        return SKIP_TWO_KEYS
+    if not is_rotation_due(user, user["keys"][0]["ak_age_days"]):
+        return SKIP_NOT_DUE
+    return None
+
+
+def deferral_reason(user_name, user):
+    """
+    Return the reason a due user is left for a later run by select_rotations
+    """
+    if days_overdue(user) <= rotation_delay_days(user_name):
+        return SKIP_SPREAD
+    return SKIP_RUN_LIMIT
+
+
+def select_rotations(users, max_rotations):
+    """
+    Return names of the users whose key is rotated by this invocation along with
+    the due users left for later runs. At most max_rotations keys are rotated,
+    the most overdue ones first once the spread delay of each user is taken off.
+    None rotates all the due keys
+    """
+    due = [
+        user_name
+        for user_name, user in users.items()
+        if "keys" in user and plan_user_rotation(user_name, user) is None
+    ]
+    if max_rotations is None or len(due) <= max_rotations:
+        return set(due), []
+
+    # Ties are broken by hash so that the same users are not always left for later
+    due.sort(
+        key=lambda user_name: (
+            rotation_delay_days(user_name) - days_overdue(users[user_name]),
+            spread_hash(user_name),
+        )
+    )
+    return set(due[:max_rotations]), sorted(due[max_rotations:])
+
+
+def create_user_key(user_name, user):
+    """
+    Generate new key pair for the IAM user if required
+    """
+    try:
+        skip_reason = plan_user_rotation(user_name, user)
+        if skip_reason == SKIP_NO_KEY:
+            logger.info(
+                "Skipping key creation for %s because no existing key found", user_name
+            )
+        elif skip_reason == SKIP_TWO_KEYS:
+            logger.warning(
+                "Skipping key creation for %s because 2 keys already exist. Please delete anyone to create new key",
+                user_name,
+            )
+        elif skip_reason == SKIP_NOT_DUE:
+            logger.info(
+                "Skipping key creation for %s because existing key is only %s day(s) old and the rotation is set for %s days",
+                user_name,
+                user["keys"][0]["ak_age_days"],
+                rotate_after_days(user),
+            )
+        else:
+            logger.info("Creating new access key for %s", user_name)
+            resp = shared_functions.get_iam_concurrency().call(
+                shared_functions.get_client("iam").create_access_key,
+                UserName=user_name,
+            )
+            logger.info("New key pair generated for user %s", user_name)
+
+            job = {
+                "user_name": user_name,
+                "user": user,
+                "access_key": resp["AccessKey"]["AccessKeyId"],
+                "secret_key": resp["AccessKey"]["SecretAccessKey"],
+            }
+            if ENCRYPT_KEY_PAIR:
+                # Mail is sent and existing key is marked once the key pair is encrypted
+                encryption_engine.submit(job)
+                return True
+            return finish_rotation(
+                job,
+                job["access_key"],
+                job["secret_key"],
+                user["attributes"]["instruction"],
+            )
+    except (Exception, ClientError) as ce:
+        logger.error("Failed to create new key pair. Reason: %s", ce)
+
+    return False
+
+
+@metrics.timed("create")
+def create_user_keys(users, max_rotations=None):
+    """
+    Call create_user_key in parallel using threads. Users are picked up in
+    order of their name and no new user is picked up once the run is close
+    to its timeout or to the time needed for encrypting and mailing the key
+    pairs already created. Due users over max_rotations are left for later runs.
+    Returns the names of the users whose key was rotated and the names of
+    the users which were not processed
+    """
+    skipped = []
+    skipped_lock = threading.Condition()
+    # No. of keys being created, which are not submitted for encryption yet
+    in_flight = [0]
+
+    _, deferred = select_rotations(users, max_rotations)
+    if len(deferred) > 0:
+        spread = [
+            user_name
+            for user_name in deferred
+            if deferral_reason(user_name, users[user_name]) == SKIP_SPREAD
+        ]
+        logger.info(
+            "Rotation limit of %s reached. %s due user(s) left for later runs, %s of them to spread rotations",
+            max_rotations,
+            len(deferred),
+            len(spread),
+        )
+        metrics.count("RotationsDeferred", len(deferred))
+    deferred = set(deferred)
+
+    def schedule(user_name):
+        if user_name in deferred:
+            return False
+        with skipped_lock:
+            wait_until = None
+            while len(skipped) == 0 and not has_time_for_rotation(in_flight[0]):
+                if wait_until is None:
+                    # Waiting never goes past the time kept for flushing
+                    wait_until = time.monotonic() + max(
+                        0, remaining_secs() - FLUSH_WHEN_REMAINING_SECS
+                    )
+                if (
+                    (in_flight[0] == 0 and drain_secs() == 0)
+                    or is_running_out_of_time()
+                    or time.monotonic() >= wait_until
+                ):
+                    skipped.append(user_name)
+                    return False
+                # Key pairs created so far may be encrypted and mailed sooner than estimated
+                skipped_lock.wait(min(DRAIN_POLL_SECS, wait_until - time.monotonic()))
+            if len(skipped) > 0:
+                skipped.append(user_name)
+                return False
+            in_flight[0] += 1
+        try:
+            return create_user_key(user_name, users[user_name])
+        finally:
+            with skipped_lock:
+                in_flight[0] -= 1
+                skipped_lock.notify_all()
+
+    user_names = sorted(users)
+    results = shared_functions.get_iam_concurrency().map(schedule, user_names)
+    rotated = [u for u, f in zip(user_names, results) if f.result()]
+
+    if len(skipped) > 0:
+        logger.warning(
+            "Run time is about to end. %s of %s user(s) left for the next run",
+            len(skipped),
+            len(users),
+        )
+    return rotated, sorted(skipped)
+
+
+def plan_record(user_name, user, clock, deferred):
+    """
+    Return plan record of a user with email tag. deferred holds the due users
+    left for later runs because of MAX_ROTATIONS_PER_RUN
+    """
+    skip_reason = plan_user_rotation(user_name, user)
+    if skip_reason is None and user_name in deferred:
+        skip_reason = deferral_reason(user_name, user)
+    record = {
+        "ikr_plan": "user",
+        "user": user_name,
+        "action": "rotate" if skip_reason is None else "skip",
+        "keys": [
+            {"access_key": k["ak"], "age_days": k["ak_age_days"]} for k in user["keys"]
+        ],
+        "rotate_after_days": rotate_after_days(user),
+    }
+    if skip_reason is not None:
+        record["reason"] = skip_reason
+    if skip_reason == SKIP_NOT_DUE:
+        record["due_in_days"] = (
+            rotate_after_days(user) + 1 - user["keys"][0]["ak_age_days"]
+        )
+    if skip_reason == SKIP_SPREAD:
+        record["due_in_days"] = rotation_delay_days(user_name) + 1 - days_overdue(user)
+    if skip_reason is None:
+        delete_on = clock.days_from_today(delete_after_days(user))
+        record["delete_after_days"] = delete_after_days(user)
+        record["delete_on"] = datetime.fromtimestamp(delete_on, timezone.utc).strftime(
+            "%Y-%m-%d"
+        )
+    return record
+
+
+def estimate_run(rotations, inventory_secs, usable_secs):
+    """
+    Estimate API calls and duration of a run which rotates the given no. of keys.
+    Inventory calls are the ones made while planning as a run makes the same calls.
+    Rotation time is based on the latency observed while planning
+    """
+    api_calls = metrics.api_call_counts()
+
+    def add(name, count):
+        if count > 0:
+            api_calls[name] = api_calls.get(name, 0) + count
+
+    add("iam:CreateAccessKey", rotations)
+    add(
+        "dynamodb:BatchWriteItem",
+        math.ceil(rotations / shared_functions.DYNAMODB_BATCH_SIZE),
+    )
+    iam_ms = metrics.average_latency_ms("iam") or PLAN_DEFAULT_CALL_MS
+    create_secs = (
+        math.ceil(rotations / shared_functions.IAM_MAX_WORKERS) * iam_ms / 1000
+    )
+
+    encrypt_secs = 0
+    if ENCRYPT_KEY_PAIR and encryption.ENCRYPTION_MODE == "kms":
+        add("kms:GenerateDataKey", rotations)
+        kms_ms = metrics.average_latency_ms("kms") or PLAN_DEFAULT_CALL_MS
+        encrypt_secs = (
+            math.ceil(rotations / encryption.ENCRYPTION_WORKERS) * kms_ms / 1000
+        )
+    elif ENCRYPT_KEY_PAIR:
+        add("ssm:PutParameter", rotations)
+        # SSM parameters are created at a limited rate
+        encrypt_secs = rotations / encryption.SSM_PUT_RATE
+
+    if MAIL_CLIENT == "ses" and SES_TEMPLATE_MODE:
+        import ses_mailer
+
+        add(
+            "ses:SendBulkTemplatedEmail",
+            math.ceil(rotations / ses_mailer.SES_BULK_BATCH_SIZE),
+        )
+    elif MAIL_CLIENT in MAIL_API_CALLS:
+        add(MAIL_API_CALLS[MAIL_CLIENT], rotations)
+
+    # Key pairs are encrypted in background while other keys are created
+    duration_secs = inventory_secs + max(create_secs, encrypt_secs)
+    estimate = {
+        "api_calls": api_calls,
+        "inventory_secs": round(inventory_secs, 1),
+        "duration_secs": round(duration_secs, 1),
+    }
+    if usable_secs is not None and usable_secs > 0:
+        estimate["invocations"] = max(1, math.ceil(duration_secs / usable_secs))
+    return estimate
+
+
+def plan_run(context):
+    """
+    Fetch all the users and decide rotation of each one without creating keys,
+    encrypting, sending mails or writing to DynamoDB. Writes a JSON line per user
+    followed by a summary line and returns the summary. Records are tagged with
+    the account id in organization mode
+    """
+    clock = shared_functions.run_clock()
+    account_id = shared_functions.current_account_id()
+    usable_secs = None
+    if context is not None:
+        usable_secs = (
+            context.get_remaining_time_in_millis() / 1000 - STOP_WHEN_REMAINING_SECS
+        )
+
+    started_at = time.monotonic()
+    try:
+        users, untagged, _ = load_inventory()
+    except ClientError as ce:
+        logger.error("Failed to fetch user details. Reason: %s", ce)
+        summary = {"ikr_plan": "summary", "error": str(ce)}
+        if account_id is not None:
+            summary["account_id"] = account_id
+        return summary
+    inventory_secs = time.monotonic() - started_at
+
+    _, deferred = select_rotations(users, MAX_ROTATIONS_PER_RUN or None)
+    deferred = set(deferred)
+    records = [
+        plan_record(user_name, user, clock, deferred)
+        for user_name, user in users.items()
+    ]
+    records.extend(
+        {
+            "ikr_plan": "user",
+            "user": user_name,
+            "action": "skip",
+            "reason": SKIP_NO_EMAIL,
+        }
+        for user_name in untagged
+    )
+    records.sort(key=lambda record: record["user"])
+
+    skipped = {}
+    for record in records:
+        if record["action"] == "skip":
+            skipped[record["reason"]] = skipped.get(record["reason"], 0) + 1
+    rotations = len(records) - sum(skipped.values())
+
+    summary = {
+        "ikr_plan": "summary",
+        "planned_at": clock.now.isoformat(),
+        "users": len(records),
+        "rotate": rotations,
+        "skipped": skipped,
+        "estimate": estimate_run(rotations, inventory_secs, usable_secs),
+    }
+    for record in records + [summary]:
+        if account_id is not None:
+            record["account_id"] = account_id
+        sys.stdout.write(json.dumps(record) + "\n")
+    sys.stdout.flush()
+
+    logger.info("Plan: %s of %s user(s) due for rotation", rotations, len(records))
+    return summary
+
+
+def shard_scope(shard):
+    """
+    Return name under which state of the whole run or a shard is stored.
+    State of each target account is kept apart in organization mode
+    """
+    scope = "creator" if shard is None else f"creator:shard:{shard[0]}:{shard[1]}"
+    account_id = shared_functions.current_account_id()
+    return scope if account_id is None else f"{scope}:account:{account_id}"
+
+
+def checkpoint_key(shard):
+    """
+    Return state table key of the checkpoint for the whole run or a shard
+    """
+    return {"pk": {"S": "checkpoint"}, "sk": {"S": shard_scope(shard)}}
+
+
+def expires_at():
+    """
+    Return expiry timestamp for items added to the state table
+    """
+    return {"N": str(shared_functions.run_clock().days_from_now(STATE_EXPIRY_DAYS))}
+
+
+def load_checkpoint(shard=None):
+    """
+    Fetch the user name from which an unfinished run needs to be resumed
+    """
+    if IAM_KEY_ROTATOR_STATE_TABLE is None:
+        return None
+
+    resp = shared_functions.get_client("dynamodb").get_item(
+        TableName=IAM_KEY_ROTATOR_STATE_TABLE,
+        Key=checkpoint_key(shard),
+        ConsistentRead=True,
+    )
+    if "Item" not in resp:
+        return None
+
+    start_from = resp["Item"]["start_from"]["S"]
+    logger.info("Resuming unfinished run from user %s", start_from)
+    return start_from
+
+
+def save_checkpoint(start_from, shard=None):
+    """
+    Save the user name from which the next run needs to continue.
+    Checkpoint is removed once all the users are processed
+    """
+    if IAM_KEY_ROTATOR_STATE_TABLE is None:
+        if start_from is not None:
+            logger.warning(
+                "IAM_KEY_ROTATOR_STATE_TABLE is not set. Next run will start from the first user"
+            )
+        return
+
+    key = checkpoint_key(shard)
+    if start_from is None:
+        shared_functions.get_client("dynamodb").delete_item(
+            TableName=IAM_KEY_ROTATOR_STATE_TABLE, Key=key
+        )
+        return
+
+    shared_functions.get_client("dynamodb").put_item(
+        TableName=IAM_KEY_ROTATOR_STATE_TABLE,
+        Item={
+            **key,
+            "start_from": {"S": start_from},
+            "updated_at": {"N": str(shared_functions.run_clock().epoch)},
+            "expires_at": expires_at(),
+        },
+    )
+    logger.info("Checkpoint saved. Next run will start from user %s", start_from)
+
+
+def invoke_next_run(context, event):
+    """
+    Invoke the function asynchronously to continue the run from the checkpoint
+    """
+    if not SELF_INVOKE or context is None:
+        return
+
+    invocation = event.get("ikr_invocation", 0)
+    if invocation >= MAX_SELF_INVOCATIONS:
+        logger.warning(
+            "Run re-invoked %s times. Remaining users are left for the next scheduled run",
+            invocation,
+        )
+        return
+
+    try:
+        shared_functions.get_client("lambda").invoke(
+            FunctionName=context.function_name,
+            InvocationType="Event",
+            Payload=json.dumps(
+                {**event, "ikr_resume": True, "ikr_invocation": invocation + 1}
+            ),
+        )
+        logger.info("Invoked %s to continue the run", context.function_name)
+    except ClientError as ce:
+        logger.error("Failed to invoke next run. Reason: %s", ce)
+
+
+def get_shard_count(user_count):
+    """
+    Return no. of shards for the given no. of users. Shards share the IAM rate
+    limits of the account, so each shard is left with at least
+    MIN_IAM_WORKERS_PER_SHARD parallel IAM calls
+    """
+    by_users = math.ceil(user_count / USERS_PER_SHARD)
+    by_rate = shared_functions.IAM_MAX_WORKERS // MIN_IAM_WORKERS_PER_SHARD
+    return max(1, min(by_users, by_rate, MAX_SHARDS))
+
+
+def build_shard_inventories(user_names, shard_count):
+    """
+    Fetch the user inventory once for all the shards and split it by shard, so
+    that each shard does not list all the users of the account again. Returns
+    the inventory of each shard, None for the shards which fetch it themselves
+    """
+    try:
+        due = [
+            not INCREMENTAL
+            or user_index.is_full_scan_due(shard_scope((index, shard_count)))
+            for index in range(shard_count)
+        ]
+        # Shards not running a full scan only fetch the users of the user index
+        if not any(due):
+            return [None] * shard_count
+
+        inventories = [{} for _ in range(shard_count)]
+        if INVENTORY_MODE == "bulk":
+            bulk_users = fetch_users_bulk()
+            for inventory in inventories:
+                inventory["users"] = {}
+            for user_name, user_attributes in bulk_users.items():
+                shard_users = inventories[shard_of(user_name, shard_count)]["users"]
+                shard_users[user_name] = user_attributes
+        else:
+            for inventory in inventories:
+                inventory["user_names"] = []
+            for user_name in user_names:
+                inventories[shard_of(user_name, shard_count)]["user_names"].append(
+                    user_name
+                )
+
+        key_ages = load_key_ages() if KEY_AGE_SOURCE == "report" else None
+    except ClientError as ce:
+        logger.error("Failed to fetch inventory for shards. Reason: %s", ce)
+        return [None] * shard_count
+
+    # Shards load the credential report themselves if it is missing or stale
+    if key_ages is not None:
+        for inventory in inventories:
+            inventory["key_ages"] = {}
+        for user_name, ages in key_ages.items():
+            # Key ages of users without email tag are not used
+            if INVENTORY_MODE == "bulk" and bulk_users.get(user_name) is None:
+                continue
+            inventories[shard_of(user_name, shard_count)]["key_ages"][user_name] = ages
+
+    return [inventory if d else None for inventory, d in zip(inventories, due)]
+
+
+def shard_inventory_payload(run_id, index, inventory):
+    """
+    Return invoke payload fields which pass the inventory to a shard. Inventories
+    too large for the payload are stored in the state table. No fields are
+    returned if the inventory cannot be passed, so the shard fetches it itself
+    """
+    content = json.dumps(inventory)
+    if len(content) <= SHARD_PAYLOAD_MAX_BYTES:
+        return {"ikr_inventory": inventory}
+
+    compressed = zlib.compress(content.encode("utf-8"))
+    if IAM_KEY_ROTATOR_STATE_TABLE is None or len(compressed) > SHARD_ITEM_MAX_BYTES:
+        logger.warning(
+            "Inventory of shard %s is too large to be passed (%s bytes). Shard fetches it itself",
+            index,
+            len(compressed),
+        )
+        return {}
+
+    shared_functions.get_client("dynamodb").put_item(
+        TableName=IAM_KEY_ROTATOR_STATE_TABLE,
+        Item={
+            "pk": {"S": f"run:{run_id}"},
+            "sk": {"S": f"inventory:{index}"},
+            "inventory": {"B": compressed},
+            "expires_at": expires_at(),
+        },
+    )
+    return {"ikr_inventory_saved": True}
+
+
+def load_shard_inventory(event):
+    """
+    Return the part of the inventory passed to this shard by the coordinator,
+    or None if the shard needs to fetch the inventory itself
+    """
+    if "ikr_inventory" in event:
+        return event["ikr_inventory"]
+    if not event.get("ikr_inventory_saved"):
+        return None
+
+    try:
+        resp = shared_functions.get_client("dynamodb").get_item(
+            TableName=IAM_KEY_ROTATOR_STATE_TABLE,
+            Key={
+                "pk": {"S": f"run:{event['ikr_run_id']}"},
+                "sk": {"S": f"inventory:{event['ikr_shard']}"},
+            },
+        )
+    except ClientError as ce:
+        logger.error("Failed to load inventory of shard. Reason: %s", ce)
+        return None
+
+    if "Item" not in resp:
+        logger.warning("Inventory of shard not found. Fetching it instead")
+        return None
+    return json.loads(zlib.decompress(resp["Item"]["inventory"]["B"]))
+
+
+def fan_out(context):
+    """
+    Split users into shards and invoke the function asynchronously for each shard.
+    Each shard is passed its part of the inventory fetched by this invocation.
+    Returns False if the run is small enough to be processed by this invocation
+    """
+    user_names = list_user_names()
+    shard_count = get_shard_count(len(user_names))
+    if shard_count <= 1 or context is None:
+        return False
+
+    run_id = context.aws_request_id
+    iam_max_workers = shared_functions.IAM_MAX_WORKERS // shard_count
+    shard_event = {
+        "ikr_run_id": run_id,
+        "ikr_shard_count": shard_count,
+        "ikr_iam_max_workers": iam_max_workers,
+    }
+    if MAX_ROTATIONS_PER_RUN > 0:
+        # Each shard gets a share of the rotations of the run
+        shard_event["ikr_max_rotations"] = math.ceil(
+            MAX_ROTATIONS_PER_RUN / shard_count
+        )
+    logger.info(
+        "Splitting run %s into %s shard(s) with %s parallel IAM call(s) each",
+        run_id,
+        shard_count,
+        iam_max_workers,
+    )
+
+    if IAM_KEY_ROTATOR_STATE_TABLE is not None:
+        shared_functions.get_client("dynamodb").put_item(
+            TableName=IAM_KEY_ROTATOR_STATE_TABLE,
+            Item={
+                "pk": {"S": f"run:{run_id}"},
+                "sk": {"S": "coordinator"},
+                "shard_count": {"N": str(shard_count)},
+                "started_at": {"N": str(shared_functions.run_clock().epoch)},
+                "expires_at": expires_at(),
+            },
+        )
+
+    inventories = build_shard_inventories(user_names, shard_count)
+    for index, inventory in enumerate(inventories):
+        payload = {**shard_event, "ikr_shard": index}
+        if inventory is not None:
+            payload.update(shard_inventory_payload(run_id, index, inventory))
+        shared_functions.get_client("lambda").invoke(
+            FunctionName=context.function_name,
+            InvocationType="Event",
+            Payload=json.dumps(payload),
+        )
+
+    return True
+
+
+def save_shard_result(event, user_count, rotated, skipped):
+    """
+    Add results of this invocation to the results of the shard
+    """
+    if IAM_KEY_ROTATOR_STATE_TABLE is None:
+        return
+
+    shared_functions.get_client("dynamodb").update_item(
+        TableName=IAM_KEY_ROTATOR_STATE_TABLE,
+        Key={
+            "pk": {"S": f"run:{event['ikr_run_id']}"},
+            "sk": {"S": f"shard:{event['ikr_shard']}"},
+        },
+        UpdateExpression="ADD processed :processed, rotated :rotated SET remaining = :remaining, updated_at = :now, expires_at = :expires_at",
+        ExpressionAttributeValues={
+            ":processed": {"N": str(user_count - skipped)},
+            ":rotated": {"N": str(rotated)},
+            ":remaining": {"N": str(skipped)},
+            ":now": {"N": str(shared_functions.run_clock().epoch)},
+            ":expires_at": expires_at(),
+        },
+    )
+
+
+def event_user_name(detail):
+    """
+    Return name of the user changed by the IAM API call. A user creating its own
+    access key does not pass the user name, so the caller is the changed user
+    """
+    user_name = (detail.get("requestParameters") or {}).get("userName")
+    if user_name is None and detail["userIdentity"].get("type") == "IAMUser":
+        user_name = detail["userIdentity"].get("userName")
+    return user_name
+
+
+def handle_user_change(event):
+    """
+    Update user index for a single user whose tags or keys were changed.
+    The user is then rotated by the next run if its key is due
+    """
+    detail = event["detail"]
+    if detail.get("eventName") not in USER_CHANGE_EVENTS:
+        logger.info("Ignoring %s event", detail.get("eventName"))
+        return
+
+    # Keys created and deleted by this function are already in the user index
+    caller = detail["userIdentity"].get("arn", "")
+    if caller.endswith(f"/{FUNCTION_NAME}"):
+        logger.info("Ignoring %s event raised by this function", detail["eventName"])
+        return
+
+    user_name = event_user_name(detail)
+    if user_name is None:
+        logger.warning("No user name found in %s event", detail["eventName"])
+        return
+
+    if not INCREMENTAL or IAM_KEY_ROTATOR_STATE_TABLE is None:
+        logger.info(
+            "User index is not enabled. %s is checked by the next run", user_name
+        )
+        return
+
+    logger.info("Updating user index for %s after %s", user_name, detail["eventName"])
+    try:
+        has_email, _, user_attributes = fetch_users_with_email(user_name)
+        users = {}
+        if has_email:
+            users[user_name] = {
+                "attributes": user_attributes,
+                "keys": fetch_user_keys(user_name)[1],
+            }
+        update_user_index(users, [user_name], [], [])
+    except ClientError as ce:
+        if ce.response["Error"]["Code"] == "NoSuchEntity":
+            user_index.remove([user_name])
+            return
+        # Changed user is checked by the next run
+        logger.error("Failed to update user index for %s. Reason: %s", user_name, ce)
+        user_index.mark_dirty(user_name)
+
+
+def list_target_accounts():
+    """
+    Return ids of the accounts whose keys are rotated in organization mode
+    """
+    if TARGET_ACCOUNTS.strip().lower() != "organization":
+        return [a.strip() for a in TARGET_ACCOUNTS.split(",") if a.strip() != ""]
+
+    account_ids = []
+    paginator = shared_functions.get_client("organizations").get_paginator(
+        "list_accounts"
+    )
+    for page in paginator.paginate():
+        account_ids.extend(a["Id"] for a in page["Accounts"] if a["Status"] == "ACTIVE")
+    return sorted(account_ids)
+
+
+def run_in_accounts(account_ids, func, *args):
+    """
+    Call func in the scope of each account, up to ACCOUNT_MAX_WORKERS accounts
+    in parallel. Returns account id along with the result for each account.
+    Accounts in which the role cannot be assumed are left out
+    """
+
+    def run(account_id):
+        with shared_functions.account_scope(account_id):
+            # Assume the role up front so that the account fails as a whole
+            shared_functions.get_client("iam")
+            return func(*args)
+
+    results = []
+    workers = max(1, min(ACCOUNT_MAX_WORKERS, len(account_ids)))
+    with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+        futures = [executor.submit(run, account_id) for account_id in account_ids]
+    for account_id, f in zip(account_ids, futures):
+        try:
+            results.append((account_id, f.result()))
+        except ClientError as ce:
+            logger.error("Failed to process account %s. Reason: %s", account_id, ce)
+            metrics.count("AccountsFailed")
+    return results
+
+
+def rotate_account_keys(shard, max_rotations, inventory=None):
+    """
+    Fetch users of the current account scope and rotate their due keys. Returns
+    the state needed to finish the run once all the key pairs are encrypted
+    """
+    try:
+        start_from = load_checkpoint(shard)
+    except ClientError as ce:
+        logger.error("Failed to load checkpoint. Reason: %s", ce)
+        start_from = None
+
+    checked, full_scan = [], False
+    if INCREMENTAL:
+        try:
+            users, checked, full_scan = fetch_changed_user_details(
+                start_from, shard, inventory
+            )
+        except ClientError as ce:
+            logger.error("Failed to fetch user details. Reason: %s", ce)
+            users = {}
+    else:
+        users = fetch_user_details(start_from, shard, inventory)
+
+    rotated, skipped = create_user_keys(users, max_rotations)
+    return {
+        "users": users,
+        "checked": checked,
+        "full_scan": full_scan,
+        "rotated": rotated,
+        "skipped": skipped,
+    }
+
+
+def finish_account_run(run, shard):
+    """
+    Update user index and checkpoint of the current account scope once all the
+    key pairs are encrypted. Rolled back users are moved from the rotated users
+    to the skipped ones, so that the checkpoint does not pass them. Returns
+    whether the checkpoint is saved
+    """
+    account_id = shared_functions.current_account_id()
+    failed = {user_name for a, user_name in rolled_back if a == account_id}
+    run["rotated"] = [u for u in run["rotated"] if u not in failed]
+    run["skipped"] = sorted(set(run["skipped"]) | failed)
+    if INCREMENTAL:
+        try:
+            update_user_index(
+                run["users"], run["checked"], run["rotated"], run["skipped"]
+            )
+            if run["full_scan"] and len(run["skipped"]) == 0:
+                user_index.save_full_scan(shard_scope(shard))
+        except ClientError as ce:
+            logger.error("Failed to update user index. Reason: %s", ce)
+
+    try:
+        skipped = run["skipped"]
+        save_checkpoint(skipped[0] if len(skipped) > 0 else None, shard)
+    except ClientError as ce:
+        logger.error("Failed to save checkpoint. Reason: %s", ce)
+        return False
+    return True
+
+
+def handler(event, context):
+    """
+    Entrypoint function for lambda
+    """
+    global ENCRYPT_KEY_PAIR, run_context
+    ENCRYPT_KEY_PAIR = str(ENCRYPT_KEY_PAIR).lower() != "false"
+    run_context = context
+    metrics.reset()
+    shared_functions.start_run_clock()
+    organization_mode = TARGET_ACCOUNTS.strip() != ""
+
+    if event.get("source") == "aws.iam":
+        # Events of target accounts are forwarded to the event bus of this account
+        with shared_functions.account_scope(
+            event.get("account") if organization_mode else None
+        ):
+            handle_user_change(event)
+        return
+
+    if event.get("ikr_plan"):
+        if not organization_mode:
+            return plan_run(context)
+
+        # Accounts are planned one by one so that estimates are based on the
+        # calls made for the account alone
+        summaries = []
+        for account_id in list_target_accounts():
+            metrics.reset()
+            with shared_functions.account_scope(account_id):
+                summaries.append(plan_run(context))
+        return summaries
+
+    if IAM_KEY_ROTATOR_TABLE is None:
+        logger.error(
+            "IAM_KEY_ROTATOR_TABLE is required. Current value: %s",
+            IAM_KEY_ROTATOR_TABLE,
+        )
+    elif MAIL_FROM is None:
+        logger.error("MAIL_FROM is required. Current value: %s", MAIL_FROM)
+    else:
+        shared_functions.reset_account_info_stats()
+        global outbox, deletion_writer, encryption_engine
+        rolled_back.clear()
+        unsent_notifications.clear()
+
+        # Shards share IAM rate limits, so each one gets a part of IAM_MAX_WORKERS
+        shared_functions.iam_concurrency.set_max_workers(
+            event.get("ikr_iam_max_workers", shared_functions.IAM_MAX_WORKERS)
+        )
+
+        shard = None
+        if "ikr_shard" in event:
+            shard = (event["ikr_shard"], event["ikr_shard_count"])
+            logger.info("Processing shard %s of %s", shard[0] + 1, shard[1])
+        elif FAN_OUT and organization_mode:
+            logger.warning("FAN_OUT is not supported in organization mode")
+        elif FAN_OUT and "ikr_resume" not in event:
+            try:
+                if fan_out(context):
+                    metrics.emit(FUNCTION_NAME)
+                    return
+            except ClientError as ce:
+                logger.error("Failed to split run into shards. Reason: %s", ce)
+
+        deletion_writer = shared_functions.DynamoDBBatchWriter(
+            shared_functions.get_client("dynamodb"), IAM_KEY_ROTATOR_TABLE
+        )
+        # Records are not lost with the buffer if the invocation is killed
+        deletion_writer.start_flushing(
+            DELETION_FLUSH_SECS, save_deletion_records, is_running_out_of_time
+        )
+        outbox = build_outbox()
+        outbox.start()
+        resent_ids = resend_unsent_notifications(shard)
+        encryption_engine = None
+        if ENCRYPT_KEY_PAIR:
+            encryption_engine = encryption.EncryptionEngine(
+                on_key_pair_encrypted, rollback_user_key, is_running_out_of_time
+            )
+            encryption_engine.start()
+
+        # Rotations left for this invocation out of MAX_ROTATIONS_PER_RUN
+        max_rotations = event.get("ikr_max_rotations", MAX_ROTATIONS_PER_RUN or None)
+        runs = None
+        try:
+            if organization_mode:
+                try:
+                    # A resumed run continues only with the accounts left unfinished
+                    account_ids = event.get("ikr_accounts") or list_target_accounts()
+                except ClientError as ce:
+                    logger.error("Failed to list target accounts. Reason: %s", ce)
+                    account_ids = []
+                logger.info("Rotating keys of %s account(s)", len(account_ids))
+                runs = run_in_accounts(
+                    account_ids, rotate_account_keys, shard, max_rotations
+                )
+                metrics.count("AccountsProcessed", len(runs))
+            else:
+                inventory = None if shard is None else load_shard_inventory(event)
+                runs = [(None, rotate_account_keys(shard, max_rotations, inventory))]
+        finally:
+            # Keys rotated so far keep their deletion record and mail even if the run fails
+            if encryption_engine is not None:
+                encryption_engine.drain()
+            # Mails are sent first as existing keys of key pairs which are not
+            # encrypted are marked for deletion once their mail is sent, and key
+            # pairs whose mail fails are rolled back before the checkpoint is saved
+            outbox_stats = drain_outbox(resent_ids)
+            flush_deletion_records()
+
+        unfinished = []
+        for account_id, run in runs:
+            with shared_functions.account_scope(account_id):
+                saved = finish_account_run(run, shard)
+            # Continue only if the run made progress
+            if saved and 0 < len(run["skipped"]) < len(run["users"]):
+                unfinished.append(account_id)
+
+        users = sum(len(run["users"]) for _, run in runs)
+        rotated = sum(len(run["rotated"]) for _, run in runs)
+        skipped = sum(len(run["skipped"]) for _, run in runs)
+        logger.info("New key pair generated for %s user(s)", rotated)
+
+        try:
+            if shard is not None:
+                save_shard_result(event, users, rotated, skipped)
+        except ClientError as ce:
+            logger.error("Failed to save run state. Reason: %s", ce)
+        else:
+            if organization_mode and len(unfinished) > 0:
+                invoke_next_run(context, {**event, "ikr_accounts": unfinished})
+            elif len(unfinished) > 0:
+                if max_rotations is not None:
+                    # Rest of the run shares the rotations left
+                    event = {
+                        **event,
+                        "ikr_max_rotations": max(0, max_rotations - rotated),
+                    }
+                invoke_next_run(context, event)
+
+        shared_functions.log_account_info_stats()
+
+        metrics.count("UsersChecked", users)
+        metrics.count("KeysRotated", rotated)
+        metrics.count("KeysRolledBack", len(rolled_back))
+        metrics.count("UsersLeft", skipped)
+        metrics.count("DeletionRecordsWritten", deletion_writer.written)
+        metrics.count("MailsSent", outbox_stats["sent"])
+        metrics.count("MailsFailed", outbox_stats["failed"])
+        metrics.count("MailsUnsent", outbox_stats["unsent"])
+        metrics.emit(FUNCTION_NAME)
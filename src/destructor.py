@@ -3,13 +3,15 @@ The file will be triggered by a DynamoDB stream to delete an IAM key pair
 """
 
 import os
+import time
 import logging
 import concurrent.futures
-import boto3
 
 from botocore.exceptions import ClientError
 
 import shared_functions
+import notification_outbox
+import metrics
 
 # Table name which holds existing access key pair details to be deleted
 IAM_KEY_ROTATOR_TABLE = os.environ.get("IAM_KEY_ROTATOR_TABLE", None)
@@ -23,27 +25,50 @@ MAIL_CLIENT = os.environ.get("MAIL_CLIENT", "ses")
 # From address to be used while sending mail
 MAIL_FROM = os.environ.get("MAIL_FROM", None)
 
-# AWS_REGION is by default available within lambda environment
-iam = boto3.client("iam", region_name=os.environ.get("AWS_REGION"))
-ses = boto3.client("ses", region_name=os.environ.get("AWS_REGION"))
-ssm = boto3.client("ssm", region_name=os.environ.get("AWS_REGION"))
-dynamodb = boto3.client("dynamodb", region_name=os.environ.get("AWS_REGION"))
+# Whether to send deletion mails of a stream batch using a single Mailgun batch sending call
+MAILGUN_BATCH_SEND = os.environ.get("MAILGUN_BATCH_SEND", "true") == "true"
+
+# Whether to send mails using SES templates and SendBulkTemplatedEmail
+SES_TEMPLATE_MODE = os.environ.get("SES_TEMPLATE_MODE", "false") == "true"
+
+# Name of SES template used for key pair deletion mail
+SES_TEMPLATE_NAME = os.environ.get(
+    "SES_TEMPLATE_NAME", "ikr-old-access-key-pair-deleted"
+)
+
+# Maximum no. of SSM deletions or re-inserts to process in parallel
+DESTRUCTOR_MAX_WORKERS = int(os.environ.get("DESTRUCTOR_MAX_WORKERS", 10))
+
+# No. of times key deletion is attempted before the key is added back to the table
+DELETE_MAX_ATTEMPTS = int(os.environ.get("DELETE_MAX_ATTEMPTS", 3))
+
+# No. of seconds to wait before the first retry, doubled on every attempt
+DELETE_RETRY_DELAY_SECS = float(os.environ.get("DELETE_RETRY_DELAY_SECS", 1))
+
+# Deletion is not retried in-process once the remaining run time falls below these many
+# seconds. The key is added back to the table instead so that the batch does not time out
+RETRY_WHEN_REMAINING_SECS = int(os.environ.get("RETRY_WHEN_REMAINING_SECS", 10))
+
+# Name of the function under which metrics are published, available within lambda environment
+FUNCTION_NAME = os.environ.get("AWS_LAMBDA_FUNCTION_NAME", "iam-key-destructor")
+
+# Maximum no. of parameters SSM accepts in a single DeleteParameters call
+SSM_DELETE_BATCH_SIZE = 10
+
+# Throttled SSM calls are retried with backoff
+ssm_concurrency = shared_functions.AdaptiveConcurrency(
+    "ssm", DESTRUCTOR_MAX_WORKERS, 1, DESTRUCTOR_MAX_WORKERS
+)
 
 logger = logging.getLogger("destructor")
 logger.setLevel(logging.INFO)
 
+# Lambda context of the current invocation
+run_context = None
 
-def send_email(email, user_name, existing_access_key):
-    """
-    Send email about key pair deletion
-    """
-    # fetch aws account info
-    account_id = shared_functions.fetch_account_info()["id"]
-    account_name = shared_functions.fetch_account_info()["name"]
-
-    mail_subject = "Old Access Key Pair Deleted"
+MAIL_SUBJECT = "Old Access Key Pair Deleted"
 
-    mail_body_plain = f"""
+MAIL_BODY_PLAIN = """
     Hey {user_name},\n
     An existing access key pair associated to your username
     has been deleted because it reached End-Of-Life.\n\n
@@ -52,7 +77,7 @@ def send_email(email, user_name, existing_access_key):
     Thanks,\n
     Your Security Team"""
 
-    mail_body_html = f"""
+MAIL_BODY_HTML = """
     <!DOCTYPE html>
     <html style="font-family: "Helvetica Neue", Helvetica, Arial, sans-serif;
                     box-sizing: border-box; font-size: 14px; margin: 0;">
@@ -61,13 +86,13 @@ def send_email(email, user_name, existing_access_key):
             <meta http-equiv="Content-Type" content="text/html charset=UTF-8" />
             <title>{mail_subject}</title>
             <style type="text/css">
-                body {{{{
+                body {{
                     -webkit-font-smoothing: antialiased;
                     -webkit-text-size-adjust: none;
                     width: 100% !important;
                     height: 100%;
                     line-height: 1.6em;
-                }}}}
+                }}
             </style>
         </head>
         <body>
@@ -85,15 +110,36 @@ def send_email(email, user_name, existing_access_key):
             </p>
         </body>
     </html>"""
+
+
+def send_email(email, user_name, existing_access_key, account_info=None):
+    """
+    Send email about key pair deletion. Returns True if the mail was sent.
+    Info of the account of the current scope is used unless account_info is passed
+    """
+    if account_info is None:
+        # fetch aws account info
+        account_info = shared_functions.fetch_account_info()
+    fields = {
+        "mail_subject": MAIL_SUBJECT,
+        "user_name": user_name,
+        "account_id": account_info["id"],
+        "account_name": account_info["name"],
+        "existing_access_key": existing_access_key,
+    }
+
+    mail_body_plain = MAIL_BODY_PLAIN.format(**fields)
+    mail_body_html = MAIL_BODY_HTML.format(**fields)
+
     try:
         logger.info("Using %s as mail client", MAIL_CLIENT)
         if MAIL_CLIENT == "smtp":
             import smtp_mailer
 
-            smtp_mailer.send_email(
+            return smtp_mailer.send_email(
                 email,
                 user_name,
-                mail_subject,
+                MAIL_SUBJECT,
                 MAIL_FROM,
                 mail_body_plain,
                 mail_body_html,
@@ -101,10 +147,10 @@ def send_email(email, user_name, existing_access_key):
         elif MAIL_CLIENT == "ses":
             import ses_mailer
 
-            ses_mailer.send_email(
+            return ses_mailer.send_email(
                 email,
                 user_name,
-                mail_subject,
+                MAIL_SUBJECT,
                 MAIL_FROM,
                 mail_body_plain,
                 mail_body_html,
@@ -112,10 +158,10 @@ def send_email(email, user_name, existing_access_key):
         elif MAIL_CLIENT == "mailgun":
             import mailgun_mailer
 
-            mailgun_mailer.send_email(
+            return mailgun_mailer.send_email(
                 email,
                 user_name,
-                mail_subject,
+                MAIL_SUBJECT,
                 MAIL_FROM,
                 mail_body_plain,
                 mail_body_html,
@@ -130,84 +176,435 @@ def send_email(email, user_name, existing_access_key):
             "Failed to send mail to user %s (%s). Reason: %s", user_name, email, ce
         )
 
+    return False
+
+
+def send_notification(record):
+    """
+    Send key pair deletion mail for a notification record
+    """
+    return send_email(
+        record["email"],
+        record["user_name"],
+        record["existing_access_key"],
+        {"id": record["account_id"], "name": record["account_name"]},
+    )
+
+
+def send_batch_notifications(records):
+    """
+    Send key pair deletion mail to multiple users using a single templated
+    Mailgun batch sending call. Returns the records the mail could not be sent to
+    """
+    import mailgun_mailer
+
+    # Records carry info of their own account, so a batch may span accounts
+    fields = {
+        "mail_subject": MAIL_SUBJECT,
+        "user_name": "%recipient.user_name%",
+        "account_id": "%recipient.account_id%",
+        "account_name": "%recipient.account_name%",
+        "existing_access_key": "%recipient.existing_access_key%",
+    }
+
+    failed = mailgun_mailer.send_batch_email(
+        [
+            (
+                r["email"],
+                {
+                    "user_name": r["user_name"],
+                    "account_id": r["account_id"],
+                    "account_name": r["account_name"],
+                    "existing_access_key": r["existing_access_key"],
+                },
+            )
+            for r in records
+        ],
+        MAIL_SUBJECT,
+        MAIL_FROM,
+        MAIL_BODY_PLAIN.format(**fields),
+        MAIL_BODY_HTML.format(**fields),
+    )
+    return [r for r in records if r["email"] in failed]
+
+
+def send_bulk_notifications(records):
+    """
+    Send key pair deletion mail to multiple users using SES template.
+    Returns the records the mail could not be sent to
+    """
+    import ses_mailer
+
+    fields = ses_mailer.template_placeholders(
+        ["user_name", "account_id", "account_name", "existing_access_key"]
+    )
+    fields["mail_subject"] = MAIL_SUBJECT
+
+    ses_mailer.ensure_template(
+        SES_TEMPLATE_NAME,
+        MAIL_SUBJECT,
+        MAIL_BODY_PLAIN.format(**fields),
+        MAIL_BODY_HTML.format(**fields),
+    )
+    # Records carry info of their own account, so a batch may span accounts
+    destinations = [
+        (
+            r["email"],
+            {
+                "user_name": r["user_name"],
+                "account_id": r["account_id"],
+                "account_name": r["account_name"],
+                "existing_access_key": r["existing_access_key"],
+            },
+        )
+        for r in records
+    ]
+    failed = ses_mailer.send_bulk_email(
+        SES_TEMPLATE_NAME,
+        MAIL_FROM,
+        destinations,
+        {
+            "account_id": records[0]["account_id"],
+            "account_name": records[0]["account_name"],
+        },
+    )
+    return [r for r, d in zip(records, destinations) if d in failed]
+
+
+def build_outbox():
+    """
+    Create notification outbox for the configured mail client
+    """
+    if MAIL_CLIENT == "mailgun" and MAILGUN_BATCH_SEND:
+        import mailgun_mailer
+
+        return notification_outbox.NotificationOutbox(
+            send_notification,
+            send_many=send_batch_notifications,
+            batch_size=mailgun_mailer.MAILGUN_BATCH_SIZE,
+        )
+    if MAIL_CLIENT == "ses" and SES_TEMPLATE_MODE:
+        import ses_mailer
+
+        return notification_outbox.NotificationOutbox(
+            send_notification,
+            send_many=send_bulk_notifications,
+            batch_size=ses_mailer.SES_BULK_BATCH_SIZE,
+        )
+
+    if MAIL_CLIENT not in ["smtp", "ses", "mailgun"]:
+        # Mails cannot be sent without a valid mail client, so do not retry them
+        return notification_outbox.NotificationOutbox(send_notification, max_attempts=1)
+
+    return notification_outbox.NotificationOutbox(send_notification)
+
+
+def delete_encryption_key_batch(account_id, user_names):
+    """
+    Delete encryption keys of up to SSM_DELETE_BATCH_SIZE users of an account
+    using a single call. Returns account id and user names along with whether
+    the key is deleted. Keys which do not exist anymore are considered deleted
+    """
+    with shared_functions.account_scope(account_id):
+        return [
+            ((account_id, user_name), deleted)
+            for user_name, deleted in delete_user_encryption_keys(user_names)
+        ]
 
-def delete_encryption_key(user_name):
+
+def delete_user_encryption_keys(user_names):
     """
-    Delete encryption key stored in SSM parameter store
+    Delete encryption keys of the users of the current account scope using a single call
     """
+    names = {f"/ikr/secret/iam/{user_name}": user_name for user_name in user_names}
     try:
-        logger.info("Deleting encryption key for %s user", user_name)
-        ssm.delete_parameter(Name=f"/ikr/secret/iam/{user_name}")
-        logger.info("Encryption key deleted for %s user", user_name)
+        logger.info("Deleting encryption key for %s user(s)", len(user_names))
+        resp = ssm_concurrency.call(
+            shared_functions.get_client("ssm").delete_parameters, Names=list(names)
+        )
     except ClientError as ce:
         logger.error(
-            "Unable to delete encryption key for %s user. Reason: %s", user_name, ce
+            "Unable to delete encryption key for %s user(s). Reason: %s",
+            len(user_names),
+            ce,
         )
-        return False
+        return [(user_name, False) for user_name in user_names]
 
-    return True
+    for name in resp.get("InvalidParameters", []):
+        logger.info("Encryption key for %s user already deleted", names[name])
+    logger.info(
+        "Encryption key deleted for %s user(s)", len(resp.get("DeletedParameters", []))
+    )
+    return [(user_name, True) for user_name in user_names]
+
+
+def delete_encryption_keys(users):
+    """
+    Delete encryption keys of the users, given as account id and user name, in
+    batches. Keys are stored in the account of the user, so each batch holds
+    users of a single account. Returns a dict of account id and user name to
+    whether the key is deleted
+    """
+    accounts = {}
+    for account_id, user_name in sorted(set(users), key=lambda u: (u[0] or "", u[1])):
+        accounts.setdefault(account_id, []).append(user_name)
+    batches = [
+        (account_id, user_names[i : i + SSM_DELETE_BATCH_SIZE])
+        for account_id, user_names in accounts.items()
+        for i in range(0, len(user_names), SSM_DELETE_BATCH_SIZE)
+    ]
+    deleted = {}
+    for results in run_in_parallel(
+        lambda batch: delete_encryption_key_batch(*batch), batches
+    ):
+        deleted.update(results)
+
+    return deleted
 
 
-def destroy_user_key(rec):
+def parse_record(rec):
     """
-    Delete IAM key pair if DynamoDB event type is remove
+    Extract key details from DynamoDB stream record
     """
-    if rec["eventName"] == "REMOVE":
-        key = rec["dynamodb"]["OldImage"]
-        user_name = key["user"]["S"]
-        user_email = key["email"]["S"]
-        access_key = key["ak"]["S"]
-        del_enc_key = key["delete_enc_key"]["S"]
-        enc_key_deleted = False
+    key = rec["dynamodb"]["OldImage"]
+    return {
+        "sequence_number": rec["dynamodb"].get("SequenceNumber"),
+        # Keys rotated in organization mode are deleted in the account of the user
+        "account_id": key.get("account_id", {}).get("S"),
+        "user_name": key["user"]["S"],
+        "email": key["email"]["S"],
+        "access_key": key["ak"]["S"],
+        "delete_on": int(key["delete_on"]["N"]),
+        "del_enc_key": key["delete_enc_key"]["S"],
+        "ak_deleted": False,
+        "enc_key_deleted": False,
+        "mail_queued": False,
+        "success": False,
+    }
+
+
+def has_remaining_time(secs):
+    """
+    Checks if the invocation has at least secs seconds left before its timeout
+    """
+    return run_context is None or run_context.get_remaining_time_in_millis() >= (
+        secs * 1000
+    )
+
+
+def is_transient_error(ex):
+    """
+    Checks if a failed call can succeed when retried, i.e. it was throttled,
+    failed on the service side or did not reach the service
+    """
+    if not isinstance(ex, ClientError):
+        return True
+    status = ex.response.get("ResponseMetadata", {}).get("HTTPStatusCode", 0)
+    return shared_functions.is_throttling_error(ex) or status >= 500
+
+
+def destroy_user_key(key):
+    """
+    Delete IAM key pair. Deletion is retried in-process before giving up
+    """
+    with shared_functions.account_scope(key["account_id"]):
+        return delete_access_key(key)
+
+
+def delete_access_key(key):
+    """
+    Delete IAM key pair in the current account scope. Only transient errors
+    are retried and only while the invocation has time left
+    """
+    for attempt in range(1, DELETE_MAX_ATTEMPTS + 1):
         try:
             logger.info(
-                "Deleting access key %s assocaited with user %s", access_key, user_name
+                "Deleting access key %s assocaited with user %s",
+                key["access_key"],
+                key["user_name"],
             )
-            iam.delete_access_key(UserName=user_name, AccessKeyId=access_key)
-            logger.info("Access Key %s has been deleted", access_key)
-
-            # Delete user encryption key stored in ssm
-            if del_enc_key == "Y":
-                enc_key_deleted = delete_encryption_key(user_name)
+            shared_functions.get_iam_concurrency().call(
+                shared_functions.get_client("iam").delete_access_key,
+                UserName=key["user_name"],
+                AccessKeyId=key["access_key"],
+            )
+            logger.info("Access Key %s has been deleted", key["access_key"])
+            return True
+        except ClientError as ce:
+            # Key was already deleted, e.g. when the stream batch is retried
+            if ce.response["Error"]["Code"] == "NoSuchEntity":
+                logger.info("Access Key %s is already deleted", key["access_key"])
+                return True
+            reason = ce
+        except Exception as ex:
+            reason = ex
 
-            # Send mail to user about key deletion
-            send_email(user_email, user_name, access_key)
-        except (Exception, ClientError) as ce:
-            logger.error("Failed to delete access key %s. Reason: %s", access_key, ce)
-            logger.info("Adding access key %s back to the database", access_key)
-
-            dynamodb.put_item(
-                TableName=IAM_KEY_ROTATOR_TABLE,
-                Item={
-                    "user": {"S": user_name},
-                    "ak": {"S": access_key},
-                    "email": {"S": user_email},
-                    "delete_on": {
-                        "N": str(int(key["delete_on"]["N"]) + (RETRY_AFTER_MINS * 60))
-                    },
-                    "delete_enc_key": {
-                        "S": "N"
-                        if del_enc_key == "Y" and enc_key_deleted
-                        else del_enc_key
-                    },
-                },
+        logger.error(
+            "Failed to delete access key %s (attempt %s of %s). Reason: %s",
+            key["access_key"],
+            attempt,
+            DELETE_MAX_ATTEMPTS,
+            reason,
+        )
+        delay = DELETE_RETRY_DELAY_SECS * 2 ** (attempt - 1)
+        if attempt == DELETE_MAX_ATTEMPTS or not is_transient_error(reason):
+            break
+        if not has_remaining_time(RETRY_WHEN_REMAINING_SECS + delay):
+            logger.warning(
+                "Not retrying deletion of access key %s as the run is about to time out",
+                key["access_key"],
             )
-            logger.info("Access key %s added back to the database", access_key)
-    else:
-        logger.info("Skipping as it is not a delete event")
+            break
+        time.sleep(delay)
+
+    return False
+
+
+def add_key_back(key):
+    """
+    Add key back to DynamoDB table so that the deletion is retried later
+    """
+    item = {
+        "user": {"S": key["user_name"]},
+        "ak": {"S": key["access_key"]},
+        "email": {"S": key["email"]},
+        "delete_on": {"N": str(key["delete_on"] + (RETRY_AFTER_MINS * 60))},
+        "delete_enc_key": {
+            "S": "N"
+            if key["del_enc_key"] == "Y" and key["enc_key_deleted"]
+            else key["del_enc_key"]
+        },
+    }
+    if key["account_id"] is not None:
+        item["account_id"] = {"S": key["account_id"]}
+
+    try:
+        logger.info("Adding access key %s back to the database", key["access_key"])
+        shared_functions.get_client("dynamodb").put_item(
+            TableName=IAM_KEY_ROTATOR_TABLE, Item=item
+        )
+        logger.info("Access key %s added back to the database", key["access_key"])
+    except ClientError as ce:
+        logger.error(
+            "Failed to add access key %s back to the database. Reason: %s",
+            key["access_key"],
+            ce,
+        )
+        return False
+
+    return True
+
+
+def run_in_parallel(func, items):
+    """
+    Call func for each item using a bounded thread pool and return the results in order
+    """
+    if len(items) == 0:
+        return []
+
+    started_at = time.monotonic()
+    busy_secs = []
+
+    def run(item):
+        item_started_at = time.monotonic()
+        try:
+            return func(item)
+        finally:
+            busy_secs.append(time.monotonic() - item_started_at)
+
+    workers = min(DESTRUCTOR_MAX_WORKERS, len(items))
+    with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+        results = list(executor.map(run, items))
+    metrics.record_pool(
+        "destructor", workers, time.monotonic() - started_at, sum(busy_secs)
+    )
+    return results
 
 
 def destroy_user_keys(records):
     """
-    Delete key pairs in parallel
+    Delete key pairs of all REMOVE events in the batch in parallel.
+    Side effects are grouped by type (IAM key deletion, SSM encryption key
+    deletion and mail) and each group is run in parallel. Mails are sent by
+    the notification outbox while the remaining steps run.
+    Returns the outcome of each key
     """
-    with concurrent.futures.ThreadPoolExecutor() as executor:
-        [executor.submit(destroy_user_key(rec)) for rec in records]
+    keys = []
+    for rec in records:
+        if rec["eventName"] == "REMOVE":
+            keys.append(parse_record(rec))
+        else:
+            logger.info("Skipping as it is not a delete event")
+
+    with metrics.timed("delete"):
+        futures = shared_functions.get_iam_concurrency().map(destroy_user_key, keys)
+    for key, f in zip(keys, futures):
+        key["ak_deleted"] = f.result()
+    deleted_keys = [key for key in keys if key["ak_deleted"]]
+
+    # Send mail to user about key deletion in background
+    outbox = build_outbox()
+    outbox.start()
+    for key in deleted_keys:
+        try:
+            with shared_functions.account_scope(key["account_id"]):
+                account_info = shared_functions.fetch_account_info()
+        except (Exception, ClientError) as ce:
+            # Record is retried, by when the key is already deleted and only the mail is sent
+            logger.error(
+                "Failed to fetch account info for deletion mail of access key %s. Reason: %s",
+                key["access_key"],
+                ce,
+            )
+            continue
+        key["mail_queued"] = True
+        outbox.enqueue(
+            {
+                "id": f"key-deleted:{key['user_name']}:{key['access_key']}",
+                "email": key["email"],
+                "user_name": key["user_name"],
+                "account_id": account_info["id"],
+                "account_name": account_info["name"],
+                "existing_access_key": key["access_key"],
+            }
+        )
+
+    # Delete user encryption key stored in ssm
+    enc_keys = [key for key in deleted_keys if key["del_enc_key"] == "Y"]
+    with metrics.timed("delete_enc_key"):
+        results = delete_encryption_keys(
+            [(key["account_id"], key["user_name"]) for key in enc_keys]
+        )
+    for key in enc_keys:
+        key["enc_key_deleted"] = results[(key["account_id"], key["user_name"])]
+
+    for key in deleted_keys:
+        key["success"] = key["mail_queued"]
+
+    # Keys that could not be deleted or added back are reported as batch item failures
+    failed_keys = [key for key in keys if not key["ak_deleted"]]
+    with metrics.timed("add_back"):
+        results = run_in_parallel(add_key_back, failed_keys)
+    for key, added_back in zip(failed_keys, results):
+        key["success"] = added_back
+
+    outbox_stats = outbox.drain()
+
+    logger.info("%s of %s key(s) deleted", len(deleted_keys), len(keys))
+    metrics.count("KeysDeleted", len(deleted_keys))
+    metrics.count("KeysAddedBack", len([key for key in failed_keys if key["success"]]))
+    metrics.count(
+        "EncKeysDeleted", len([key for key in enc_keys if key["enc_key_deleted"]])
+    )
+    metrics.count("MailsSent", outbox_stats["sent"])
+    metrics.count("MailsFailed", outbox_stats["failed"])
+    return keys
 
 
 def handler(event, context):
     """
-    Lambda entrypoint function
+    Lambda entrypoint function. Returns the sequence numbers of failed records
+    so that only those are retried by the event source mapping
     """
     if IAM_KEY_ROTATOR_TABLE is None:
         logger.error(
@@ -217,4 +614,17 @@ def handler(event, context):
     elif MAIL_FROM is None:
         logger.error("MAIL_FROM is required. Current value: %s", MAIL_FROM)
     else:
-        destroy_user_keys(event["Records"])
+        global run_context
+        run_context = context
+        shared_functions.reset_account_info_stats()
+        metrics.reset()
+        keys = destroy_user_keys(event["Records"])
+        shared_functions.log_account_info_stats()
+        metrics.emit(FUNCTION_NAME)
+        return {
+            "batchItemFailures": [
+                {"itemIdentifier": key["sequence_number"]}
+                for key in keys
+                if not key["success"]
+            ]
+        }
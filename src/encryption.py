@@ -2,56 +2,154 @@
 Encrypt key pair shared with user
 """
 
-import logging
-import sys
 import os
-from cryptography.fernet import Fernet
-
-import boto3
+import time
+import queue
+import base64
+import logging
+import threading
+import contextvars
 
 from botocore.exceptions import ClientError
 
-ssm = boto3.client("ssm", region_name=os.environ.get("AWS_REGION"))
+import shared_functions
+import metrics
+
+# Where the encryption key is kept. ssm: Fernet key per user stored in SSM parameter,
+# kms: data key per user generated by AWS KMS and shared in encrypted form with the user
+ENCRYPTION_MODE = os.environ.get("ENCRYPTION_MODE", "ssm")
+
+# KMS key used for generating data keys. Required if encryption mode is kms
+KMS_KEY_ID = os.environ.get("KMS_KEY_ID", None)
+
+# Maximum no. of SSM parameters to create per second
+SSM_PUT_RATE = float(os.environ.get("SSM_PUT_RATE", 3))
+
+# No. of threads encrypting key pairs in parallel
+ENCRYPTION_WORKERS = int(os.environ.get("ENCRYPTION_WORKERS", 2))
+
+# Maximum no. of key pairs waiting to be encrypted. Key creation waits when the queue is full
+ENCRYPTION_QUEUE_SIZE = int(os.environ.get("ENCRYPTION_QUEUE_SIZE", 20))
+
+# No. of seconds encrypting a key pair is assumed to take until the first one is encrypted
+DEFAULT_ENCRYPT_SECS = 0.1
+
 
 logger = logging.getLogger("encryption")
 logger.setLevel(logging.INFO)
 
+_STOP = object()
+
+
+class RateLimiter:
+    """
+    Spaces calls so that no more than rate calls are made per second.
+    Rate is halved when a call is throttled and slowly raised back after successful calls
+    """
+
+    def __init__(self, rate, min_rate=0.5):
+        self.max_rate = rate
+        self.min_rate = min(min_rate, rate)
+        self.rate = rate
+        self._next_call_at = 0.0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        """
+        Wait for the next call slot
+        """
+        with self._lock:
+            now = time.monotonic()
+            call_at = max(now, self._next_call_at)
+            self._next_call_at = call_at + (1 / self.rate)
+
+        if call_at > now:
+            time.sleep(call_at - now)
+
+    def on_success(self):
+        """
+        Raise rate after a successful call
+        """
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate + 0.1)
+
+    def on_throttle(self):
+        """
+        Halve rate after a throttled call
+        """
+        with self._lock:
+            self.rate = max(self.min_rate, self.rate / 2)
+            metrics.count("SsmThrottleRetries")
+            logger.warning("SSM calls throttled. Reducing rate to %.1f/s", self.rate)
+
+
+ssm_limiter = RateLimiter(SSM_PUT_RATE)
+
+# Throttled KMS calls are retried with backoff
+kms_concurrency = shared_functions.AdaptiveConcurrency(
+    "kms", ENCRYPTION_WORKERS, 1, ENCRYPTION_WORKERS
+)
+
 
 def store_in_ssm(user_name, encryption_key):
     """
     Store encryption key in SSM
     """
-    try:
-        logger.info(
-            "Creating SSM parameter to store encryption key for %s user", user_name
-        )
-        ssm.put_parameter(
-            Name=f"/ikr/secret/iam/{user_name}",
-            Description=f"Encryption key used to encrypt access key pair of {user_name} user",
-            Value=encryption_key,
-            Type="SecureString",
-            Overwrite=True,
-        )
-        logger.info("SSM parameter created for %s user", user_name)
-    except ClientError as ce:
-        logger.error(
-            "Failed to create SSM parameter to store encryption key for %s user. Reason: %s",
-            user_name,
-            ce,
-        )
-        return False
+    logger.info("Creating SSM parameter to store encryption key for %s user", user_name)
+    attempt = 1
+    while True:
+        ssm_limiter.wait()
+        try:
+            shared_functions.get_client("ssm").put_parameter(
+                Name=f"/ikr/secret/iam/{user_name}",
+                Description=f"Encryption key used to encrypt access key pair of {user_name} user",
+                Value=encryption_key,
+                Type="SecureString",
+                Overwrite=True,
+            )
+        except ClientError as ce:
+            if (
+                shared_functions.is_throttling_error(ce)
+                and attempt < shared_functions.API_MAX_ATTEMPTS
+            ):
+                ssm_limiter.on_throttle()
+                attempt += 1
+                continue
 
-    return True
+            logger.error(
+                "Failed to create SSM parameter to store encryption key for %s user. Reason: %s",
+                user_name,
+                ce,
+            )
+            return False
 
+        ssm_limiter.on_success()
+        logger.info("SSM parameter created for %s user", user_name)
+        return True
 
-def encrypt(user_name, access_key, secret_access_key):
+
+def generate_data_key(user_name):
     """
-    Encrypt access key pair
+    Generate data key bound to the user using KMS. Returns the Fernet key
+    and the encrypted data key which is shared with the user
     """
-    encryption_key = Fernet.generate_key().decode("utf-8")
+    resp = kms_concurrency.call(
+        shared_functions.get_client("kms").generate_data_key,
+        KeyId=KMS_KEY_ID,
+        KeySpec="AES_256",
+        EncryptionContext={"ikr:user": user_name},
+    )
+    return (
+        base64.urlsafe_b64encode(resp["Plaintext"]).decode("utf-8"),
+        base64.b64encode(resp["CiphertextBlob"]).decode("utf-8"),
+    )
+
 
-    if not store_in_ssm(user_name, encryption_key):
-        sys.exit(1)
+def encrypt_with_key(encryption_key, access_key, secret_access_key):
+    """
+    Encrypt access key pair using Fernet key
+    """
+    from cryptography.fernet import Fernet
 
     f = Fernet(encryption_key)
     encrypted_access_key = f.encrypt(access_key.encode("utf-8")).decode("utf-8")
@@ -60,3 +158,158 @@ def encrypt(user_name, access_key, secret_access_key):
     )
 
     return encrypted_access_key, encrypted_secret_access_key
+
+
+def encrypt(user_name, access_key, secret_access_key):
+    """
+    Encrypt access key pair. Returns encrypted access key, encrypted secret key
+    and encrypted data key (kms mode only), or None if the key pair could not be encrypted
+    """
+    if ENCRYPTION_MODE == "kms":
+        try:
+            encryption_key, encrypted_data_key = generate_data_key(user_name)
+        except ClientError as ce:
+            logger.error(
+                "Failed to generate data key for %s user. Reason: %s", user_name, ce
+            )
+            return None
+    else:
+        from cryptography.fernet import Fernet
+
+        encryption_key = Fernet.generate_key().decode("utf-8")
+        encrypted_data_key = None
+        if not store_in_ssm(user_name, encryption_key):
+            return None
+
+    return (
+        *encrypt_with_key(encryption_key, access_key, secret_access_key),
+        encrypted_data_key,
+    )
+
+
+class EncryptionEngine:
+    """
+    Encrypts key pairs in background threads so that IAM calls are not held up
+    by encryption and SSM writes. Each job is a dict with user_name, access_key
+    and secret_key. on_encrypted is called with the job and the result of
+    encrypt, on_failed is called with the job and the reason of failure.
+    Jobs are failed without encryption once should_stop returns True
+    """
+
+    def __init__(
+        self,
+        on_encrypted,
+        on_failed,
+        should_stop,
+        workers=ENCRYPTION_WORKERS,
+        queue_size=ENCRYPTION_QUEUE_SIZE,
+    ):
+        self.on_encrypted = on_encrypted
+        self.on_failed = on_failed
+        self.should_stop = should_stop
+        self.workers = workers
+        self.stats = {"encrypted": 0, "failed": 0}
+        self._pending = 0
+        self._queue = queue.Queue(queue_size)
+        self._stats_lock = threading.Lock()
+        self._threads = []
+        self._started_at = None
+        self._busy_secs = 0.0
+
+    def start(self):
+        """
+        Start encryption threads
+        """
+        self._started_at = time.monotonic()
+        for _ in range(self.workers):
+            thread = threading.Thread(target=self._run, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, job):
+        """
+        Queue key pair for encryption. Waits if the queue is full. The job is
+        processed in the account scope of the caller
+        """
+        with self._stats_lock:
+            self._pending += 1
+        self._queue.put((contextvars.copy_context(), job))
+
+    def backlog_secs(self, extra=0):
+        """
+        Estimate no. of seconds needed to encrypt the key pairs not processed yet,
+        along with extra key pairs about to be submitted
+        """
+        with self._stats_lock:
+            pending = self._pending + extra
+            processed = self.stats["encrypted"] + self.stats["failed"]
+            busy_secs = self._busy_secs
+
+        if ENCRYPTION_MODE == "ssm":
+            # SSM parameters are created at the rate of the limiter whatever the no. of workers
+            return pending / ssm_limiter.rate
+        per_job_secs = busy_secs / processed if processed > 0 else DEFAULT_ENCRYPT_SECS
+        return pending * per_job_secs / self.workers
+
+    def drain(self):
+        """
+        Wait for all the queued key pairs to be processed and stop encryption threads
+        """
+        for _ in self._threads:
+            self._queue.put(_STOP)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+        metrics.record_pool(
+            "encryption",
+            self.workers,
+            time.monotonic() - self._started_at,
+            self._busy_secs,
+        )
+
+        logger.info(
+            "Key pairs encrypted: %s, failed: %s",
+            self.stats["encrypted"],
+            self.stats["failed"],
+        )
+        return self.stats
+
+    def _count(self, stat):
+        with self._stats_lock:
+            self.stats[stat] += 1
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is _STOP:
+                return
+
+            context, job = item
+            started_at = time.monotonic()
+            try:
+                context.run(self._process, job)
+            except Exception as ex:
+                logger.error(
+                    "Failed to process key pair of %s user. Reason: %s",
+                    job["user_name"],
+                    ex,
+                )
+            finally:
+                with self._stats_lock:
+                    self._pending -= 1
+                    self._busy_secs += time.monotonic() - started_at
+
+    def _process(self, job):
+        if self.should_stop():
+            self._count("failed")
+            self.on_failed(job, "run is about to time out")
+            return
+
+        with metrics.timed("encrypt"):
+            result = encrypt(job["user_name"], job["access_key"], job["secret_key"])
+        if result is None:
+            self._count("failed")
+            self.on_failed(job, "key pair could not be encrypted")
+        else:
+            self._count("encrypted")
+            self.on_encrypted(job, result)
@@ -3,12 +3,17 @@ Send email via Mailgun service
 """
 
 import os
+import json
+import time
 import logging
+import threading
 import requests
-import boto3
 
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
-ssm = boto3.client("ssm", region_name=os.environ.get("AWS_REGION"))
+import shared_functions
+import metrics
 
 # Mailgun API URL for sending email
 MAILGUN_API_URL = os.environ.get("MAILGUN_API_URL", None)
@@ -16,15 +21,53 @@ MAILGUN_API_URL = os.environ.get("MAILGUN_API_URL", None)
 # Name of SSM Parameter which holds Mailgun API key
 MAILGUN_API_KEY_NAME = os.environ.get("MAILGUN_API_KEY_NAME", None)
 
+# No. of seconds to wait for Mailgun API to respond
+MAILGUN_TIMEOUT_SECS = float(os.environ.get("MAILGUN_TIMEOUT_SECS", 3))
+
+# Maximum no. of recipients Mailgun accepts in a single batch sending call
+MAILGUN_BATCH_SIZE = 1000
+
 logger = logging.getLogger("mailgun-mailer")
 logger.setLevel(logging.INFO)
 
+_session = None
+_session_lock = threading.Lock()
 
-def send_email(
-    mail_to, user_name, mail_subject, mail_from, mail_body_plain, mail_body_html
-):
+
+def get_session():
     """
-    Trigger Mailgun API via REST to send email
+    Return HTTP session shared by all the calls to Mailgun API so that
+    connections are kept alive. Only the requests Mailgun surely did not accept
+    are retried, i.e. failed connections and rate limited responses, as sending
+    a message is not idempotent. Other failures are left to the caller
+    """
+    global _session
+
+    with _session_lock:
+        if _session is None:
+            retry = Retry(
+                total=3,
+                connect=3,
+                read=0,
+                other=0,
+                backoff_factor=0.5,
+                status_forcelist=[429],
+                allowed_methods=["POST"],
+                respect_retry_after_header=True,
+            )
+            adapter = HTTPAdapter(
+                pool_connections=1, pool_maxsize=10, max_retries=retry
+            )
+            _session = requests.Session()
+            _session.mount("https://", adapter)
+            _session.mount("http://", adapter)
+
+    return _session
+
+
+def is_configured():
+    """
+    Checks if all the settings required by Mailgun are present
     """
     if MAILGUN_API_URL is None or MAILGUN_API_KEY_NAME is None:
         logger.error(
@@ -34,31 +77,147 @@ def send_email(
         )
         return False
 
-    logger.info("Fetching Mailgun API key from SSM")
-    resp = ssm.get_parameter(Name=MAILGUN_API_KEY_NAME, WithDecryption=True)
-    api_key = resp["Parameter"]["Value"]
+    return True
+
+
+def retry_count(resp):
+    """
+    Return no. of times the request was retried by the session
+    """
+    retries = getattr(resp.raw, "retries", None)
+    return 0 if retries is None else len(retries.history)
+
+
+def post_message(data):
+    """
+    Call Mailgun messages API and return the response message if mail was queued
+    """
+    api_key = shared_functions.get_secret(MAILGUN_API_KEY_NAME)
+
+    started_at = time.monotonic()
+    try:
+        resp = get_session().post(
+            MAILGUN_API_URL,
+            auth=("api", api_key),
+            timeout=MAILGUN_TIMEOUT_SECS,
+            data=data,
+        )
+    except requests.RequestException as ex:
+        metrics.record_api_call(
+            "mailgun",
+            "SendMessage",
+            (time.monotonic() - started_at) * 1000,
+            error_code=type(ex).__name__,
+        )
+        raise
+
+    metrics.record_api_call(
+        "mailgun",
+        "SendMessage",
+        (time.monotonic() - started_at) * 1000,
+        retry_count(resp),
+        str(resp.status_code) if resp.status_code >= 300 else None,
+        resp.status_code == 429,
+    )
+    if resp.status_code == 401:
+        logger.error("Mailgun rejected the API key")
+        shared_functions.invalidate_secret(MAILGUN_API_KEY_NAME)
+        return False, "Unauthorized"
+
+    resp_body = resp.json()
+    if "message" in resp_body and resp_body["message"] == "Queued. Thank you.":
+        return True, resp_body["message"]
+
+    return False, resp_body.get("message")
+
+
+@metrics.timed("mail")
+def send_email(
+    mail_to, user_name, mail_subject, mail_from, mail_body_plain, mail_body_html
+):
+    """
+    Trigger Mailgun API via REST to send email
+    """
+    if not is_configured():
+        return False
 
     logger.info("Sending mail to %s (%s) via Mailgun", user_name, mail_to)
-    resp = requests.post(
-        MAILGUN_API_URL,
-        auth=("api", api_key),
-        timeout=3,
-        data={
+    queued, message = post_message(
+        {
             "from": mail_from,
             "to": [mail_to],
             "subject": mail_subject,
             "text": mail_body_plain,
             "html": mail_body_html,
-        },
+        }
     )
-    resp_body = resp.json()
 
-    if "message" in resp_body and resp_body["message"] == "Queued. Thank you.":
+    if queued:
         logger.info("Mail sent to %s (%s) via Mailgun", user_name, mail_to)
     else:
         logger.error(
             "Mailgun was unable to send mail to %s (%s). Reason: %s",
             user_name,
             mail_to,
-            resp_body["message"],
+            message,
         )
+    return queued
+
+
+def split_batches(recipients):
+    """
+    Split recipients into batches accepted by Mailgun. Recipient variables are
+    keyed by mail address so an address can appear only once in a batch
+    """
+    batches = []
+    for mail_to, variables in recipients:
+        for batch in batches:
+            if len(batch) < MAILGUN_BATCH_SIZE and mail_to not in batch:
+                batch[mail_to] = variables
+                break
+        else:
+            batches.append({mail_to: variables})
+
+    return batches
+
+
+@metrics.timed("mail")
+def send_batch_email(
+    recipients, mail_subject, mail_from, mail_body_plain, mail_body_html
+):
+    """
+    Send the same templated mail to multiple recipients using Mailgun batch sending.
+    recipients is a list of mail address and variables used in the template as
+    %recipient.VARIABLE%. Returns the list of mail addresses the mail could not be sent to
+    """
+    if not is_configured():
+        return [mail_to for mail_to, _ in recipients]
+
+    failed = []
+    for batch in split_batches(recipients):
+        logger.info("Sending mail to %s recipient(s) via Mailgun", len(batch))
+        try:
+            queued, message = post_message(
+                {
+                    "from": mail_from,
+                    "to": list(batch),
+                    "subject": mail_subject,
+                    "text": mail_body_plain,
+                    "html": mail_body_html,
+                    "recipient-variables": json.dumps(batch),
+                }
+            )
+        except requests.RequestException as ex:
+            queued, message = False, ex
+
+        if queued:
+            logger.info("Mail sent to %s recipient(s) via Mailgun", len(batch))
+        else:
+            logger.error(
+                "Mailgun was unable to send mail to %s recipient(s). Reason: %s",
+                len(batch),
+                message,
+            )
+            failed.extend(batch)
+
+    return failed
@@ -0,0 +1,284 @@
+"""
+Collects metrics of a single invocation and emits them in CloudWatch
+Embedded Metric Format (EMF) along with a summary record
+"""
+
+import os
+import sys
+import json
+import time
+import threading
+from contextlib import contextmanager
+
+# Whether to emit metrics at the end of each invocation
+METRICS_ENABLED = os.environ.get("METRICS_ENABLED", "true") == "true"
+
+# CloudWatch namespace under which the metrics are published
+METRICS_NAMESPACE = os.environ.get("METRICS_NAMESPACE", "IAMKeyRotator")
+
+# Upper bounds of API call latency histogram buckets in milliseconds
+LATENCY_BUCKETS_MS = [5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000]
+
+_lock = threading.Lock()
+_started_at = time.monotonic()
+_api_calls = {}
+_phases = {}
+_pools = {}
+_counters = {}
+
+
+def reset():
+    """
+    Clear metrics at the start of an invocation
+    """
+    global _started_at
+
+    with _lock:
+        _started_at = time.monotonic()
+        _api_calls.clear()
+        _phases.clear()
+        _pools.clear()
+        _counters.clear()
+
+
+def record_api_call(
+    service, operation, latency_ms, retries=0, error_code=None, throttled=False
+):
+    """
+    Record latency and outcome of an API call, including the retries made by the SDK
+    """
+    bucket = len(LATENCY_BUCKETS_MS)
+    for i, upper_bound in enumerate(LATENCY_BUCKETS_MS):
+        if latency_ms <= upper_bound:
+            bucket = i
+            break
+
+    with _lock:
+        stats = _api_calls.setdefault(
+            (service, operation),
+            {
+                "calls": 0,
+                "errors": 0,
+                "throttles": 0,
+                "retries": 0,
+                "total_ms": 0.0,
+                "max_ms": 0.0,
+                "buckets": [0] * (len(LATENCY_BUCKETS_MS) + 1),
+            },
+        )
+        stats["calls"] += 1
+        stats["retries"] += retries
+        stats["total_ms"] += latency_ms
+        stats["max_ms"] = max(stats["max_ms"], latency_ms)
+        stats["buckets"][bucket] += 1
+        if error_code is not None:
+            stats["errors"] += 1
+        if throttled:
+            stats["throttles"] += 1
+
+
+def add_phase_time(phase, secs):
+    """
+    Add time spent in a phase. Time spent by parallel threads adds up
+    """
+    with _lock:
+        stats = _phases.setdefault(phase, {"secs": 0.0, "count": 0})
+        stats["secs"] += secs
+        stats["count"] += 1
+
+
+@contextmanager
+def timed(phase):
+    """
+    Measure time spent in the block as part of the given phase
+    """
+    started_at = time.monotonic()
+    try:
+        yield
+    finally:
+        add_phase_time(phase, time.monotonic() - started_at)
+
+
+def record_pool(pool, workers, wall_secs, busy_secs):
+    """
+    Record how busy the workers of a thread pool were while it was running
+    """
+    with _lock:
+        stats = _pools.setdefault(pool, {"capacity_secs": 0.0, "busy_secs": 0.0})
+        stats["capacity_secs"] += workers * wall_secs
+        stats["busy_secs"] += busy_secs
+
+
+def count(name, value=1):
+    """
+    Increase counter of the invocation, e.g. no. of rotated keys
+    """
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + value
+
+
+def percentile(stats, fraction):
+    """
+    Return upper bound of the histogram bucket holding the given fraction of calls
+    """
+    target = stats["calls"] * fraction
+    seen = 0
+    for i, calls in enumerate(stats["buckets"]):
+        seen += calls
+        if seen >= target and i < len(LATENCY_BUCKETS_MS):
+            return min(LATENCY_BUCKETS_MS[i], round(stats["max_ms"], 1))
+    return round(stats["max_ms"], 1)
+
+
+def emf_record(dimensions, metrics):
+    """
+    Build EMF record. metrics is a list of name, unit and value
+    """
+    return {
+        "_aws": {
+            "Timestamp": round(time.time() * 1000),
+            "CloudWatchMetrics": [
+                {
+                    "Namespace": METRICS_NAMESPACE,
+                    "Dimensions": [list(dimensions)],
+                    "Metrics": [
+                        {"Name": name, "Unit": unit} for name, unit, _ in metrics
+                    ],
+                }
+            ],
+        },
+        **dimensions,
+        **{name: value for name, _, value in metrics},
+    }
+
+
+def api_call_counts():
+    """
+    Return no. of API calls made so far per service and operation
+    """
+    with _lock:
+        return {
+            f"{service}:{operation}": stats["calls"]
+            for (service, operation), stats in sorted(_api_calls.items())
+        }
+
+
+def average_latency_ms(service):
+    """
+    Return average latency of the calls made so far to the service, None if no call was made
+    """
+    with _lock:
+        calls = [stats for (s, _), stats in _api_calls.items() if s == service]
+        count = sum(stats["calls"] for stats in calls)
+        if count == 0:
+            return None
+        return sum(stats["total_ms"] for stats in calls) / count
+
+
+def build_records(function_name):
+    """
+    Return EMF records and the summary record of the invocation
+    """
+    with _lock:
+        duration_secs = time.monotonic() - _started_at
+        records = [
+            emf_record(
+                {"FunctionName": function_name},
+                [("Duration", "Seconds", round(duration_secs, 3))]
+                + [(name, "Count", value) for name, value in sorted(_counters.items())],
+            )
+        ]
+        summary = {
+            "function": function_name,
+            "duration_secs": round(duration_secs, 3),
+            "counters": dict(_counters),
+            "phases": {},
+            "pools": {},
+            "api_calls": {},
+        }
+
+        for phase, stats in sorted(_phases.items()):
+            records.append(
+                emf_record(
+                    {"FunctionName": function_name, "Phase": phase},
+                    [
+                        ("PhaseDuration", "Seconds", round(stats["secs"], 3)),
+                        ("PhaseCount", "Count", stats["count"]),
+                    ],
+                )
+            )
+            summary["phases"][phase] = {
+                "secs": round(stats["secs"], 3),
+                "count": stats["count"],
+            }
+
+        for pool, stats in sorted(_pools.items()):
+            utilization = (
+                100 * stats["busy_secs"] / stats["capacity_secs"]
+                if stats["capacity_secs"] > 0
+                else 0
+            )
+            records.append(
+                emf_record(
+                    {"FunctionName": function_name, "Pool": pool},
+                    [("WorkerUtilization", "Percent", round(utilization, 1))],
+                )
+            )
+            summary["pools"][pool] = {
+                "busy_secs": round(stats["busy_secs"], 3),
+                "utilization_percent": round(utilization, 1),
+            }
+
+        for (service, operation), stats in sorted(_api_calls.items()):
+            records.append(
+                emf_record(
+                    {
+                        "FunctionName": function_name,
+                        "Service": service,
+                        "Operation": operation,
+                    },
+                    [
+                        ("ApiCalls", "Count", stats["calls"]),
+                        ("ApiErrors", "Count", stats["errors"]),
+                        ("ApiThrottles", "Count", stats["throttles"]),
+                        ("ApiRetries", "Count", stats["retries"]),
+                        (
+                            "ApiLatencyAvg",
+                            "Milliseconds",
+                            round(stats["total_ms"] / stats["calls"], 1),
+                        ),
+                        ("ApiLatencyP50", "Milliseconds", percentile(stats, 0.5)),
+                        ("ApiLatencyP99", "Milliseconds", percentile(stats, 0.99)),
+                        ("ApiLatencyMax", "Milliseconds", round(stats["max_ms"], 1)),
+                    ],
+                )
+            )
+            summary["api_calls"][f"{service}:{operation}"] = {
+                "calls": stats["calls"],
+                "errors": stats["errors"],
+                "throttles": stats["throttles"],
+                "retries": stats["retries"],
+                "latency_ms": {
+                    f"le_{upper_bound}": calls
+                    for upper_bound, calls in zip(
+                        LATENCY_BUCKETS_MS + ["inf"], stats["buckets"]
+                    )
+                    if calls > 0
+                },
+            }
+
+    return records, {"ikr_summary": summary}
+
+
+def emit(function_name):
+    """
+    Write EMF records and the summary record of the invocation to stdout,
+    from where lambda ships them to CloudWatch Logs
+    """
+    if not METRICS_ENABLED:
+        return
+
+    records, summary = build_records(function_name)
+    for record in records + [summary]:
+        sys.stdout.write(json.dumps(record) + "\n")
+    sys.stdout.flush()
@@ -0,0 +1,318 @@
+"""
+Outbox which sends notifications in background so that mail latency
+does not hold up key rotation
+"""
+
+import os
+import time
+import queue
+import logging
+import threading
+import contextvars
+from collections import OrderedDict
+
+import metrics
+
+# Maximum no. of threads sending notifications in parallel
+OUTBOX_MAX_WORKERS = int(os.environ.get("OUTBOX_MAX_WORKERS", 5))
+
+# No. of times sending a notification is attempted before giving up
+OUTBOX_MAX_ATTEMPTS = int(os.environ.get("OUTBOX_MAX_ATTEMPTS", 3))
+
+# Maximum no. of notifications waiting to be sent. Queueing waits when the outbox is full
+OUTBOX_QUEUE_SIZE = int(os.environ.get("OUTBOX_QUEUE_SIZE", 100))
+
+# No. of seconds between checks of should_stop while waiting for room in a full queue
+FULL_QUEUE_POLL_SECS = 0.1
+
+# No. of seconds to wait before the first retry, doubled on every attempt
+OUTBOX_RETRY_DELAY_SECS = float(os.environ.get("OUTBOX_RETRY_DELAY_SECS", 1))
+
+# No. of seconds sending a batch of notifications is assumed to take until the first one is sent
+DEFAULT_SEND_SECS = 0.5
+
+# No. of notification ids remembered for de-duplication within a lambda container
+OUTBOX_DEDUP_SIZE = 10000
+
+logger = logging.getLogger("notification-outbox")
+logger.setLevel(logging.INFO)
+
+_STOP = object()
+
+# Notification ids already queued, kept across warm invocations so that
+# retried stream records do not send the same mail twice
+_seen_ids = OrderedDict()
+_seen_ids_lock = threading.Lock()
+
+
+def is_duplicate(notification_id):
+    """
+    Checks if notification with the same id was already queued and remembers the id
+    """
+    with _seen_ids_lock:
+        if notification_id in _seen_ids:
+            return True
+        _seen_ids[notification_id] = True
+        if len(_seen_ids) > OUTBOX_DEDUP_SIZE:
+            _seen_ids.popitem(last=False)
+    return False
+
+
+def forget(notification_id):
+    """
+    Forget notification id so that the notification can be queued again
+    """
+    with _seen_ids_lock:
+        _seen_ids.pop(notification_id, None)
+
+
+def time_left(deadline):
+    """
+    Return no. of seconds left before the deadline, None if there is no deadline
+    """
+    if deadline is None:
+        return None
+    return max(0, deadline - time.monotonic())
+
+
+class NotificationOutbox:
+    """
+    Bounded in-process queue of notification records. Each record is a dict
+    with a unique id. Records are sent by dispatcher threads using send_one, or
+    in batches of batch_size using send_many when provided. Both return the
+    records which could not be sent so that they are retried. Once should_stop
+    returns True, queued records are no longer sent. on_sent is called with each
+    sent record and on_undelivered with each record which could not be sent,
+    in the context of the caller which queued the record
+    """
+
+    def __init__(
+        self,
+        send_one,
+        send_many=None,
+        batch_size=1,
+        max_workers=OUTBOX_MAX_WORKERS,
+        max_attempts=OUTBOX_MAX_ATTEMPTS,
+        should_stop=None,
+        on_sent=None,
+        on_undelivered=None,
+        queue_size=OUTBOX_QUEUE_SIZE,
+    ):
+        self.send_one = send_one
+        self.send_many = send_many
+        self.batch_size = batch_size if send_many is not None else 1
+        self.max_workers = max_workers
+        self.max_attempts = max_attempts
+        self.should_stop = should_stop
+        self.on_sent = on_sent
+        self.on_undelivered = on_undelivered
+        self.stats = {"queued": 0, "duplicates": 0, "sent": 0, "failed": 0, "unsent": 0}
+        self._queue = queue.Queue(queue_size)
+        self._stats_lock = threading.Lock()
+        self._workers = []
+        self._started_at = None
+        self._busy_secs = 0.0
+        self._batches = 0
+
+    def start(self):
+        """
+        Start dispatcher threads
+        """
+        self._started_at = time.monotonic()
+        for _ in range(self.max_workers):
+            worker = threading.Thread(target=self._dispatch, daemon=True)
+            worker.start()
+            self._workers.append(worker)
+
+    def enqueue(self, record):
+        """
+        Queue notification record unless the same notification was already queued.
+        Waits if the queue is full, until should_stop returns True
+        """
+        if is_duplicate(record["id"]):
+            logger.info("Skipping duplicate notification %s", record["id"])
+            self._count("duplicates", 1)
+            return
+
+        self._count("queued", 1)
+        context = contextvars.copy_context()
+        while True:
+            try:
+                self._queue.put((context, record), timeout=FULL_QUEUE_POLL_SECS)
+                return
+            except queue.Full:
+                if self._stopping():
+                    self._leave_unsent(context, record)
+                    return
+
+    def backlog_secs(self, extra=0):
+        """
+        Estimate no. of seconds needed to send the notifications not processed yet,
+        along with extra notifications about to be queued
+        """
+        with self._stats_lock:
+            done = self.stats["sent"] + self.stats["failed"] + self.stats["unsent"]
+            pending = self.stats["queued"] - done + extra
+            batches = self._batches
+            busy_secs = self._busy_secs
+
+        per_batch_secs = busy_secs / batches if batches > 0 else DEFAULT_SEND_SECS
+        pending_batches = -(-pending // self.batch_size)
+        return pending_batches * per_batch_secs / self.max_workers
+
+    def drain(self, timeout=None):
+        """
+        Wait for all the queued notifications to be sent and stop dispatcher threads.
+        Once timeout seconds pass, notifications still queued are left unsent and
+        threads still sending are not waited for
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        try:
+            for _ in self._workers:
+                self._queue.put(_STOP, timeout=time_left(deadline))
+            for worker in self._workers:
+                worker.join(time_left(deadline))
+        except queue.Full:
+            pass
+
+        sending = sum(1 for worker in self._workers if worker.is_alive())
+        if sending > 0:
+            logger.warning(
+                "Not waiting for %s notification thread(s) which are still sending",
+                sending,
+            )
+            self._leave_queued()
+        self._workers = []
+        metrics.record_pool(
+            "outbox",
+            self.max_workers,
+            time.monotonic() - self._started_at,
+            self._busy_secs,
+        )
+
+        logger.info(
+            "Notifications queued: %s, sent: %s, failed: %s, left unsent: %s, duplicates skipped: %s",
+            self.stats["queued"],
+            self.stats["sent"],
+            self.stats["failed"],
+            self.stats["unsent"],
+            self.stats["duplicates"],
+        )
+        return self.stats
+
+    def _leave_queued(self):
+        while True:
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                return
+            if item is not _STOP:
+                self._leave_unsent(*item)
+
+    def _leave_unsent(self, context, record):
+        logger.warning(
+            "Leaving notification %s unsent as the run is about to end", record["id"]
+        )
+        self._count("unsent", 1)
+        forget(record["id"])
+        self._notify(context, self.on_undelivered, record)
+
+    def _count(self, stat, count):
+        with self._stats_lock:
+            self.stats[stat] += count
+
+    def _stopping(self):
+        return self.should_stop is not None and self.should_stop()
+
+    def _next_batch(self):
+        """
+        Return next batch of queued (context, record) pairs and whether the
+        stop marker for this thread was reached
+        """
+        item = self._queue.get()
+        if item is _STOP:
+            return [], True
+
+        batch = [item]
+        while len(batch) < self.batch_size:
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is _STOP:
+                # Stop once the batch is sent
+                return batch, True
+            batch.append(item)
+        return batch, False
+
+    def _send(self, records):
+        try:
+            if self.send_many is not None:
+                return self.send_many(records)
+            return [r for r in records if not self.send_one(r)]
+        except Exception as ex:
+            logger.error(
+                "Failed to send %s notification(s). Reason: %s", len(records), ex
+            )
+            return records
+
+    def _dispatch(self):
+        while True:
+            batch, stop = self._next_batch()
+            if len(batch) > 0:
+                self._deliver(batch)
+            if stop:
+                return
+
+    def _deliver(self, batch):
+        started_at = time.monotonic()
+        pending = [record for _, record in batch]
+        attempts = 0
+        while attempts < self.max_attempts and not self._stopping():
+            attempts += 1
+            pending = self._send(pending)
+            if len(pending) == 0 or attempts == self.max_attempts:
+                break
+            logger.info(
+                "Retrying %s notification(s) (attempt %s of %s)",
+                len(pending),
+                attempts + 1,
+                self.max_attempts,
+            )
+            time.sleep(OUTBOX_RETRY_DELAY_SECS * 2 ** (attempts - 1))
+
+        with self._stats_lock:
+            self.stats["sent"] += len(batch) - len(pending)
+            if attempts == self.max_attempts:
+                self.stats["failed"] += len(pending)
+            else:
+                self.stats["unsent"] += len(pending)
+            if attempts > 0:
+                self._batches += 1
+                self._busy_secs += time.monotonic() - started_at
+
+        unsent_ids = {record["id"] for record in pending}
+        for context, record in batch:
+            if record["id"] not in unsent_ids:
+                self._notify(context, self.on_sent, record)
+                continue
+
+            if attempts == self.max_attempts:
+                logger.error("Giving up on notification %s", record["id"])
+            else:
+                logger.warning(
+                    "Leaving notification %s unsent as the run is about to end",
+                    record["id"],
+                )
+            forget(record["id"])
+            self._notify(context, self.on_undelivered, record)
+
+    def _notify(self, context, callback, record):
+        if callback is None:
+            return
+        try:
+            context.run(callback, record)
+        except Exception as ex:
+            logger.error(
+                "Failed to process notification %s. Reason: %s", record["id"], ex
+            )
@@ -2,16 +2,49 @@
 Send email via AWS SES service
 """
 
-import os
+import json
+import time
 import logging
-import boto3
+import threading
 
-ses = boto3.client("ses", region_name=os.environ.get("AWS_REGION"))
+from botocore.exceptions import ClientError
+
+import metrics
+import shared_functions
+
+# Maximum no. of destinations SES accepts in a single SendBulkTemplatedEmail call
+SES_BULK_BATCH_SIZE = 50
 
 logger = logging.getLogger("ses-mailer")
 logger.setLevel(logging.INFO)
 
+_registered_templates = set()
+_send_rate = None
+_next_send_at = 0.0
+_lock = threading.Lock()
+
+
+def wait_for_send_rate(mail_count):
+    """
+    Wait so that mails are sent within the SES maximum send rate of the account
+    """
+    global _send_rate, _next_send_at
+
+    with _lock:
+        if _send_rate is None:
+            quota = shared_functions.get_client("ses").get_send_quota()
+            _send_rate = quota["MaxSendRate"]
+            logger.info("SES maximum send rate: %s mail(s) per second", _send_rate)
 
+        now = time.monotonic()
+        send_at = max(now, _next_send_at)
+        _next_send_at = send_at + (mail_count / _send_rate)
+
+    if send_at > now:
+        time.sleep(send_at - now)
+
+
+@metrics.timed("mail")
 def send_email(
     mail_to, user_name, mail_subject, mail_from, mail_body_plain, mail_body_html
 ):
@@ -19,7 +52,7 @@ def send_email(
     Use AWS SDK to send email via SES
     """
     logger.info("Sending mail to %s (%s) via AWS SES", user_name, mail_to)
-    ses.send_email(
+    shared_functions.get_client("ses").send_email(
         Source=f"{mail_from}",
         Destination={"ToAddresses": [mail_to]},
         Message={
@@ -31,3 +64,90 @@ def send_email(
         },
     )
     logger.info("Mail sent to %s (%s) via AWS SES", user_name, mail_to)
+    return True
+
+
+def template_placeholders(field_names):
+    """
+    Return SES template placeholder for each field. Triple braces are used
+    so that the values are not HTML escaped, same as the non-templated mails
+    """
+    return {name: "{{{" + name + "}}}" for name in field_names}
+
+
+def ensure_template(template_name, mail_subject, mail_body_plain, mail_body_html):
+    """
+    Create or update SES template once per lambda container
+    """
+    with _lock:
+        if template_name in _registered_templates:
+            return
+
+        template = {
+            "TemplateName": template_name,
+            "SubjectPart": mail_subject,
+            "TextPart": mail_body_plain,
+            "HtmlPart": mail_body_html,
+        }
+        try:
+            shared_functions.get_client("ses").create_template(Template=template)
+            logger.info("SES template %s created", template_name)
+        except ClientError as ce:
+            if ce.response["Error"]["Code"] != "AlreadyExists":
+                raise
+            shared_functions.get_client("ses").update_template(Template=template)
+            logger.info("SES template %s updated", template_name)
+
+        _registered_templates.add(template_name)
+
+
+@metrics.timed("mail")
+def send_bulk_email(template_name, mail_from, destinations, default_template_data):
+    """
+    Send templated mail to multiple recipients using SendBulkTemplatedEmail.
+    destinations is a list of mail address and per recipient template data.
+    Returns the destinations the mail could not be sent to
+    """
+    failed = []
+    for i in range(0, len(destinations), SES_BULK_BATCH_SIZE):
+        batch = destinations[i : i + SES_BULK_BATCH_SIZE]
+        wait_for_send_rate(len(batch))
+
+        logger.info("Sending mail to %s recipient(s) via AWS SES", len(batch))
+        try:
+            resp = shared_functions.get_client("ses").send_bulk_templated_email(
+                Source=mail_from,
+                Template=template_name,
+                DefaultTemplateData=json.dumps(default_template_data),
+                Destinations=[
+                    {
+                        "Destination": {"ToAddresses": [mail_to]},
+                        "ReplacementTemplateData": json.dumps(template_data),
+                    }
+                    for mail_to, template_data in batch
+                ],
+            )
+        except ClientError as ce:
+            logger.error(
+                "AWS SES was unable to send mail to %s recipient(s). Reason: %s",
+                len(batch),
+                ce,
+            )
+            failed.extend(batch)
+            continue
+
+        sent = 0
+        for destination, status in zip(batch, resp["Status"]):
+            if status["Status"] == "Success":
+                sent += 1
+            else:
+                logger.error(
+                    "AWS SES was unable to send mail to %s. Reason: %s",
+                    destination[0],
+                    status.get("Error", status["Status"]),
+                )
+                failed.append(destination)
+
+        logger.info("Mail sent to %s recipient(s) via AWS SES", sent)
+
+    return failed
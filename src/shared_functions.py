@@ -3,22 +3,695 @@ Functions that are required by both creator and destructor modules
 """
 
 import os
+import time
+import random
 import logging
+import threading
+import contextvars
+import concurrent.futures
+from contextlib import contextmanager
+from datetime import datetime, timezone
 import boto3
 
+from botocore.exceptions import ClientError
+
+import metrics
+
 logger = logging.getLogger("shared_functions")
 logger.setLevel(logging.INFO)
 
-iam = boto3.client("iam", region_name=os.environ.get("AWS_REGION"))
+# Minimum no. of IAM calls to run in parallel
+IAM_MIN_WORKERS = int(os.environ.get("IAM_MIN_WORKERS", 1))
+
+# No. of IAM calls to run in parallel when a run starts
+IAM_INITIAL_WORKERS = int(os.environ.get("IAM_INITIAL_WORKERS", 10))
+
+# Maximum no. of IAM calls to run in parallel
+IAM_MAX_WORKERS = int(os.environ.get("IAM_MAX_WORKERS", 32))
+
+# No. of times an API call is attempted before giving up when it is throttled
+API_MAX_ATTEMPTS = int(os.environ.get("API_MAX_ATTEMPTS", 5))
+
+# No. of seconds for which account info is cached within a lambda container
+ACCOUNT_INFO_TTL_SECS = int(os.environ.get("ACCOUNT_INFO_TTL_SECS", 3600))
+
+# Whether to fetch account info while the lambda container is initialised
+PREFETCH_ACCOUNT_INFO = os.environ.get("PREFETCH_ACCOUNT_INFO", "false") == "true"
+
+# No. of seconds for which secrets read from SSM parameter store are cached
+SECRET_CACHE_TTL_SECS = int(os.environ.get("SECRET_CACHE_TTL_SECS", 900))
+
+SECONDS_PER_DAY = 24 * 60 * 60
+
+# Name of the role assumed in each target account in organization mode
+ORGANIZATION_ROLE_NAME = os.environ.get("ORGANIZATION_ROLE_NAME", "iam-key-rotator")
+
+# Services called in the target account in organization mode, all the others are called in the account of the function
+ACCOUNT_SERVICES = {"iam", "ssm"}
+
+# Assumed role credentials are renewed once they expire within these many seconds
+CREDENTIAL_RENEW_SECS = 300
+
+# Maximum no. of items DynamoDB accepts in a single BatchWriteItem call
+DYNAMODB_BATCH_SIZE = 25
+
+# No. of seconds between checks of the background flush of batch writers
+BATCH_FLUSH_POLL_SECS = 0.1
+
+# Error codes returned by AWS services when a request is throttled
+THROTTLING_ERROR_CODES = {
+    "Throttling",
+    "ThrottlingException",
+    "RequestLimitExceeded",
+    "TooManyRequestsException",
+    "ProvisionedThroughputExceededException",
+}
+
+
+def _before_call(context, **kwargs):
+    context["ikr_started_at"] = time.monotonic()
+
+
+def _record_call(event_name, context, retries, error_code):
+    service, operation = event_name.split(".")[1:3]
+    started_at = context.get("ikr_started_at", time.monotonic())
+    metrics.record_api_call(
+        service,
+        operation,
+        (time.monotonic() - started_at) * 1000,
+        retries,
+        error_code,
+        error_code in THROTTLING_ERROR_CODES,
+    )
+
+
+def _after_call(event_name, http_response, parsed, context, **kwargs):
+    _record_call(
+        event_name,
+        context,
+        parsed.get("ResponseMetadata", {}).get("RetryAttempts", 0),
+        parsed.get("Error", {}).get("Code")
+        if http_response.status_code >= 300
+        else None,
+    )
+
+
+def _after_call_error(event_name, exception, context, **kwargs):
+    _record_call(event_name, context, 0, type(exception).__name__)
+
+
+def instrument_client(client):
+    """
+    Record latency, retries and errors of every call made by the boto3 client
+    """
+    client.meta.events.register("before-call", _before_call)
+    client.meta.events.register("after-call", _after_call)
+    client.meta.events.register("after-call-error", _after_call_error)
+    return client
+
+
+_session = None
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+# Target account of the calls made by the current thread, None for the account of the function
+_account = contextvars.ContextVar("account", default=None)
+_account_sessions = {}
+_account_clients = {}
+_account_concurrency = {}
+_account_lock = threading.Lock()
+
+
+def current_account_id():
+    """
+    Return id of the target account of the current thread, None outside organization mode
+    """
+    return _account.get()
+
+
+@contextmanager
+def account_scope(account_id):
+    """
+    Make IAM and SSM calls of the block in the given account using the role
+    assumed in it. None keeps the calls in the account of the function.
+    Threads started by AdaptiveConcurrency and EncryptionEngine inherit the scope
+    """
+    token = _account.set(account_id)
+    try:
+        yield
+    finally:
+        _account.reset(token)
+
+
+def _account_session(account_id):
+    """
+    Return session of the role assumed in the account, assuming the role again
+    when its credentials are about to expire. Called with _account_lock held
+    """
+    cached = _account_sessions.get(account_id)
+    if cached is not None and cached[1] - time.time() > CREDENTIAL_RENEW_SECS:
+        return cached[0]
+
+    logger.info("Assuming %s role in account %s", ORGANIZATION_ROLE_NAME, account_id)
+    credentials = get_client("sts").assume_role(
+        RoleArn=f"arn:aws:iam::{account_id}:role/{ORGANIZATION_ROLE_NAME}",
+        # Session is named after the function so that it can recognise its own events
+        RoleSessionName=os.environ.get("AWS_LAMBDA_FUNCTION_NAME", "iam-key-rotator"),
+    )["Credentials"]
+    session = boto3.session.Session(
+        aws_access_key_id=credentials["AccessKeyId"],
+        aws_secret_access_key=credentials["SecretAccessKey"],
+        aws_session_token=credentials["SessionToken"],
+        region_name=os.environ.get("AWS_REGION"),
+    )
+    _account_sessions[account_id] = (session, credentials["Expiration"].timestamp())
+    # Clients of the expired session are created again
+    for key in [key for key in _account_clients if key[0] == account_id]:
+        _account_clients.pop(key)
+    return session
+
+
+def _account_client(account_id, service):
+    with _account_lock:
+        session = _account_session(account_id)
+        client = _account_clients.get((account_id, service))
+        if client is None:
+            client = instrument_client(session.client(service))
+            _account_clients[(account_id, service)] = client
+        return client
+
+
+def get_client(service):
+    """
+    Return boto3 client of the service. Clients are created from a single
+    session on first use and shared by all the modules. Within an account
+    scope, IAM and SSM clients of the target account are returned
+    """
+    account_id = _account.get()
+    if account_id is not None and service in ACCOUNT_SERVICES:
+        client = _clients.get((account_id, service))
+        if client is not None:
+            return client
+        return _account_client(account_id, service)
+
+    client = _clients.get(service)
+    if client is not None:
+        return client
+
+    global _session
+    with _clients_lock:
+        if service not in _clients:
+            if _session is None:
+                # AWS_REGION is by default available within lambda environment
+                _session = boto3.session.Session(
+                    region_name=os.environ.get("AWS_REGION")
+                )
+            _clients[service] = instrument_client(_session.client(service))
+        return _clients[service]
+
+
+def set_client(service, client, account_id=None):
+    """
+    Use the given client for all the calls to the service, e.g. a stubbed client.
+    With account_id, the client is used within the scope of that account
+    """
+    with _clients_lock:
+        _clients[service if account_id is None else (account_id, service)] = client
+
+
+class RunClock:
+    """
+    Time at which a run started. Key ages and expiry times of the whole run
+    are computed from it so that they stay consistent however long the run takes
+    """
+
+    def __init__(self, now):
+        self.now = now
+        # Epoch seconds of now and of UTC midnight of today
+        self.epoch = round(now.timestamp())
+        self.today = self.epoch - (self.epoch % SECONDS_PER_DAY)
+
+    def age_days(self, moment):
+        """
+        Return no. of whole days passed since the given timezone aware datetime
+        """
+        return (self.now - moment).days
+
+    def age_hours(self, moment):
+        """
+        Return no. of hours passed since the given timezone aware datetime
+        """
+        return (self.now - moment).total_seconds() / 3600
+
+    def days_ago(self, days):
+        """
+        Return epoch seconds of UTC midnight the given no. of days ago
+        """
+        return self.today - days * SECONDS_PER_DAY
+
+    def days_from_today(self, days):
+        """
+        Return epoch seconds of UTC midnight after the given no. of days
+        """
+        return self.today + days * SECONDS_PER_DAY
+
+    def days_from_now(self, days):
+        """
+        Return epoch seconds the given no. of days after now
+        """
+        return self.epoch + days * SECONDS_PER_DAY
+
+
+_fixed_now = None
+_run_clock = None
+
+
+def start_run_clock():
+    """
+    Start clock of a new run. Called once at the start of each invocation
+    """
+    global _run_clock
+    _run_clock = RunClock(_fixed_now or datetime.now(timezone.utc))
+    return _run_clock
+
+
+def run_clock():
+    """
+    Return clock of the current run, starting one if no run is started yet
+    """
+    return _run_clock or start_run_clock()
+
+
+def set_clock_time(now):
+    """
+    Start all the following runs at the given timezone aware datetime, e.g. to
+    make benchmark runs reproducible. None restores the current time
+    """
+    global _fixed_now, _run_clock
+    _fixed_now = now
+    _run_clock = None
+
+
+def is_throttling_error(ex):
+    """
+    Checks if the exception was raised because the request was throttled
+    """
+    return (
+        isinstance(ex, ClientError)
+        and ex.response.get("Error", {}).get("Code") in THROTTLING_ERROR_CODES
+    )
+
+
+class AdaptiveConcurrency:
+    """
+    Limits no. of parallel API calls using AIMD (additive increase, multiplicative decrease).
+    The limit is raised by one after a full window of successful calls and halved
+    when a call is throttled. Throttled calls are retried with jittered exponential backoff
+    """
+
+    def __init__(
+        self,
+        name,
+        initial_workers,
+        min_workers,
+        max_workers,
+        max_attempts=API_MAX_ATTEMPTS,
+        base_delay=0.2,
+        max_delay=5.0,
+    ):
+        self.name = name
+        self.min_workers = max(1, min_workers)
+        self.max_workers = max(self.min_workers, max_workers)
+        self.limit = min(max(initial_workers, self.min_workers), self.max_workers)
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.throttles = 0
+        self.retries = 0
+        self._in_flight = 0
+        self._successes = 0
+        self._last_decrease = 0.0
+        self._cond = threading.Condition()
+
+    def set_max_workers(self, max_workers):
+        """
+        Change maximum no. of parallel calls, e.g. when the rate limits
+        are shared with other invocations
+        """
+        with self._cond:
+            self.max_workers = max(self.min_workers, max_workers)
+            self.limit = min(self.limit, self.max_workers)
+
+    def _acquire(self):
+        with self._cond:
+            while self._in_flight >= self.limit:
+                self._cond.wait()
+            self._in_flight += 1
+
+    def _release(self):
+        with self._cond:
+            self._in_flight -= 1
+            self._cond.notify_all()
+
+    def _on_success(self):
+        with self._cond:
+            self._successes += 1
+            if self._successes >= self.limit and self.limit < self.max_workers:
+                self.limit += 1
+                self._successes = 0
+                self._cond.notify_all()
+
+    def _on_throttle(self):
+        with self._cond:
+            self.throttles += 1
+            self._successes = 0
+            # Calls in flight are throttled together, so decrease only once per window
+            if time.monotonic() - self._last_decrease > self.base_delay:
+                self.limit = max(self.min_workers, self.limit // 2)
+                self._last_decrease = time.monotonic()
+                logger.warning(
+                    "%s calls throttled. Reducing parallel calls to %s",
+                    self.name,
+                    self.limit,
+                )
+
+    def call(self, func, *args, **kwargs):
+        """
+        Call AWS API and retry it with jittered backoff if the request is throttled
+        """
+        attempt = 1
+        while True:
+            try:
+                resp = func(*args, **kwargs)
+            except ClientError as ce:
+                if not is_throttling_error(ce) or attempt >= self.max_attempts:
+                    raise
+                self._on_throttle()
+                self.retries += 1
+                metrics.count(f"{self.name.title()}ThrottleRetries")
+                time.sleep(
+                    random.uniform(0, min(self.max_delay, self.base_delay * 2**attempt))
+                )
+                attempt += 1
+                continue
+
+            # Request succeeded only after being retried by botocore
+            if isinstance(resp, dict) and resp.get("ResponseMetadata", {}).get(
+                "RetryAttempts", 0
+            ):
+                self._on_throttle()
+            else:
+                self._on_success()
+            return resp
+
+    def _run(self, func, busy_secs, *args):
+        self._acquire()
+        started_at = time.monotonic()
+        try:
+            return func(*args)
+        finally:
+            busy_secs.append(time.monotonic() - started_at)
+            self._release()
+
+    def map(self, func, *iterables):
+        """
+        Call func for each item in parallel and return the list of futures.
+        No. of parallel calls is limited by the current limit. Calls run in
+        the account scope of the caller
+        """
+        started_at = time.monotonic()
+        busy_secs = []
+        with concurrent.futures.ThreadPoolExecutor(self.max_workers) as executor:
+            futures = [
+                executor.submit(
+                    contextvars.copy_context().run, self._run, func, busy_secs, *args
+                )
+                for args in zip(*iterables)
+            ]
+        metrics.record_pool(
+            self.name, self.max_workers, time.monotonic() - started_at, sum(busy_secs)
+        )
+        return futures
+
+
+# IAM rate limits are shared by the whole account so a single controller is used
+iam_concurrency = AdaptiveConcurrency(
+    "iam", IAM_INITIAL_WORKERS, IAM_MIN_WORKERS, IAM_MAX_WORKERS
+)
+
+
+def get_iam_concurrency():
+    """
+    Return controller of parallel IAM calls for the current account scope.
+    Each target account has its own IAM rate limits and so its own controller
+    """
+    account_id = _account.get()
+    if account_id is None:
+        return iam_concurrency
+
+    with _account_lock:
+        if account_id not in _account_concurrency:
+            _account_concurrency[account_id] = AdaptiveConcurrency(
+                "iam", IAM_INITIAL_WORKERS, IAM_MIN_WORKERS, IAM_MAX_WORKERS
+            )
+        return _account_concurrency[account_id]
+
+
+class DynamoDBBatchWriter:
+    """
+    Collects items to be put in a DynamoDB table and writes them using
+    BatchWriteItem in groups of DYNAMODB_BATCH_SIZE. Unprocessed items and
+    throttled calls are retried with jittered exponential backoff. Queued
+    items can also be written in background so that they are not held back
+    until the batch is full
+    """
+
+    def __init__(
+        self, client, table_name, max_attempts=API_MAX_ATTEMPTS, base_delay=0.1
+    ):
+        self.client = client
+        self.table_name = table_name
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.written = 0
+        self._pending = []
+        self._lock = threading.Lock()
+        self._flusher = None
+        self._stop_flushing = threading.Event()
+
+    def put(self, item):
+        """
+        Queue item and write a batch as soon as it is full.
+        Returns the items which could not be written
+        """
+        with self._lock:
+            self._pending.append(item)
+            if len(self._pending) < DYNAMODB_BATCH_SIZE:
+                return []
+            batch = self._pending[:DYNAMODB_BATCH_SIZE]
+            del self._pending[:DYNAMODB_BATCH_SIZE]
+
+        return self._write(batch)
+
+    def flush(self):
+        """
+        Write all the queued items. Returns the items which could not be written
+        """
+        with self._lock:
+            items = self._pending[:]
+            self._pending.clear()
+
+        failed = []
+        for i in range(0, len(items), DYNAMODB_BATCH_SIZE):
+            failed.extend(self._write(items[i : i + DYNAMODB_BATCH_SIZE]))
+        return failed
+
+    def start_flushing(self, interval_secs, on_failed, flush_now=None):
+        """
+        Write queued items in background every interval_secs, and right away
+        once flush_now returns True, until stop_flushing is called. Items which
+        could not be written are passed to on_failed
+        """
+        self._stop_flushing.clear()
+        self._flusher = threading.Thread(
+            target=self._flush_periodically,
+            args=(interval_secs, on_failed, flush_now),
+            daemon=True,
+        )
+        self._flusher.start()
+
+    def stop_flushing(self):
+        """
+        Stop writing queued items in background
+        """
+        if self._flusher is None:
+            return
+        self._stop_flushing.set()
+        self._flusher.join()
+        self._flusher = None
+
+    def _flush_periodically(self, interval_secs, on_failed, flush_now):
+        last_flush = time.monotonic()
+        while not self._stop_flushing.wait(BATCH_FLUSH_POLL_SECS):
+            due = time.monotonic() - last_flush >= interval_secs
+            if not due and not (flush_now is not None and flush_now()):
+                continue
+
+            last_flush = time.monotonic()
+            with self._lock:
+                has_pending = len(self._pending) > 0
+            if not has_pending:
+                continue
+            try:
+                on_failed(self.flush())
+            except Exception as ex:
+                logger.error(
+                    "Failed to write queued items to %s. Reason: %s",
+                    self.table_name,
+                    ex,
+                )
+
+    def _write(self, items):
+        requests = [{"PutRequest": {"Item": item}} for item in items]
+        attempt = 1
+        while True:
+            try:
+                resp = self.client.batch_write_item(
+                    RequestItems={self.table_name: requests}
+                )
+                requests = resp.get("UnprocessedItems", {}).get(self.table_name, [])
+            except ClientError as ce:
+                if not is_throttling_error(ce):
+                    logger.error(
+                        "Failed to write %s item(s) to %s. Reason: %s",
+                        len(requests),
+                        self.table_name,
+                        ce,
+                    )
+                    break
+
+            if len(requests) == 0 or attempt >= self.max_attempts:
+                break
+
+            logger.info(
+                "Retrying %s unprocessed item(s) for %s", len(requests), self.table_name
+            )
+            time.sleep(random.uniform(0, self.base_delay * 2**attempt))
+            attempt += 1
+
+        with self._lock:
+            self.written += len(items) - len(requests)
+        return [r["PutRequest"]["Item"] for r in requests]
+
+
+# Account id to account info and the time until which it is cached
+_account_info = {}
+_account_info_lock = threading.Lock()
+
+# IAM calls made and saved by account info cache during the current run
+account_info_stats = {"iam_calls": 0, "iam_calls_saved": 0}
 
 
 def fetch_account_info():
     """
-    Retrieve AWS account info
+    Retrieve info of the account of the current account scope. The info is
+    cached for ACCOUNT_INFO_TTL_SECS
+    """
+    account_id = _account.get()
+    with _account_info_lock:
+        cached = _account_info.get(account_id)
+        if cached is not None and time.monotonic() < cached[1]:
+            # Uncached lookup makes two ListAccountAliases calls
+            account_info_stats["iam_calls_saved"] += 2
+            return cached[0]
+
+        logger.info("Fetching account info")
+        aliases = get_iam_concurrency().call(get_client("iam").list_account_aliases)[
+            "AccountAliases"
+        ]
+        account_info_stats["iam_calls"] += 1
+        account_info_stats["iam_calls_saved"] += 1
+
+        info = {
+            "id": account_id or os.environ.get("ACCOUNT_ID", ""),
+            "name": aliases[0] if len(aliases) > 0 else "",
+        }
+        _account_info[account_id] = (info, time.monotonic() + ACCOUNT_INFO_TTL_SECS)
+        return info
+
+
+def reset_account_info_stats():
+    """
+    Reset account info cache stats at the start of a run
+    """
+    with _account_info_lock:
+        account_info_stats["iam_calls"] = 0
+        account_info_stats["iam_calls_saved"] = 0
+
+
+def log_account_info_stats():
+    """
+    Log IAM calls made and saved by account info cache during the run
+    """
+    logger.info(
+        "Account info: %s IAM call(s) made, %s IAM call(s) saved by cache",
+        account_info_stats["iam_calls"],
+        account_info_stats["iam_calls_saved"],
+    )
+
+
+_secrets = {}
+_secret_locks = {}
+_secrets_lock = threading.Lock()
+
+
+def _cached_secret(name):
+    with _secrets_lock:
+        cached = _secrets.get(name)
+        if cached is not None and time.monotonic() < cached[1]:
+            return cached[0]
+    return None
+
+
+def get_secret(name):
+    """
+    Retrieve decrypted value of SSM parameter. The value is cached for
+    SECRET_CACHE_TTL_SECS and only one thread fetches a given secret at a time
     """
-    return {
-        "id": os.environ.get("ACCOUNT_ID", ""),
-        "name": iam.list_account_aliases()["AccountAliases"][0]
-        if len(iam.list_account_aliases()["AccountAliases"]) > 0
-        else "",
-    }
+    value = _cached_secret(name)
+    if value is not None:
+        return value
+
+    with _secrets_lock:
+        lock = _secret_locks.setdefault(name, threading.Lock())
+
+    with lock:
+        # Secret may have been fetched by another thread while waiting for the lock
+        value = _cached_secret(name)
+        if value is not None:
+            return value
+
+        logger.info("Fetching %s secret from SSM", name)
+        resp = get_client("ssm").get_parameter(Name=name, WithDecryption=True)
+        value = resp["Parameter"]["Value"]
+        with _secrets_lock:
+            _secrets[name] = (value, time.monotonic() + SECRET_CACHE_TTL_SECS)
+
+    return value
+
+
+def invalidate_secret(name):
+    """
+    Remove secret from cache, e.g. when it is rejected by the mail provider
+    """
+    logger.info("Invalidating cached %s secret", name)
+    with _secrets_lock:
+        _secrets.pop(name, None)
+
+
+if PREFETCH_ACCOUNT_INFO:
+    try:
+        fetch_account_info()
+    except ClientError as ce:
+        logger.warning("Unable to prefetch account info. Reason: %s", ce)
@@ -3,15 +3,17 @@ Send email through SMTP server
 """
 
 import os
+import time
+import queue
 import smtplib
 import ssl
 import logging
+import threading
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 
-import boto3
-
-ssm = boto3.client("ssm", region_name=os.environ.get("AWS_REGION"))
+import shared_functions
+import metrics
 
 logger = logging.getLogger("smtp-mailer")
 logger.setLevel(logging.INFO)
@@ -28,51 +30,147 @@ SMTP_SERVER = os.environ.get("SMTP_SERVER", None)
 # SSM Parameter name which holds SMTP server password
 SMTP_PASSWORD_PARAMETER = os.environ.get("SMTP_PASSWORD_PARAMETER")
 
+# No. of seconds to wait for SMTP server to respond
+SMTP_TIMEOUT_SECS = float(os.environ.get("SMTP_TIMEOUT_SECS", 10))
+
+# Maximum no. of authenticated SMTP connections kept open per lambda container
+SMTP_POOL_SIZE = int(os.environ.get("SMTP_POOL_SIZE", 3))
+
+# No. of mails sent over a single SMTP connection before it is replaced
+SMTP_MAX_MAILS_PER_CONNECTION = int(
+    os.environ.get("SMTP_MAX_MAILS_PER_CONNECTION", 100)
+)
+
+
+def connect_via_ssl(mail_from, smtp_password):
+    """
+    Open an authenticated SMTP connection over SSL
+    """
+    context = ssl.create_default_context()
+    server = smtplib.SMTP_SSL(
+        SMTP_SERVER, SMTP_PORT, context=context, timeout=SMTP_TIMEOUT_SECS
+    )
+    server.login(mail_from, smtp_password)
+    return server
+
 
-def send_via_ssl(user_name, mail_from, smtp_password, mail_to, mail_body):
+def connect_via_tls(mail_from, smtp_password):
+    """
+    Open an authenticated SMTP connection over TLS
     """
-    Send email via SMTP over SSL
+    context = ssl.create_default_context()
+    server = smtplib.SMTP(SMTP_SERVER, SMTP_PORT, timeout=SMTP_TIMEOUT_SECS)
+    server.starttls(context=context)
+    server.login(mail_from, smtp_password)
+    return server
+
+
+def is_alive(server):
+    """
+    Checks if SMTP connection is still usable
     """
     try:
-        logger.info("Sending mail to %f (%f) via SMTP over SSL", user_name, mail_to)
-        context = ssl.create_default_context()
-        with smtplib.SMTP_SSL(SMTP_SERVER, SMTP_PORT, context=context) as server:
-            server.login(mail_from, smtp_password)
-            server.sendmail(mail_from, mail_to, mail_body)
-        logger.info("Mail sent to %s (%s) via SMTP over SSL", user_name, mail_to)
-    except Exception as ex:
-        logger.error("Unable to send mail via SSL to %s. Reason: %s", mail_to, ex)
+        return server.noop()[0] == 250
+    except (smtplib.SMTPException, OSError):
+        return False
 
 
-def send_via_tls(user_name, mail_from, smtp_password, mail_to, mail_body):
+def close_connection(server):
     """
-    Send email via SMTP over TLS
+    Close SMTP connection ignoring errors from already dropped connections
     """
     try:
-        logger.info("Sending mail to %s (%s) via SMTP over TLS", user_name, mail_to)
-        context = ssl.create_default_context()
-        with smtplib.SMTP(SMTP_SERVER, SMTP_PORT) as server:
-            server.starttls(context=context)
-            server.login(mail_from, smtp_password)
-            server.sendmail(mail_from, mail_to, mail_body)
-        logger.info("Mail sent to %s (%s) via SMTP over TLS", user_name, mail_to)
-    except Exception as ex:
-        logger.error("Unable to send mail via TLS to %s. Reason: %s", mail_to, ex)
+        server.quit()
+    except (smtplib.SMTPException, OSError):
+        server.close()
+
 
+class SMTPConnectionPool:
+    """
+    Keeps a small number of authenticated SMTP connections open and reuses
+    them for sending multiple mails
+    """
 
+    def __init__(self, size):
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(size)
+
+    def _checkout(self, mail_from, smtp_password):
+        while True:
+            try:
+                server, sent = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            if is_alive(server):
+                return server, sent
+            logger.info("Dropping stale SMTP connection")
+            close_connection(server)
+
+        logger.info("Opening new SMTP connection over %s", SMTP_PROTOCOL.upper())
+        if SMTP_PROTOCOL.lower() == "tls":
+            return connect_via_tls(mail_from, smtp_password), 0
+        return connect_via_ssl(mail_from, smtp_password), 0
+
+    def _checkin(self, server, sent):
+        if sent >= SMTP_MAX_MAILS_PER_CONNECTION:
+            close_connection(server)
+        else:
+            self._idle.put((server, sent))
+
+    def send(self, mail_from, smtp_password, mail_to, mail_body):
+        """
+        Send mail over a pooled connection. If a reused connection was dropped
+        by the server the mail is sent again over a new connection
+        """
+        with self._slots:
+            for attempt in (1, 2):
+                server, sent = self._checkout(mail_from, smtp_password)
+                try:
+                    server.sendmail(mail_from, mail_to, mail_body)
+                except smtplib.SMTPServerDisconnected:
+                    close_connection(server)
+                    if sent == 0 or attempt == 2:
+                        raise
+                    logger.info("SMTP connection dropped. Retrying on a new one")
+                    continue
+                except Exception:
+                    close_connection(server)
+                    raise
+
+                self._checkin(server, sent + 1)
+                return
+
+    def close(self):
+        """
+        Close all idle connections
+        """
+        while True:
+            try:
+                server, _ = self._idle.get_nowait()
+            except queue.Empty:
+                return
+            close_connection(server)
+
+
+pool = SMTPConnectionPool(SMTP_POOL_SIZE)
+
+
+@metrics.timed("mail")
 def send_email(
     mail_to, user_name, mail_subject, mail_from, mail_body_plain, mail_body_html
 ):
     """
-    Prepares message and decides if email will be sent over SSL or TLS
+    Prepares message and sends it over a pooled SSL or TLS connection
     """
     if SMTP_SERVER is None:
         logger.error("SMTP_SERVER value cannot be blank")
         return False
 
-    logger.info("Fetching SMTP password from SSM")
-    resp = ssm.get_parameter(Name=SMTP_PASSWORD_PARAMETER, WithDecryption=True)
-    smtp_password = resp["Parameter"]["Value"]
+    if SMTP_PROTOCOL.lower() not in ["ssl", "tls"]:
+        logger.error("%s is not a supported SMTP protocol", SMTP_PROTOCOL)
+        return False
+
+    smtp_password = shared_functions.get_secret(SMTP_PASSWORD_PARAMETER)
 
     message = MIMEMultipart("alternative")
     message["Subject"] = mail_subject
@@ -85,9 +183,30 @@ def send_email(
     message.attach(mail_body_plain)
     message.attach(mail_body_html)
 
-    if SMTP_PROTOCOL.lower() == "ssl":
-        send_via_ssl(user_name, mail_from, smtp_password, mail_to, message.as_string())
-    elif SMTP_PROTOCOL.lower() == "tls":
-        send_via_tls(user_name, mail_from, smtp_password, mail_to, message.as_string())
-    else:
-        logger.error("%s is not a supported SMTP protocol", SMTP_PROTOCOL)
+    started_at = time.monotonic()
+    try:
+        logger.info("Sending mail to %s (%s) via SMTP", user_name, mail_to)
+        pool.send(mail_from, smtp_password, mail_to, message.as_string())
+        logger.info("Mail sent to %s (%s) via SMTP", user_name, mail_to)
+    except smtplib.SMTPAuthenticationError as ae:
+        logger.error("SMTP server rejected the credentials. Reason: %s", ae)
+        shared_functions.invalidate_secret(SMTP_PASSWORD_PARAMETER)
+        metrics.record_api_call(
+            "smtp",
+            "SendMail",
+            (time.monotonic() - started_at) * 1000,
+            error_code=type(ae).__name__,
+        )
+        return False
+    except Exception as ex:
+        logger.error("Unable to send mail via SMTP to %s. Reason: %s", mail_to, ex)
+        metrics.record_api_call(
+            "smtp",
+            "SendMail",
+            (time.monotonic() - started_at) * 1000,
+            error_code=type(ex).__name__,
+        )
+        return False
+
+    metrics.record_api_call("smtp", "SendMail", (time.monotonic() - started_at) * 1000)
+    return True
@@ -0,0 +1,200 @@
+"""
+Per user state index which lets the creator skip users whose keys
+are not due for rotation
+"""
+
+import os
+import logging
+
+import shared_functions
+
+# Table name which holds run checkpoints and the user state index
+IAM_KEY_ROTATOR_STATE_TABLE = os.environ.get("IAM_KEY_ROTATOR_STATE_TABLE", None)
+
+# No. of days after which all the users are scanned again to correct any missed change
+FULL_SCAN_AFTER_DAYS = int(os.environ.get("FULL_SCAN_AFTER_DAYS", 7))
+
+# Global secondary index of the state table holding the entries to check, keyed
+# by index_scope and due_at. Entries which are not due until they change are left out
+DUE_INDEX_NAME = os.environ.get("DUE_INDEX_NAME", "due")
+
+logger = logging.getLogger("user-index")
+logger.setLevel(logging.INFO)
+
+
+def key_prefix():
+    """
+    Return prefix of the index entries. Entries of each target account are
+    kept apart in organization mode
+    """
+    account_id = shared_functions.current_account_id()
+    return "user:" if account_id is None else f"account:{account_id}:user:"
+
+
+def user_key(user_name):
+    """
+    Return state table key of the index entry of a user
+    """
+    return {"pk": {"S": f"{key_prefix()}{user_name}"}, "sk": {"S": "index"}}
+
+
+def load_due(now):
+    """
+    Return names of the users which are marked as changed or whose key is due
+    by now. Only the due index is read, so the cost depends on the no. of due users
+    """
+    user_names = []
+    prefix = key_prefix()
+    paginator = shared_functions.get_client("dynamodb").get_paginator("query")
+    for page in paginator.paginate(
+        TableName=IAM_KEY_ROTATOR_STATE_TABLE,
+        IndexName=DUE_INDEX_NAME,
+        KeyConditionExpression="index_scope = :scope AND due_at <= :now",
+        ExpressionAttributeValues={
+            ":scope": {"S": prefix},
+            ":now": {"N": str(now)},
+        },
+    ):
+        for item in page["Items"]:
+            user_names.append(item["pk"]["S"][len(prefix) :])
+
+    logger.info("User index contains %s changed or due user(s)", len(user_names))
+    return user_names
+
+
+def load_user_names():
+    """
+    Fetch names of all the users in the index. Scans the whole table, so it is
+    used only by full scans to remove users which no longer exist
+    """
+    user_names = []
+    prefix = key_prefix()
+    paginator = shared_functions.get_client("dynamodb").get_paginator("scan")
+    for page in paginator.paginate(
+        TableName=IAM_KEY_ROTATOR_STATE_TABLE,
+        FilterExpression="begins_with(pk, :prefix)",
+        ProjectionExpression="pk",
+        ExpressionAttributeValues={":prefix": {"S": prefix}},
+    ):
+        for item in page["Items"]:
+            user_names.append(item["pk"]["S"][len(prefix) :])
+
+    return user_names
+
+
+def build_entry(user_name, key_ages, rotate_after_days, delete_after_days, clock):
+    """
+    Build index entry from age of the keys in days as seen by the run clock. Users
+    without email tag are passed with rotate_after_days as None and are not due
+    until they are re-tagged
+    """
+    created = [clock.days_ago(age) for age in key_ages]
+    item = {
+        **user_key(user_name),
+        "keys": {"L": [{"N": str(c)} for c in created]},
+        "updated_at": {"N": str(clock.epoch)},
+    }
+    if rotate_after_days is None:
+        return item
+
+    item["rotate_after_days"] = {"N": str(rotate_after_days)}
+    item["delete_after_days"] = {"N": str(delete_after_days)}
+    if len(created) > 0:
+        # Key is rotated once it is older than rotate after days
+        next_due = {
+            "N": str(
+                min(created)
+                + (rotate_after_days + 1) * shared_functions.SECONDS_PER_DAY
+            )
+        }
+        item["next_due"] = next_due
+        item["index_scope"] = {"S": key_prefix()}
+        item["due_at"] = next_due
+    return item
+
+
+def save(items):
+    """
+    Write index entries in batches
+    """
+    writer = shared_functions.DynamoDBBatchWriter(
+        shared_functions.get_client("dynamodb"), IAM_KEY_ROTATOR_STATE_TABLE
+    )
+    for item in items:
+        writer.put(item)
+    failed = writer.flush()
+    if len(failed) > 0:
+        # Users without an up to date entry are checked again by the next run
+        logger.warning("Failed to update index for %s user(s)", len(failed))
+    logger.info("User index updated for %s user(s)", writer.written)
+
+
+def remove(user_names):
+    """
+    Remove index entries of users which no longer exist
+    """
+    for user_name in user_names:
+        shared_functions.get_client("dynamodb").delete_item(
+            TableName=IAM_KEY_ROTATOR_STATE_TABLE, Key=user_key(user_name)
+        )
+    if len(user_names) > 0:
+        logger.info("Removed %s deleted user(s) from index", len(user_names))
+
+
+def mark_dirty(user_name):
+    """
+    Mark user to be checked by the next run, e.g. when its tags or keys change.
+    Changed users are due right away
+    """
+    shared_functions.get_client("dynamodb").update_item(
+        TableName=IAM_KEY_ROTATOR_STATE_TABLE,
+        Key=user_key(user_name),
+        UpdateExpression="SET dirty = :dirty, updated_at = :now, index_scope = :scope, due_at = :due",
+        ExpressionAttributeValues={
+            ":dirty": {"BOOL": True},
+            ":now": {"N": str(shared_functions.run_clock().epoch)},
+            ":scope": {"S": key_prefix()},
+            ":due": {"N": "0"},
+        },
+    )
+    logger.info("User %s marked for check by the next run", user_name)
+
+
+def full_scan_key(scope):
+    """
+    Return state table key of the time of the last full scan. Entries written
+    before the due index existed are rewritten by the first scan under this key
+    """
+    return {"pk": {"S": "index_scan"}, "sk": {"S": scope}}
+
+
+def is_full_scan_due(scope):
+    """
+    Checks if all the users need to be scanned, either because the index is
+    not built yet or it was built more than FULL_SCAN_AFTER_DAYS ago
+    """
+    resp = shared_functions.get_client("dynamodb").get_item(
+        TableName=IAM_KEY_ROTATOR_STATE_TABLE,
+        Key=full_scan_key(scope),
+        ConsistentRead=True,
+    )
+    if "Item" not in resp:
+        return True
+
+    scanned_at = int(resp["Item"]["scanned_at"]["N"])
+    return shared_functions.run_clock().epoch - scanned_at > (
+        FULL_SCAN_AFTER_DAYS * shared_functions.SECONDS_PER_DAY
+    )
+
+
+def save_full_scan(scope):
+    """
+    Record that all the users were scanned
+    """
+    shared_functions.get_client("dynamodb").put_item(
+        TableName=IAM_KEY_ROTATOR_STATE_TABLE,
+        Item={
+            **full_scan_key(scope),
+            "scanned_at": {"N": str(shared_functions.run_clock().epoch)},
+        },
+    )
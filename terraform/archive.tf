@@ -13,6 +13,10 @@ data "archive_file" "creator" {
     content  = file("../src/encryption.py")
     filename = "encryption.py"
   }
+  source {
+    content  = file("../src/user_index.py")
+    filename = "user_index.py"
+  }
   source {
     content  = file("../src/ses_mailer.py")
     filename = "ses_mailer.py"
@@ -25,6 +29,14 @@ data "archive_file" "creator" {
     content  = file("../src/smtp_mailer.py")
     filename = "smtp_mailer.py"
   }
+  source {
+    content  = file("../src/notification_outbox.py")
+    filename = "notification_outbox.py"
+  }
+  source {
+    content  = file("../src/metrics.py")
+    filename = "metrics.py"
+  }
 }
 
 data "archive_file" "destructor" {
@@ -50,4 +62,12 @@ data "archive_file" "destructor" {
     content  = file("../src/smtp_mailer.py")
     filename = "smtp_mailer.py"
   }
+  source {
+    content  = file("../src/notification_outbox.py")
+    filename = "notification_outbox.py"
+  }
+  source {
+    content  = file("../src/metrics.py")
+    filename = "metrics.py"
+  }
 }
@@ -57,16 +57,61 @@ resource "aws_dynamodb_table" "iam_key_rotator" {
   tags = var.tags
 }
 
-# ====== Lambda Layers =====
-resource "aws_lambda_layer_version" "pytz" {
-  filename            = "pytz.zip"
-  source_code_hash    = filebase64sha256("pytz.zip")
-  description         = "https://pypi.org/project/pytz/"
-  layer_name          = "pytz"
-  compatible_runtimes = ["python3.6", "python3.7", "python3.8", "python3.9"]
+# DynamoDB table for storing run checkpoints
+resource "aws_dynamodb_table" "iam_key_rotator_state" {
+  # checkov:skip=CKV_AWS_119: SSE is enabled by default using AWS owned SSE. If required customer owned key can be used
+  # checkov:skip=CKV_AWS_28: Enabling PITR depends on user
+  name         = var.state_table_name
+  billing_mode = "PAY_PER_REQUEST"
+  hash_key     = "pk"
+  range_key    = "sk"
+
+  attribute {
+    name = "pk"
+    type = "S"
+  }
 
+  attribute {
+    name = "sk"
+    type = "S"
+  }
+
+  attribute {
+    name = "index_scope"
+    type = "S"
+  }
+
+  attribute {
+    name = "due_at"
+    type = "N"
+  }
+
+  # User index entries which are changed or due, so that a run reads only those
+  global_secondary_index {
+    name            = "due"
+    hash_key        = "index_scope"
+    range_key       = "due_at"
+    projection_type = "KEYS_ONLY"
+  }
+
+  ttl {
+    attribute_name = "expires_at"
+    enabled        = true
+  }
+
+  server_side_encryption {
+    enabled     = var.enable_sse
+    kms_key_arn = var.kms_key_arn
+  }
+
+  point_in_time_recovery {
+    enabled = var.enable_pitr
+  }
+
+  tags = var.tags
 }
 
+# ====== Lambda Layers =====
 resource "aws_lambda_layer_version" "requests" {
   filename            = "requests.zip"
   source_code_hash    = filebase64sha256("requests.zip")
@@ -105,17 +150,35 @@ resource "aws_iam_role_policy" "iam_key_creator_policy" {
           "iam:ListAccessKeys",
           "iam:ListUsers",
           "iam:CreateAccessKey",
-          "iam:ListAccountAliases"
+          "iam:DeleteAccessKey",
+          "iam:ListAccountAliases",
+          "iam:GetAccountAuthorizationDetails",
+          "iam:GenerateCredentialReport",
+          "iam:GetCredentialReport"
         ]
         Resource = ["*"]
         },
         {
           Effect = "Allow"
           Action = [
-            "dynamodb:PutItem"
+            "dynamodb:PutItem",
+            "dynamodb:BatchWriteItem"
           ]
           Resource = [aws_dynamodb_table.iam_key_rotator.arn]
         },
+        {
+          Effect = "Allow"
+          Action = [
+            "dynamodb:GetItem",
+            "dynamodb:PutItem",
+            "dynamodb:UpdateItem",
+            "dynamodb:DeleteItem",
+            "dynamodb:BatchWriteItem",
+            "dynamodb:Scan",
+            "dynamodb:Query"
+          ]
+          Resource = [aws_dynamodb_table.iam_key_rotator_state.arn, "${aws_dynamodb_table.iam_key_rotator_state.arn}/index/*"]
+        },
         {
           Effect = "Allow"
           Action = [
@@ -123,15 +186,45 @@ resource "aws_iam_role_policy" "iam_key_creator_policy" {
           ]
           Resource = ["arn:aws:ssm:${var.region}:${local.account_id}:parameter/ikr/*"]
       }],
-      var.encrypt_key_pair ? [{
+      var.encrypt_key_pair && var.encryption_mode == "ssm" ? [{
         Effect   = "Allow"
         Action   = ["ssm:PutParameter"]
         Resource = ["arn:aws:ssm:${var.region}:${local.account_id}:parameter/ikr/*"]
       }] : [],
+      var.encrypt_key_pair && var.encryption_mode == "kms" ? [{
+        Effect   = "Allow"
+        Action   = ["kms:GenerateDataKey"]
+        Resource = [var.encryption_kms_key_arn]
+      }] : [],
       var.mail_client == "ses" ? [{
         Effect   = "Allow"
         Action   = ["ses:SendEmail"]
         Resource = ["*"]
+      }] : [],
+      var.mail_client == "ses" && var.ses_template_mode ? [{
+        Effect = "Allow"
+        Action = [
+          "ses:CreateTemplate",
+          "ses:UpdateTemplate",
+          "ses:SendBulkTemplatedEmail",
+          "ses:GetSendQuota"
+        ]
+        Resource = ["*"]
+      }] : [],
+      var.self_invoke || var.fan_out ? [{
+        Effect   = "Allow"
+        Action   = ["lambda:InvokeFunction"]
+        Resource = ["arn:aws:lambda:${var.region}:${local.account_id}:function:${var.key_creator_function_name}"]
+      }] : [],
+      var.target_accounts != "" ? [{
+        Effect   = "Allow"
+        Action   = ["sts:AssumeRole"]
+        Resource = ["arn:aws:iam::*:role/${var.organization_role_name}"]
+      }] : [],
+      var.target_accounts == "organization" ? [{
+        Effect   = "Allow"
+        Action   = ["organizations:ListAccounts"]
+        Resource = ["*"]
       }] : []
     ])
   })
@@ -185,7 +278,7 @@ resource "aws_lambda_function" "iam_key_creator" {
   timeout                        = var.function_timeout
   reserved_concurrent_executions = var.reserved_concurrent_executions
 
-  layers = [aws_lambda_layer_version.pytz.arn, aws_lambda_layer_version.requests.arn, aws_lambda_layer_version.cryptography.arn]
+  layers = [aws_lambda_layer_version.requests.arn, aws_lambda_layer_version.cryptography.arn]
 
   tracing_config {
     mode = var.xray_tracing_mode
@@ -193,19 +286,38 @@ resource "aws_lambda_function" "iam_key_creator" {
 
   environment {
     variables = {
-      IAM_KEY_ROTATOR_TABLE   = aws_dynamodb_table.iam_key_rotator.name
-      ROTATE_AFTER_DAYS       = var.rotate_after_days
-      DELETE_AFTER_DAYS       = var.delete_after_days
-      ENCRYPT_KEY_PAIR        = var.encrypt_key_pair
-      MAIL_CLIENT             = var.mail_client
-      MAIL_FROM               = var.mail_from
-      SMTP_PROTOCOL           = var.smtp_protocol
-      SMTP_PORT               = var.smtp_port
-      SMTP_SERVER             = var.smtp_server
-      SMTP_PASSWORD_PARAMETER = var.mail_client == "smtp" ? join(",", aws_ssm_parameter.smtp_password.*.name) : null
-      MAILGUN_API_URL         = var.mailgun_api_url
-      MAILGUN_API_KEY_NAME    = var.mail_client == "mailgun" ? join(",", aws_ssm_parameter.mailgun.*.name) : null
-      ACCOUNT_ID              = local.account_id
+      IAM_KEY_ROTATOR_TABLE       = aws_dynamodb_table.iam_key_rotator.name
+      ROTATE_AFTER_DAYS           = var.rotate_after_days
+      DELETE_AFTER_DAYS           = var.delete_after_days
+      ENCRYPT_KEY_PAIR            = var.encrypt_key_pair
+      MAIL_CLIENT                 = var.mail_client
+      MAIL_FROM                   = var.mail_from
+      SMTP_PROTOCOL               = var.smtp_protocol
+      SMTP_PORT                   = var.smtp_port
+      SMTP_SERVER                 = var.smtp_server
+      SMTP_PASSWORD_PARAMETER     = var.mail_client == "smtp" ? join(",", aws_ssm_parameter.smtp_password.*.name) : null
+      MAILGUN_API_URL             = var.mailgun_api_url
+      MAILGUN_API_KEY_NAME        = var.mail_client == "mailgun" ? join(",", aws_ssm_parameter.mailgun.*.name) : null
+      ACCOUNT_ID                  = local.account_id
+      PREFETCH_ACCOUNT_INFO       = "true"
+      SES_TEMPLATE_MODE           = var.ses_template_mode
+      INVENTORY_MODE              = var.inventory_mode
+      KEY_AGE_SOURCE              = var.key_age_source
+      IAM_KEY_ROTATOR_STATE_TABLE = aws_dynamodb_table.iam_key_rotator_state.name
+      SELF_INVOKE                 = var.self_invoke
+      FAN_OUT                     = var.fan_out
+      USERS_PER_SHARD             = var.users_per_shard
+      INCREMENTAL                 = var.incremental
+      MAX_ROTATIONS_PER_RUN       = var.max_rotations_per_run
+      ROTATION_SPREAD_DAYS        = var.rotation_spread_days
+      TARGET_ACCOUNTS             = var.target_accounts
+      ORGANIZATION_ROLE_NAME      = var.organization_role_name
+      ACCOUNT_MAX_WORKERS         = var.account_max_workers
+      ENCRYPTION_MODE             = var.encryption_mode
+      KMS_KEY_ID                  = var.encryption_kms_key_arn
+      IAM_MAX_WORKERS             = var.iam_max_workers
+      METRICS_ENABLED             = var.metrics_enabled
+      METRICS_NAMESPACE           = var.metrics_namespace
     }
   }
 
@@ -234,6 +346,39 @@ resource "aws_lambda_permission" "iam_key_creator" {
   source_arn    = aws_cloudwatch_event_rule.iam_key_creator.arn
 }
 
+# IAM events are delivered only in us-east-1 region
+resource "aws_cloudwatch_event_rule" "iam_key_creator_user_changes" {
+  count       = var.incremental ? 1 : 0
+  name        = "IAMAccessKeyCreatorUserChanges"
+  description = "Triggers a lambda function which updates rotation schedule of a user whenever its tags or access keys change"
+  state       = "ENABLED"
+  event_pattern = jsonencode({
+    source      = ["aws.iam"]
+    detail-type = ["AWS API Call via CloudTrail"]
+    detail = {
+      eventSource = ["iam.amazonaws.com"]
+      eventName   = ["CreateUser", "DeleteUser", "TagUser", "UntagUser", "CreateAccessKey", "DeleteAccessKey"]
+    }
+  })
+  tags = var.tags
+}
+
+resource "aws_cloudwatch_event_target" "iam_key_creator_user_changes" {
+  count     = var.incremental ? 1 : 0
+  rule      = aws_cloudwatch_event_rule.iam_key_creator_user_changes[0].name
+  target_id = "TriggerIAMKeyCreatorLambdaOnUserChange"
+  arn       = aws_lambda_function.iam_key_creator.arn
+}
+
+resource "aws_lambda_permission" "iam_key_creator_user_changes" {
+  count         = var.incremental ? 1 : 0
+  statement_id  = "AllowExecutionFromCloudWatchOnUserChange"
+  action        = "lambda:InvokeFunction"
+  function_name = aws_lambda_function.iam_key_creator.function_name
+  principal     = "events.amazonaws.com"
+  source_arn    = aws_cloudwatch_event_rule.iam_key_creator_user_changes[0].arn
+}
+
 # ====== iam-key-destructor ======
 resource "aws_iam_role" "iam_key_destructor" {
   name                  = var.key_destructor_role_name
@@ -277,13 +422,28 @@ resource "aws_iam_role_policy" "iam_key_destructor_policy" {
       }],
       var.encrypt_key_pair ? [{
         Effect   = "Allow"
-        Action   = ["ssm:DeleteParameter"]
+        Action   = ["ssm:DeleteParameter", "ssm:DeleteParameters"]
         Resource = ["arn:aws:ssm:${var.region}:${local.account_id}:parameter/ikr/secret/iam/*"]
       }] : [],
       var.mail_client == "ses" ? [{
         Effect   = "Allow"
         Action   = ["ses:SendEmail"]
         Resource = ["*"]
+      }] : [],
+      var.mail_client == "ses" && var.ses_template_mode ? [{
+        Effect = "Allow"
+        Action = [
+          "ses:CreateTemplate",
+          "ses:UpdateTemplate",
+          "ses:SendBulkTemplatedEmail",
+          "ses:GetSendQuota"
+        ]
+        Resource = ["*"]
+      }] : [],
+      var.target_accounts != "" ? [{
+        Effect   = "Allow"
+        Action   = ["sts:AssumeRole"]
+        Resource = ["arn:aws:iam::*:role/${var.organization_role_name}"]
       }] : []
     ])
   })
@@ -331,6 +491,7 @@ resource "aws_lambda_function" "iam_key_destructor" {
     variables = {
       IAM_KEY_ROTATOR_TABLE   = aws_dynamodb_table.iam_key_rotator.name
       RETRY_AFTER_MINS        = var.retry_after_mins
+      IAM_MAX_WORKERS         = var.iam_max_workers
       MAIL_CLIENT             = var.mail_client
       MAIL_FROM               = var.mail_from
       SMTP_PROTOCOL           = var.smtp_protocol
@@ -340,6 +501,11 @@ resource "aws_lambda_function" "iam_key_destructor" {
       MAILGUN_API_URL         = var.mailgun_api_url
       MAILGUN_API_KEY_NAME    = var.mail_client == "mailgun" ? join(",", aws_ssm_parameter.mailgun.*.name) : null
       ACCOUNT_ID              = local.account_id
+      PREFETCH_ACCOUNT_INFO   = "true"
+      SES_TEMPLATE_MODE       = var.ses_template_mode
+      ORGANIZATION_ROLE_NAME  = var.organization_role_name
+      METRICS_ENABLED         = var.metrics_enabled
+      METRICS_NAMESPACE       = var.metrics_namespace
     }
   }
 
@@ -347,10 +513,11 @@ resource "aws_lambda_function" "iam_key_destructor" {
 }
 
 resource "aws_lambda_event_source_mapping" "iam_key_destructor" {
-  event_source_arn       = aws_dynamodb_table.iam_key_rotator.stream_arn
-  function_name          = aws_lambda_function.iam_key_destructor.arn
-  starting_position      = "LATEST"
-  maximum_retry_attempts = 0
+  event_source_arn        = aws_dynamodb_table.iam_key_rotator.stream_arn
+  function_name           = aws_lambda_function.iam_key_destructor.arn
+  starting_position       = "LATEST"
+  maximum_retry_attempts  = var.stream_retry_attempts
+  function_response_types = ["ReportBatchItemFailures"]
 
   depends_on = [aws_iam_role_policy.iam_key_destructor_policy]
 }
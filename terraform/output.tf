@@ -3,6 +3,11 @@ output "table_name" {
   description = "Name of dynamodb table created for storing access keys to be deleted"
 }
 
+output "state_table_name" {
+  value       = aws_dynamodb_table.iam_key_rotator_state.name
+  description = "Name of dynamodb table created for storing checkpoints and results of key creator runs"
+}
+
 output "key_creator_function_name" {
   value       = aws_lambda_function.iam_key_creator.function_name
   description = "Name of lambda function created to create a set of new key pair for IAM user"
@@ -34,6 +34,12 @@ variable "table_name" {
   description = "Name of dynamodb table to store access keys to be deleted"
 }
 
+variable "state_table_name" {
+  type        = string
+  default     = "iam-key-rotator-state"
+  description = "Name of dynamodb table to store checkpoints and results of key creator runs"
+}
+
 variable "enable_sse" {
   type        = bool
   default     = true
@@ -136,12 +142,102 @@ variable "retry_after_mins" {
   description = "In case lambda fails to delete the old key, how long should it wait before the next try"
 }
 
+variable "inventory_mode" {
+  type        = string
+  default     = "bulk"
+  description = "How key creator function fetches users and their tags. **Possible values:** `bulk` (GetAccountAuthorizationDetails) and `per_user` (ListUserTags for each user)"
+}
+
+variable "key_age_source" {
+  type        = string
+  default     = "report"
+  description = "Where key creator function reads access key age from. **Possible values:** `report` (IAM credential report) and `api` (ListAccessKeys for each user). **Note:** Keys are fetched per user if the credential report is missing or stale"
+}
+
+variable "iam_max_workers" {
+  type        = number
+  default     = 32
+  description = "Maximum no. of IAM calls both creator and destructor function run in parallel. Parallelism is adjusted automatically up to this value and reduced whenever IAM throttles the calls"
+}
+
+variable "stream_retry_attempts" {
+  type        = number
+  default     = 3
+  description = "No. of times destructor function is retried for a stream record that could neither be processed nor added back to the table for a later retry"
+}
+
+variable "self_invoke" {
+  type        = bool
+  default     = true
+  description = "Whether key creator function invokes itself to continue the run when it stops early to avoid timing out. **Note:** If disabled, the next scheduled run continues from the saved checkpoint"
+}
+
+variable "fan_out" {
+  type        = bool
+  default     = false
+  description = "Whether key creator function splits users into shards and invokes itself once per shard so that the shards are processed in parallel"
+}
+
+variable "users_per_shard" {
+  type        = number
+  default     = 1000
+  description = "No. of users processed by a single shard. **Note:** Used only if fan out is enabled. No. of shards is also limited by `iam_max_workers`"
+}
+
+variable "incremental" {
+  type        = bool
+  default     = false
+  description = "Whether key creator function keeps an index of user state and checks only new, changed or due users. Tag and access key changes are picked up through CloudTrail events. All the users are still scanned once a week. **Note:** IAM events are delivered only in us-east-1 region and require CloudTrail to be enabled"
+}
+
+variable "max_rotations_per_run" {
+  type        = number
+  default     = 0
+  description = "Maximum no. of access keys rotated by a single run of key creator function, the most overdue keys first. Remaining due keys are rotated by the following runs. 0 rotates all the due keys"
+}
+
+variable "rotation_spread_days" {
+  type        = number
+  default     = 0
+  description = "No. of days over which rotation of keys that become due on the same day is spread when max_rotations_per_run leaves due keys for later runs. Each left over user is delayed by a fixed no. of days based on the hash of its name. Keys under the cap are always rotated as soon as they are due"
+}
+
+variable "target_accounts" {
+  type        = string
+  default     = ""
+  description = "Comma separated ids of the accounts whose keys are rotated by assuming `organization_role_name` in each one, or `organization` for all the active accounts of the AWS organization. Empty rotates keys of the account in which the functions are deployed. **Note:** Fan out is not used in organization mode"
+}
+
+variable "organization_role_name" {
+  type        = string
+  default     = "iam-key-rotator"
+  description = "Name of the role assumed by both creator and destructor function in each target account. The role must trust the roles of both functions. **Note:** Used only if `target_accounts` is set"
+}
+
+variable "account_max_workers" {
+  type        = number
+  default     = 4
+  description = "Maximum no. of target accounts key creator function processes in parallel. Each account makes up to `iam_max_workers` IAM calls in parallel. **Note:** Used only if `target_accounts` is set"
+}
+
 variable "encrypt_key_pair" {
   type        = bool
   default     = true
   description = "Whether to share encrypted version of key pair with the user instead of sending them in plain text. The encryption key will be stored in SSM paramter store in `/ikr/secret/iam/USERNAME` format"
 }
 
+variable "encryption_mode" {
+  type        = string
+  default     = "ssm"
+  description = "How the key pair is encrypted. **Possible values:** `ssm` (encryption key stored in SSM parameter store) and `kms` (data key generated by AWS KMS for each user and shared in encrypted form in the mail, no SSM parameter is created). **Note:** Used only if `encrypt_key_pair` is set to true"
+}
+
+variable "encryption_kms_key_arn" {
+  type        = string
+  default     = null
+  description = "ARN of KMS key used to generate data keys. Users need `kms:Decrypt` permission on this key with encryption context `ikr:user` set to their user name. **Note:** Required if encryption mode is set to kms"
+}
+
 variable "mail_client" {
   type        = string
   default     = "ses"
@@ -153,6 +249,12 @@ variable "mail_from" {
   description = "Email address which should be used for sending mails. **Note:** Prior setup of mail client is required"
 }
 
+variable "ses_template_mode" {
+  type        = bool
+  default     = false
+  description = "Whether to send mails in bulk using SES templates instead of one SendEmail call per user. Mails are paced according to the SES maximum send rate of the account. **Note:** Used only if mail client is set to ses"
+}
+
 variable "smtp_protocol" {
   type        = string
   default     = null
@@ -200,3 +302,15 @@ variable "cw_logs_kms_key_arn" {
   default     = null
   description = "ARN of KMS key to use for encrypting CloudWatch logs at rest"
 }
+
+variable "metrics_enabled" {
+  type        = bool
+  default     = true
+  description = "Whether to publish metrics of each invocation to CloudWatch using embedded metric format"
+}
+
+variable "metrics_namespace" {
+  type        = string
+  default     = "IAMKeyRotator"
+  description = "CloudWatch namespace under which metrics are published"
+}